@@ -61,6 +61,7 @@ interface TokenItem {
   deleted_at: string | null;
   enable: number;
   count: number;
+  usage_window?: number | null;
   account_type: string | null;
 }
 
@@ -340,7 +341,9 @@ const TokensPage: React.FC = () => {
     if (!batchRefreshTask) return;
     const timer = setInterval(async () => {
       try {
+        // 只需要计数器，不拉取明细
         const res = await api.get(`/register/refresh-status/${batchRefreshTask}`, {
+          params: { limit: 0 },
           headers: {
             'Authorization': `Bearer ${localStorage.getItem('adminToken')}`
           }
@@ -386,7 +389,9 @@ const TokensPage: React.FC = () => {
     if (!registrationTask) return;
     const timer = setInterval(async () => {
       try {
+        // 只需要计数器，不拉取明细
         const res = await api.get(`/register/status/${registrationTask}`, {
+          params: { limit: 0 },
           headers: {
             'Authorization': `Bearer ${localStorage.getItem('adminToken')}`
           }
@@ -720,6 +725,9 @@ const TokensPage: React.FC = () => {
                     <Chip color="primary" size="sm" variant="flat" className="text-sm bg-blue-100/50">
                       {row.count}
                     </Chip>
+                    {row.usage_window != null && (
+                      <span className="text-xs text-gray-500 ml-2">窗口: {row.usage_window}</span>
+                    )}
                   </div>
                   <div className="flex items-center bg-gray-50/80 p-2 rounded-lg">
                     <div className="text-xs font-medium text-gray-500 mr-2">状态:</div>
@@ -844,6 +852,9 @@ const TokensPage: React.FC = () => {
                         <Chip color="primary" size="sm" variant="flat" className="text-sm">
                           {row.count}
                         </Chip>
+                        {row.usage_window != null && (
+                          <div className="text-xs text-gray-500 mt-1">窗口: {row.usage_window}</div>
+                        )}
                       </TableCell>
                       <TableCell>
                         <Switch
@@ -1,6 +1,7 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
 from env import DATABASE_URL
 
 # 创建数据库引擎，增加连接池配置
@@ -26,3 +27,13 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# 短生命周期的数据库会话，用完立即归还连接池
+# 用于流式响应等长请求：不要通过 Depends(get_db) 持有连接直到响应结束
+@contextmanager
+def session_scope():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
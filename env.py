@@ -52,14 +52,118 @@ else:
     redis_client_config = None
 
 REDIS_ACCOUNT_CACHE_TTL = int(os.environ.get('REDIS_ACCOUNT_CACHE_TTL', 30))  # 账号缓存过期时间（秒）
+ACCOUNT_L1_CACHE_TTL = int(os.environ.get('ACCOUNT_L1_CACHE_TTL', 300))  # 进程内账号缓存过期时间（秒）
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 5))  # Redis健康状态缓存时间（秒）
+
+# 账号池后端: redis（默认，多副本共享）或 memory（进程内账号池，适合单节点部署）
+# Redis不可用时会自动回退到 memory
+ACCOUNT_POOL_BACKEND = os.environ.get('ACCOUNT_POOL_BACKEND', 'redis').lower()
+MEMORY_POOL_LOAD_BATCH = int(os.environ.get('MEMORY_POOL_LOAD_BATCH', 1000))  # 内存账号池每批从数据库加载的账号数
+ACCOUNT_CANDIDATE_BATCH = int(os.environ.get('ACCOUNT_CANDIDATE_BATCH', 500))  # 每次刷新写入Redis的候选账号数（按使用次数最少）
+
+# 滑动窗口使用量（Redis账号池）：按最近 USAGE_WINDOW_MINUTES 分钟的使用量均衡挑选账号，
+# 最近 USAGE_RATE_WINDOW_MINUTES 分钟内使用达到 ACCOUNT_RATE_LIMIT 次的账号尽量避开（0表示不限制）
+USAGE_WINDOW_MINUTES = int(os.environ.get('USAGE_WINDOW_MINUTES', 24 * 60))
+USAGE_RATE_WINDOW_MINUTES = int(os.environ.get('USAGE_RATE_WINDOW_MINUTES', 5))
+ACCOUNT_RATE_LIMIT = int(os.environ.get('ACCOUNT_RATE_LIMIT', 0))
+# 挑选账号时随机抽取的候选数，在抽样中选窗口使用量最少的账号（开销与账号总数无关）
+USAGE_PICK_SAMPLE = int(os.environ.get('USAGE_PICK_SAMPLE', 16))
+
+# 主动刷新凭据：在 token_expires 前多少秒刷新，以及随机抖动范围和并发线程数
+TOKEN_REFRESH_LEAD_SECONDS = int(os.environ.get('TOKEN_REFRESH_LEAD_SECONDS', 120))
+TOKEN_REFRESH_JITTER_SECONDS = int(os.environ.get('TOKEN_REFRESH_JITTER_SECONDS', 60))
+TOKEN_REFRESH_WORKERS = int(os.environ.get('TOKEN_REFRESH_WORKERS', 5))
+# 主动刷新失败（账号未被禁用）后至少等待多少秒再重试，另加随机抖动
+TOKEN_REFRESH_RETRY_SECONDS = int(os.environ.get('TOKEN_REFRESH_RETRY_SECONDS', 60))
+REFRESH_LOCK_TTL = int(os.environ.get('REFRESH_LOCK_TTL', 30))  # 跨副本凭据刷新锁的过期时间（秒）
+
+# 批量刷新：并发数、对 auth.chatbetter.com 的限流（每秒请求数 / 突发上限）、失败退避（秒）
+REFRESH_CONCURRENCY = int(os.environ.get('REFRESH_CONCURRENCY', 50))
+AUTH_RATE_LIMIT = float(os.environ.get('AUTH_RATE_LIMIT', 10))
+AUTH_RATE_BURST = int(os.environ.get('AUTH_RATE_BURST', 20))
+REFRESH_BACKOFF_BASE_SECONDS = int(os.environ.get('REFRESH_BACKOFF_BASE_SECONDS', 60))
+REFRESH_BACKOFF_MAX_SECONDS = int(os.environ.get('REFRESH_BACKOFF_MAX_SECONDS', 6 * 3600))
+
+# 到期刷新调度（cookies 即将过期的账号和禁用账号的重试）：检查间隔（秒）、连续失败多少次后视为永久失效
+# access_token 的刷新只由主动刷新器（TOKEN_REFRESH_*）负责
+REFRESH_CHECK_INTERVAL_SECONDS = int(os.environ.get('REFRESH_CHECK_INTERVAL_SECONDS', 120))
+MAX_REFRESH_FAILURES = int(os.environ.get('MAX_REFRESH_FAILURES', 10))
 
 # 代理配置（可选），如 http://127.0.0.1:7890 或 socks5://127.0.0.1:1080
 PROXY_URL = os.environ.get('PROXY_URL')
 
+# 同步HTTP客户端：连接/读取超时（秒）、每个主机的连接池大小、重试次数和退避系数
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 50))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+
 # 管理员密码，从环境变量获取，如果没有则使用默认值
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', '123456')
 
 # 批量注册线程池最大线程数
 REGISTER_MAX_THREADS = int(os.environ.get('REGISTER_MAX_THREADS', '10'))
 
+# 注册流水线：同时检查邮箱的数量、auth.chatbetter.com 请求限流（每秒/突发）、同时处理的邮箱上限
+REGISTER_MAIL_CONCURRENCY = int(os.environ.get('REGISTER_MAIL_CONCURRENCY', 20))
+REGISTER_RATE_LIMIT = float(os.environ.get('REGISTER_RATE_LIMIT', 5))
+REGISTER_RATE_BURST = int(os.environ.get('REGISTER_RATE_BURST', 10))
+REGISTER_MAX_INFLIGHT = int(os.environ.get('REGISTER_MAX_INFLIGHT', 2000))
+
+# 账号批量写入：每批条数和最长等待时间（毫秒）
+TOKEN_UPSERT_BATCH = int(os.environ.get('TOKEN_UPSERT_BATCH', 200))
+TOKEN_UPSERT_FLUSH_MS = int(os.environ.get('TOKEN_UPSERT_FLUSH_MS', 500))
+
+# 后台任务状态：保留时间（秒）和每个任务最多保留的最终结果条数、条目最新状态数
+TASK_STATUS_TTL = int(os.environ.get('TASK_STATUS_TTL', 24 * 3600))
+TASK_DETAILS_MAX = int(os.environ.get('TASK_DETAILS_MAX', 5000))
+
+# 后台作业队列：每个 worker 进程同时执行的作业数、作业租约（秒，worker 失联超过该时间后作业重新入队）、
+# 空闲时的轮询间隔（秒）、作业最多执行次数；EMBEDDED_JOB_WORKER 为 true 时 API 进程内也运行一个 worker
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 2))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+EMBEDDED_JOB_WORKER = os.environ.get('EMBEDDED_JOB_WORKER', 'true').lower() == 'true'
+
+# 定时任务调度器：主实例租约（秒）、执行时间的随机抖动上限（秒）、每个任务保留的执行记录条数；
+# EMBEDDED_SCHEDULER 为 true 时 API 进程也参与主实例选举，单独部署调度器进程（python scheduler.py）时可设为 false
+SCHEDULER_LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 30))
+SCHEDULER_JITTER_SECONDS = int(os.environ.get('SCHEDULER_JITTER_SECONDS', 30))
+SCHEDULER_HISTORY_MAX = int(os.environ.get('SCHEDULER_HISTORY_MAX', 50))
+EMBEDDED_SCHEDULER = os.environ.get('EMBEDDED_SCHEDULER', 'true').lower() == 'true'
+
+# API 服务（python main.py 启动）：监听地址/端口、worker 进程数、监听队列长度、keep-alive 超时（秒）
+API_HOST = os.environ.get('API_HOST', '0.0.0.0')
+API_PORT = int(os.environ.get('API_PORT', 8055))
+API_WORKERS = int(os.environ.get('API_WORKERS', 1))
+API_BACKLOG = int(os.environ.get('API_BACKLOG', 2048))
+API_KEEPALIVE_SECONDS = int(os.environ.get('API_KEEPALIVE_SECONDS', 15))
+# /v1/chat/completions 准入控制（每个 API 进程独立）：全局并发、付费/普通账号路由的并发、
+# 全局并发中只给流式请求使用的预留比例、只给付费账号路由使用的预留比例、等待队列长度、排队超时（秒）、Retry-After 上限（秒）
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 200))
+ADMISSION_PAID_CONCURRENCY = int(os.environ.get('ADMISSION_PAID_CONCURRENCY', 50))
+ADMISSION_FREE_CONCURRENCY = int(os.environ.get('ADMISSION_FREE_CONCURRENCY', 200))
+ADMISSION_INTERACTIVE_RESERVED = float(os.environ.get('ADMISSION_INTERACTIVE_RESERVED', 0.3))
+ADMISSION_PAID_RESERVED = float(os.environ.get('ADMISSION_PAID_RESERVED', 0.2))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 100))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+ADMISSION_RETRY_AFTER_MAX = int(os.environ.get('ADMISSION_RETRY_AFTER_MAX', 30))
+
+# 优雅停机：等待进行中的流式响应、后台作业和定时任务结束的最长时间（秒）
+SHUTDOWN_TIMEOUT_SECONDS = int(os.environ.get('SHUTDOWN_TIMEOUT_SECONDS', 30))
+
+# 会话亲和：多轮对话的后续请求复用上一轮所在账号的上游对话（只发送新的一轮），条目在Redis中保留的秒数，0 表示关闭
+CONVERSATION_CACHE_TTL = int(os.environ.get('CONVERSATION_CACHE_TTL', 1800))
+
+# 精确匹配响应缓存（默认关闭）：相同的模型、消息和参数直接返回缓存的结果；条目保留秒数、条目数上限、单条大小上限（字节）
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', 262144))
+
+# 相同请求的并发合并：同时到达的相同请求只向上游发起一次生成，默认关闭；请求头 X-Coalesce: true/false 可按请求开启或关闭
+REQUEST_COALESCING = os.environ.get('REQUEST_COALESCING', 'false').lower() == 'true'
+
 FILE_DOMAIN = os.environ.get('FILE_DOMAIN', 'https://127.0.0.1:8055')
@@ -7,12 +7,31 @@ from routers import token, register, reverse
 import os
 import threading
 import time
-from utils.check_cookies import run_scheduler as run_cookies_scheduler, check_and_refresh_accounts
-from utils.check_models import run_scheduler as run_models_scheduler, refresh_models
-from utils.redis_cache import test_connection as test_redis_connection
-from utils.account_manager import refresh_accounts_cache
-from db import get_db
-from env import PROXY_URL
+import importlib.util
+from utils.redis_cache import test_connection as test_redis_connection, acquire_task_lock
+from utils.account_manager import refresh_accounts_cache, use_memory_pool
+from utils.local_cache import start_invalidation_listener
+from utils.token_refresher import token_refresher
+from utils.job_queue import JobWorker
+from utils.scheduler import start_scheduler, stop_scheduler
+from utils.usage_counter import flush_usage_counts
+from utils.token_writer import token_collector
+from utils.http_client import close_session
+from utils import ws_pool
+from db import get_db, session_scope
+from env import (
+    PROXY_URL,
+    ACCOUNT_POOL_BACKEND,
+    EMBEDDED_JOB_WORKER,
+    EMBEDDED_SCHEDULER,
+    API_HOST,
+    API_PORT,
+    API_WORKERS,
+    API_BACKLOG,
+    API_KEEPALIVE_SECONDS,
+    SHUTDOWN_TIMEOUT_SECONDS,
+)
+import asyncio
 import subprocess, shutil
 
 # 创建FastAPI应用
@@ -37,9 +56,8 @@ app.include_router(register.router)  # 添加注册路由器
 app.include_router(reverse.router)  # 注册reverse路由器
 
 # 后台线程
-cookie_checker_thread = None
-model_checker_thread = None
-redis_refresher_thread = None
+token_refresher_thread = None
+job_worker = None
 
 # 创建表和启动后台任务
 @app.on_event("startup")
@@ -50,75 +68,108 @@ async def startup_event():
         os.environ["https_proxy"] = PROXY_URL
         print(f"已启用全局代理: {PROXY_URL}")
 
-    # 创建数据库表
-    tokens.create_tables()
+    # 创建数据库表（多个 worker 同时启动时可能互相冲突，失败的 worker 忽略即可）
+    try:
+        tokens.create_tables()
+    except Exception as e:
+        print(f"创建数据库表失败: {str(e)}")
+    # 凭据迁移未执行时拒绝启动
+    tokens.check_schema()
     
-    # 初始化Redis缓存
+    # 初始化账号缓存
     try:
-        if test_redis_connection():
+        if ACCOUNT_POOL_BACKEND == "memory":
+            print("已配置内存账号池模式，正在加载账号...")
+        elif test_redis_connection():
             print("Redis连接成功，正在初始化缓存...")
-            db = next(get_db())
-            refresh_accounts_cache(db)
-            db.close()
-            print("Redis缓存初始化完成")
         else:
-            print("Redis连接失败，将使用数据库作为备用")
-    except Exception as e:
-        print(f"Redis初始化失败: {str(e)}")
-    
-    # 启动cookie检查器线程
-    global cookie_checker_thread, model_checker_thread, redis_refresher_thread
-    
-    def run_cookie_checker():
-        # 在应用启动30秒后执行首次检查，确保应用完全初始化
-        time.sleep(30)
-        # 立即执行一次检查
-        check_and_refresh_accounts()
-        # 然后启动定时任务
-        run_cookies_scheduler()
-    
-    # 创建并启动守护线程
-    cookie_checker_thread = threading.Thread(target=run_cookie_checker, daemon=True)
-    cookie_checker_thread.start()
-    print("Cookie检查程序已在后台启动")
-
-    # 启动模型刷新线程
-    def run_model_checker():
-        # 在应用启动60秒后执行首次刷新，确保应用和cookie都已初始化
-        time.sleep(60)
-        # 立即执行一次模型刷新
-        refresh_models()
-        # 然后启动定时任务
-        run_models_scheduler()
-    
-    # 创建并启动模型刷新守护线程
-    model_checker_thread = threading.Thread(target=run_model_checker, daemon=True)
-    model_checker_thread.start()
-    print("模型刷新程序已在后台启动")
-    
-    # 启动Redis缓存刷新线程
-    def run_redis_refresher():
-        # 应用启动后延迟15秒开始刷新，避免和其他任务冲突
-        time.sleep(15)
-        while True:
+            print("Redis连接失败，将使用内存账号池作为备用")
+        # Redis账号缓存由所有 worker 和副本共享，短时间内只需一个进程初始化；内存账号池每个进程各自加载
+        if use_memory_pool() or acquire_task_lock("startup_account_cache", 30):
+            db = next(get_db())
             try:
-                # 每隔60秒刷新一次Redis缓存
-                db = next(get_db())
-                try:
-                    refresh_accounts_cache(db)
-                finally:
-                    # 确保在任何情况下都关闭数据库连接
-                    db.close()
-            except Exception as e:
-                print(f"Redis缓存刷新失败: {str(e)}")
+                refresh_accounts_cache(db)
             finally:
-                # 每隔60秒刷新一次
-                time.sleep(60)
+                db.close()
+        print("账号缓存初始化完成")
+    except Exception as e:
+        print(f"账号缓存初始化失败: {str(e)}")
+
+    # 订阅账号缓存失效通知，保持各副本L1缓存一致
+    start_invalidation_listener()
     
-    # 创建并启动Redis缓存刷新守护线程
-    redis_refresher_thread = threading.Thread(target=run_redis_refresher, daemon=True)
-    redis_refresher_thread.start()
-    print("Redis缓存刷新程序已在后台启动")
+    # 定时任务：集群任务只在调度器主实例上执行，进程任务每个进程各自执行
+    scheduler = start_scheduler(elect=EMBEDDED_SCHEDULER)
+    print("定时任务调度器已在后台启动")
+
+    global token_refresher_thread
+    # 启动凭据主动刷新线程，在 token_expires 到期前刷新，避免请求链路内联刷新；
+    # 与集群任务一样只在调度器主实例上执行，单独部署调度器进程时由其负责
+    if EMBEDDED_SCHEDULER:
+        token_refresher_thread = threading.Thread(target=token_refresher.run, args=(scheduler.is_leader,), daemon=True)
+        token_refresher_thread.start()
+        print("凭据主动刷新程序已在后台启动")
+
+    # 未单独部署 worker 进程（python worker.py）时，在 API 进程内执行批量注册/刷新作业
+    global job_worker
+    if EMBEDDED_JOB_WORKER:
+        job_worker = JobWorker()
+        job_worker.start()
+        print("后台作业 worker 已在 API 进程内启动")
+
+
+def _flush_buffers():
+    """写回缓冲：账号批量写入、使用次数"""
+    try:
+        written = token_collector.drain()
+        if written:
+            print(f"停机前写入 {written} 条账号数据")
+    except Exception as e:
+        print(f"停机时写入账号数据失败: {str(e)}")
+    try:
+        with session_scope() as db:
+            flushed = flush_usage_counts(db)
+        if flushed:
+            print(f"停机前写回 {flushed} 个账号的使用次数")
+    except Exception as e:
+        print(f"停机时写回使用次数失败: {str(e)}")
+
+
+def _drain_background_work():
+    """停止后台任务并写回缓冲的数据（阻塞，所有步骤共用 SHUTDOWN_TIMEOUT_SECONDS 秒的期限）"""
+    deadline = time.time() + SHUTDOWN_TIMEOUT_SECONDS
+
+    def remaining() -> float:
+        return max(0.0, deadline - time.time())
+
+    # 1. 不再产生新的后台工作：作业、主动刷新
+    if job_worker is not None:
+        job_worker.stop()
+    token_refresher.stop()
+
+    # 2. 先写回缓冲，等待后台工作超时被强制终止时也不会丢失已缓冲的数据
+    _flush_buffers()
+
+    # 3. 等待执行中的作业、定时任务和主动刷新结束；超时未结束的作业释放租约交给其他 worker
+    if job_worker is not None:
+        job_worker.drain(remaining())
+    stop_scheduler(remaining())
+    if token_refresher_thread is not None:
+        token_refresher_thread.join(remaining())
+
+    # 4. 写回等待期间新产生的数据，关闭HTTP连接池
+    _flush_buffers()
+    close_session()
+
+
+# 优雅停机：uvicorn 收到 SIGTERM 后先停止接受新连接，等待进行中的请求（包括流式响应）
+# 最多 SHUTDOWN_TIMEOUT_SECONDS 秒，然后执行这里的清理（最多再用 SHUTDOWN_TIMEOUT_SECONDS 秒）
+@app.on_event("shutdown")
+async def shutdown_event():
+    print("开始停机清理...")
+    await ws_pool.close_all()
+    await asyncio.get_running_loop().run_in_executor(None, _drain_background_work)
+    print("停机清理完成")
 
 # 首页
 @app.get("/")
@@ -167,6 +218,22 @@ async def admin_spa_routes(path: str):
     return FileResponse(os.path.join(frontend_dist_path, "index.html"))
 
 # 启动服务器
+# API_WORKERS > 1 时以多进程模式运行：进程间共享的状态（账号池、使用量、任务状态、作业队列、调度器主实例）
+# 都保存在Redis中；进程内只保留缓存和连接（L1账号缓存通过Redis通知失效，上游websocket跟随请求所在进程）
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8055)
+    # 安装了 uvloop/httptools 时使用，否则退回标准实现
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    print(f"启动API服务: {API_HOST}:{API_PORT}, worker {API_WORKERS} 个, loop={loop}, http={http}")
+    uvicorn.run(
+        "main:app",
+        host=API_HOST,
+        port=API_PORT,
+        workers=API_WORKERS,
+        loop=loop,
+        http=http,
+        backlog=API_BACKLOG,
+        timeout_keep_alive=API_KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT_SECONDS,
+    )
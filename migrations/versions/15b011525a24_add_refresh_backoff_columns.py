@@ -0,0 +1,48 @@
+"""add refresh backoff columns
+
+Revision ID: 15b011525a24
+Revises: 9b1d2bf11139
+Create Date: 2026-10-19 14:05:12.331870
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '15b011525a24'
+down_revision: Union[str, None] = '9b1d2bf11139'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+_INDEX = 'ix_tokens_refresh_due'
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    columns = {column['name'] for column in inspector.get_columns('tokens')}
+    # mysql/init.sql 新建的库已包含这些字段和索引
+    if 'refresh_failures' not in columns:
+        op.add_column('tokens', sa.Column('refresh_failures', sa.Integer(), nullable=False, server_default=sa.text('0')))
+    if 'next_refresh_at' not in columns:
+        op.add_column('tokens', sa.Column('next_refresh_at', sa.DateTime(), nullable=True))
+    if _INDEX not in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.create_index(_INDEX, 'tokens', ['enable', 'deleted_at', 'next_refresh_at'])
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    if _INDEX in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.drop_index(_INDEX, table_name='tokens')
+    columns = {column['name'] for column in inspector.get_columns('tokens')}
+    if 'next_refresh_at' in columns:
+        op.drop_column('tokens', 'next_refresh_at')
+    if 'refresh_failures' in columns:
+        op.drop_column('tokens', 'refresh_failures')
@@ -0,0 +1,61 @@
+"""unique live account
+
+Revision ID: 5a04748940a9
+Revises: 15b011525a24
+Create Date: 2026-10-19 16:42:08.117402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a04748940a9'
+down_revision: Union[str, None] = '15b011525a24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+_INDEX = 'ux_tokens_live_account'
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    columns = {column['name'] for column in inspector.get_columns('tokens')}
+    # mysql/init.sql 新建的库已包含该字段和索引
+    if 'live_account' not in columns:
+        # 同一账号存在多条未删除记录时只保留最新的一条，其余软删除
+        op.execute(
+            """
+            UPDATE tokens t
+            JOIN (
+                SELECT account, MAX(id) AS keep_id
+                FROM tokens
+                WHERE deleted_at IS NULL AND account IS NOT NULL
+                GROUP BY account
+                HAVING COUNT(*) > 1
+            ) d ON t.account = d.account
+            SET t.deleted_at = NOW()
+            WHERE t.deleted_at IS NULL AND t.id <> d.keep_id
+            """
+        )
+        op.execute(
+            "ALTER TABLE tokens ADD COLUMN live_account varchar(255) "
+            "GENERATED ALWAYS AS (IF(deleted_at IS NULL, account, NULL)) STORED"
+        )
+    if _INDEX not in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.create_index(_INDEX, 'tokens', ['live_account'], unique=True)
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    if _INDEX in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.drop_index(_INDEX, table_name='tokens')
+    if 'live_account' in {column['name'] for column in inspector.get_columns('tokens')}:
+        op.drop_column('tokens', 'live_account')
@@ -0,0 +1,53 @@
+"""add tokens selection indexes
+
+Revision ID: 71f9606207cc
+Revises: 4e6aadf16da7
+Create Date: 2026-10-19 10:12:40.518204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '71f9606207cc'
+down_revision: Union[str, None] = '4e6aadf16da7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+_INDEXES = [
+    ('ix_tokens_selection', ['enable', 'deleted_at', 'count', sa.text('token_expires DESC')]),
+    ('ix_tokens_paid_selection', ['account_type', 'enable', 'deleted_at', 'count', sa.text('token_expires DESC')]),
+    ('ix_tokens_account', ['account', 'deleted_at']),
+    ('ix_tokens_listing', ['deleted_at', 'updated_at']),
+]
+
+
+def _existing_indexes() -> Union[set, None]:
+    """返回 tokens 表已有的索引名；表不存在时返回 None（由 create_tables 建表时一并创建索引）"""
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return None
+    return {index['name'] for index in inspector.get_indexes('tokens')}
+
+
+def upgrade() -> None:
+    existing = _existing_indexes()
+    if existing is None:
+        return
+    for name, columns in _INDEXES:
+        # mysql/init.sql 新建的库已包含这些索引
+        if name not in existing:
+            op.create_index(name, 'tokens', columns)
+
+
+def downgrade() -> None:
+    existing = _existing_indexes()
+    if existing is None:
+        return
+    for name, _ in reversed(_INDEXES):
+        if name in existing:
+            op.drop_index(name, table_name='tokens')
@@ -0,0 +1,57 @@
+"""move credentials to side table
+
+Revision ID: 9b1d2bf11139
+Revises: 71f9606207cc
+Create Date: 2026-10-19 11:03:27.904516
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b1d2bf11139'
+down_revision: Union[str, None] = '71f9606207cc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        # 新库由 create_tables 建表
+        return
+
+    if not inspector.has_table('token_credentials'):
+        op.create_table(
+            'token_credentials',
+            sa.Column('token_id', sa.Integer(), nullable=False),
+            sa.Column('silent_cookies', sa.Text(), nullable=True),
+            sa.Column('auth', sa.Text().with_variant(mysql.LONGTEXT(), 'mysql'), nullable=True),
+            sa.ForeignKeyConstraint(['token_id'], ['tokens.id'], name='fk_token_credentials_token_id', ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('token_id'),
+        )
+
+    # 旧库：把大字段搬到 token_credentials 后从 tokens 中删除
+    columns = {column['name'] for column in inspector.get_columns('tokens')}
+    if 'silent_cookies' in columns and 'auth' in columns:
+        op.execute(
+            "INSERT INTO token_credentials (token_id, silent_cookies, auth) "
+            "SELECT id, silent_cookies, auth FROM tokens "
+            "WHERE silent_cookies IS NOT NULL OR auth IS NOT NULL"
+        )
+        op.drop_column('tokens', 'silent_cookies')
+        op.drop_column('tokens', 'auth')
+
+
+def downgrade() -> None:
+    op.add_column('tokens', sa.Column('silent_cookies', sa.Text(), nullable=True))
+    op.add_column('tokens', sa.Column('auth', sa.Text().with_variant(mysql.LONGTEXT(), 'mysql'), nullable=True))
+    op.execute(
+        "UPDATE tokens t JOIN token_credentials c ON c.token_id = t.id "
+        "SET t.silent_cookies = c.silent_cookies, t.auth = c.auth"
+    )
+    op.drop_table('token_credentials')
@@ -0,0 +1,38 @@
+"""add cookies due index
+
+Revision ID: c4d7e2a9f013
+Revises: 5a04748940a9
+Create Date: 2026-10-19 18:40:26.204117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d7e2a9f013'
+down_revision: Union[str, None] = '5a04748940a9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+_INDEX = 'ix_tokens_cookies_due'
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    # mysql/init.sql 新建的库已包含该索引
+    if _INDEX not in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.create_index(_INDEX, 'tokens', ['enable', 'deleted_at', 'cookies_expires'])
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('tokens'):
+        return
+    if _INDEX in {index['name'] for index in inspector.get_indexes('tokens')}:
+        op.drop_index(_INDEX, table_name='tokens')
@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, SmallInteger, func
-from sqlalchemy.orm import Session
+from sqlalchemy import Column, Integer, String, DateTime, Text, SmallInteger, Index, ForeignKey, Computed, case, func, inspect, text
+from sqlalchemy.dialects.mysql import LONGTEXT, insert as mysql_insert
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import Session, relationship, selectinload
 from datetime import datetime, timedelta
 from db import Base, engine
 import json
-from typing import Optional
+from typing import Dict, List, Optional
 
 class Token(Base):
     __tablename__ = "tokens"
@@ -11,9 +13,7 @@ class Token(Base):
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     account = Column(String(255), nullable=True, default=None)
     token = Column(Text, nullable=True, default=None)
-    silent_cookies = Column(Text, nullable=True, default=None)
     cookies_expires = Column(DateTime, nullable=True, default=None)
-    auth = Column(Text, nullable=True, default=None)
     access_token = Column(Text, nullable=True, default=None)
     token_expires = Column(DateTime, nullable=True, default=None)
     created_at = Column(DateTime, nullable=True, default=None)
@@ -22,6 +22,56 @@ class Token(Base):
     deleted_at = Column(DateTime, nullable=True, default=None)
     count = Column(Integer, nullable=True, default=None)
     account_type = Column(String(50), nullable=True, default=None)
+    refresh_failures = Column(Integer, nullable=False, default=0, server_default=text("0"))  # 连续刷新失败次数
+    next_refresh_at = Column(DateTime, nullable=True, default=None)  # 禁用账号的下次重试时间
+    # 未删除账号的 account（已删除为 NULL），用于保证未删除账号唯一，批量写入时据此 upsert
+    live_account = Column(String(255), Computed("IF(deleted_at IS NULL, account, NULL)", persisted=True))
+
+    __table_args__ = (
+        # 账号选择：enable=1 AND deleted_at IS NULL ORDER BY count, token_expires DESC
+        Index("ix_tokens_selection", "enable", "deleted_at", "count", text("token_expires DESC")),
+        # 付费账号选择：额外按 account_type 过滤
+        Index("ix_tokens_paid_selection", "account_type", "enable", "deleted_at", "count", text("token_expires DESC")),
+        # 按账号查找
+        Index("ix_tokens_account", "account", "deleted_at"),
+        # 后台列表：deleted_at IS NULL，按更新时间排序
+        Index("ix_tokens_listing", "deleted_at", "updated_at"),
+        # 到期刷新：禁用账号按下次重试时间查找
+        Index("ix_tokens_refresh_due", "enable", "deleted_at", "next_refresh_at"),
+        # 到期刷新：启用账号按cookies过期时间查找
+        Index("ix_tokens_cookies_due", "enable", "deleted_at", "cookies_expires"),
+        # 未删除的账号不允许重复
+        Index("ux_tokens_live_account", "live_account", unique=True),
+    )
+
+    # 体积较大的凭据（silent_cookies、auth）存放在 token_credentials 表中，
+    # 只有访问这两个属性时才会加载，账号选择等热点查询不再读取这些大字段。
+    # token、access_token 留在 tokens 表：选中账号后每次请求都要用到（token_to_dict、内存账号池），
+    # 排序和过滤在 ix_tokens_selection 索引上完成，只回表读取最终返回的行，移走反而让每次使用多一次关联查询
+    credentials = relationship(
+        "TokenCredential",
+        uselist=False,
+        lazy="select",
+        cascade="all, delete-orphan",
+        back_populates="owner",
+    )
+    silent_cookies = association_proxy(
+        "credentials", "silent_cookies",
+        creator=lambda value: TokenCredential(silent_cookies=value)
+    )
+    auth = association_proxy(
+        "credentials", "auth",
+        creator=lambda value: TokenCredential(auth=value)
+    )
+
+class TokenCredential(Base):
+    __tablename__ = "token_credentials"
+
+    token_id = Column(Integer, ForeignKey("tokens.id", ondelete="CASCADE"), primary_key=True)
+    silent_cookies = Column(Text, nullable=True, default=None)
+    auth = Column(Text().with_variant(LONGTEXT, "mysql"), nullable=True, default=None)
+
+    owner = relationship("Token", back_populates="credentials")
 
 # CRUD操作
 def create_token(db: Session, token_data: dict):
@@ -50,6 +100,8 @@ def create_token(db: Session, token_data: dict):
         # 若获得新的 token，则启用账号
         if token_data.get('token'):
             existing_token.enable = 1
+            existing_token.refresh_failures = 0
+            existing_token.next_refresh_at = None
 
         existing_token.updated_at = now
         db.commit()
@@ -101,6 +153,155 @@ def create_token(db: Session, token_data: dict):
     db.refresh(db_token)
     return db_token
 
+def _credential_values(data: dict) -> Optional[dict]:
+    """账号数据中的凭据字段（silent_cookies、auth），都为空时返回None"""
+    cookies = data.get('cookies')
+    silent_cookies = json.dumps(cookies) if cookies else None
+    auth = data.get('auth')
+    if auth is not None and not isinstance(auth, str):
+        auth = json.dumps(auth, ensure_ascii=False)
+    if not silent_cookies and not auth:
+        return None
+    return {'silent_cookies': silent_cookies, 'auth': auth}
+
+def _upsert_credentials(db: Session, credential_rows: List[dict]):
+    if not credential_rows:
+        return
+    cred_table = TokenCredential.__table__
+    cred_stmt = mysql_insert(cred_table).values(credential_rows)
+    cred_stmt = cred_stmt.on_duplicate_key_update(
+        silent_cookies=func.coalesce(cred_stmt.inserted.silent_cookies, cred_table.c.silent_cookies),
+        auth=func.coalesce(cred_stmt.inserted.auth, cred_table.c.auth),
+    )
+    db.execute(cred_stmt)
+
+def _update_tokens_by_id(db: Session, token_rows: List[dict]) -> Dict[int, bool]:
+    """
+    按ID更新没有 account 的账号（旧接口创建的账号 account 可能为空），语义与 upsert_tokens 的更新分支一致
+
+    Returns:
+        账号ID -> 是否更新成功（账号不存在或已删除时为False）
+    """
+    now = datetime.now()
+    table = Token.__table__
+    updated, credential_rows = {}, []
+    for data in token_rows:
+        token_id = data['id']
+        # 只更新传入的非空字段
+        values = {'updated_at': now}
+        fields = {
+            'token': data.get('token'),
+            'access_token': data.get('access_token'),
+            'account_type': data.get('account_type'),
+            'token_expires': data.get('token_expires'),
+            'cookies_expires': now + timedelta(days=30) if data.get('cookies') else None,
+        }
+        for field, value in fields.items():
+            if value is not None:
+                values[field] = value
+        if data.get('enable') == 1:
+            values.update(enable=1, refresh_failures=0, next_refresh_at=None)
+        result = db.execute(
+            table.update()
+            .where(table.c.id == token_id, table.c.deleted_at == None)
+            .values(**values)
+        )
+        updated[token_id] = result.rowcount > 0
+        credentials = _credential_values(data)
+        if updated[token_id] and credentials:
+            credential_rows.append(dict(token_id=token_id, **credentials))
+    _upsert_credentials(db, credential_rows)
+    return updated
+
+def upsert_tokens(db: Session, token_rows: List[dict]) -> List[Optional[int]]:
+    """
+    批量插入或更新账号（INSERT ... ON DUPLICATE KEY UPDATE），语义与 create_token 的新格式一致：
+    - 新账号：cookies_expires 为 30 天后，有 token 时启用
+    - 已有账号：只更新传入的非空字段；enable 为 1 时启用账号并清除刷新失败记录
+    没有 account 但带 id 的数据（刷新旧接口创建的账号）按ID直接更新
+
+    Args:
+        db: 数据库会话
+        token_rows: 账号数据列表，支持 account、id（二者至少一个）、cookies、access_token、token、auth、
+                    account_type、token_expires、enable 字段
+
+    Returns:
+        与 token_rows 一一对应的账号ID，未写入的数据为None
+    """
+    now = datetime.now()
+    rows, credentials, by_id = [], {}, []
+    for data in token_rows:
+        account = data.get('account')
+        if not account:
+            if data.get('id'):
+                by_id.append(data)
+            continue
+        enable = data.get('enable')
+        if enable is None:
+            enable = 1 if data.get('token') else 0
+        rows.append({
+            'account': account,
+            'token': data.get('token'),
+            'access_token': data.get('access_token'),
+            'account_type': data.get('account_type'),
+            'cookies_expires': now + timedelta(days=30) if data.get('cookies') else None,
+            'token_expires': data.get('token_expires'),
+            'enable': enable,
+            'count': 0,
+            'created_at': now,
+            'updated_at': now,
+        })
+        values = _credential_values(data)
+        if values:
+            credentials[account] = values
+
+    ids: Dict[str, int] = {}
+    if rows:
+        table = Token.__table__
+        stmt = mysql_insert(table).values(rows)
+        inserted = stmt.inserted
+        # MySQL 按从左到右的顺序赋值，先赋值的列在后面的表达式中已是新值；
+        # refresh_failures/next_refresh_at 读取的是 inserted.enable（本次传入的值）而不是 enable 列，
+        # 所以 enable 放在最后赋值也不受影响
+        stmt = stmt.on_duplicate_key_update(
+            token=func.coalesce(inserted.token, table.c.token),
+            access_token=func.coalesce(inserted.access_token, table.c.access_token),
+            account_type=func.coalesce(inserted.account_type, table.c.account_type),
+            cookies_expires=func.coalesce(inserted.cookies_expires, table.c.cookies_expires),
+            token_expires=func.coalesce(inserted.token_expires, table.c.token_expires),
+            refresh_failures=case((inserted.enable == 1, 0), else_=table.c.refresh_failures),
+            next_refresh_at=case((inserted.enable == 1, None), else_=table.c.next_refresh_at),
+            enable=case((inserted.enable == 1, 1), else_=table.c.enable),
+            updated_at=inserted.updated_at,
+        )
+        db.execute(stmt)
+
+        accounts = [row['account'] for row in rows]
+        # account 列的排序规则不区分大小写，按小写对应回传入的账号
+        found = {
+            row.account.lower(): row.id
+            for row in db.query(Token.id, Token.account).filter(Token.live_account.in_(accounts))
+        }
+        ids = {account: found[account.lower()] for account in accounts if account.lower() in found}
+
+        _upsert_credentials(db, [
+            dict(token_id=ids[account], **values)
+            for account, values in credentials.items() if account in ids
+        ])
+
+    updated = _update_tokens_by_id(db, by_id) if by_id else {}
+
+    db.commit()
+    results: List[Optional[int]] = []
+    for data in token_rows:
+        if data.get('account'):
+            results.append(ids.get(data['account']))
+        elif data.get('id') and updated.get(data['id']):
+            results.append(data['id'])
+        else:
+            results.append(None)
+    return results
+
 def get_token(db: Session, token_id: int):
     """根据ID获取token"""
     return db.query(Token).filter(Token.id == token_id, Token.deleted_at == None).first()
@@ -111,14 +312,15 @@ def get_token_by_account(db: Session, account: str):
 
 def get_tokens(db: Session, skip: int = 0, limit: int = 100, sort_by: str = None, sort_desc: bool = False, account: Optional[str] = None):
     """获取所有未删除的token列表，支持账号模糊搜索"""
-    query = db.query(Token).filter(Token.deleted_at == None)
+    # 列表需要展示凭据字段，一次性加载避免逐行查询
+    query = db.query(Token).options(selectinload(Token.credentials)).filter(Token.deleted_at == None)
     
     # 添加账号模糊搜索条件
     if account:
         query = query.filter(Token.account.like(f'%{account}%'))
     
     # Add sorting if sort_by is specified and it's a valid column
-    if sort_by and hasattr(Token, sort_by):
+    if sort_by and sort_by in Token.__table__.columns:
         column = getattr(Token, sort_by)
         if sort_desc:
             query = query.order_by(column.desc())
@@ -148,6 +350,11 @@ def update_token(db: Session, token_id: int, token_data: dict):
         if hasattr(db_token, key):
             setattr(db_token, key, value)
     
+    # 手动启用账号时清除刷新失败记录
+    if token_data.get('enable') == 1:
+        db_token.refresh_failures = 0
+        db_token.next_refresh_at = None
+    
     db_token.updated_at = datetime.now()
     db.commit()
     db.refresh(db_token)
@@ -187,3 +394,25 @@ def get_available_tokens(db: Session, skip: int = 0, limit: int = 100):
 # 创建表
 def create_tables():
     Base.metadata.create_all(bind=engine)
+
+# 迁移前 tokens 表中存放凭据的字段（alembic 9b1d2bf11139 将其移到 token_credentials）
+_LEGACY_CREDENTIAL_COLUMNS = {"silent_cookies", "auth"}
+
+def check_schema():
+    """
+    启动检查：tokens 表仍有 silent_cookies/auth 字段说明凭据迁移尚未执行，
+    此时 create_tables 建出的 token_credentials 是空表，所有账号的凭据都会读成空值。
+    这种情况直接报错退出，而不是带着空凭据运行
+
+    Raises:
+        RuntimeError: 凭据迁移尚未执行
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("tokens"):
+        return
+    legacy = _LEGACY_CREDENTIAL_COLUMNS & {column["name"] for column in inspector.get_columns("tokens")}
+    if legacy:
+        raise RuntimeError(
+            f"tokens 表仍包含 {', '.join(sorted(legacy))} 字段，账号凭据尚未迁移到 token_credentials，"
+            f"请先执行 alembic upgrade head"
+        )
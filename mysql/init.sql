@@ -14,7 +14,6 @@ CREATE TABLE `tokens`  (
   `account` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL DEFAULT NULL,
   `account_type` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL DEFAULT NULL,
   `token` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
-  `silent_cookies` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
   `cookies_expires` datetime NULL DEFAULT NULL,
   `access_token` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
   `token_expires` datetime NULL DEFAULT NULL,
@@ -23,8 +22,30 @@ CREATE TABLE `tokens`  (
   `enable` smallint NULL DEFAULT NULL,
   `deleted_at` datetime NULL DEFAULT NULL,
   `count` int NULL DEFAULT NULL,
-  `auth` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
-  PRIMARY KEY (`id`) USING BTREE
+  `refresh_failures` int NOT NULL DEFAULT 0,
+  `next_refresh_at` datetime NULL DEFAULT NULL,
+  `live_account` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci GENERATED ALWAYS AS (if(`deleted_at` is null, `account`, NULL)) STORED NULL,
+  PRIMARY KEY (`id`) USING BTREE,
+  UNIQUE INDEX `ux_tokens_live_account`(`live_account`) USING BTREE,
+  INDEX `ix_tokens_selection`(`enable`, `deleted_at`, `count`, `token_expires` DESC) USING BTREE,
+  INDEX `ix_tokens_paid_selection`(`account_type`, `enable`, `deleted_at`, `count`, `token_expires` DESC) USING BTREE,
+  INDEX `ix_tokens_account`(`account`, `deleted_at`) USING BTREE,
+  INDEX `ix_tokens_listing`(`deleted_at`, `updated_at`) USING BTREE,
+  INDEX `ix_tokens_refresh_due`(`enable`, `deleted_at`, `next_refresh_at`) USING BTREE,
+  INDEX `ix_tokens_cookies_due`(`enable`, `deleted_at`, `cookies_expires`) USING BTREE
 ) ENGINE = InnoDB AUTO_INCREMENT = 198 CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci ROW_FORMAT = Dynamic;
 
+-- ----------------------------
+-- Table structure for token_credentials
+-- 体积较大的凭据字段，与 tokens 一对一
+-- ----------------------------
+DROP TABLE IF EXISTS `token_credentials`;
+CREATE TABLE `token_credentials`  (
+  `token_id` int NOT NULL,
+  `silent_cookies` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
+  `auth` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NULL,
+  PRIMARY KEY (`token_id`) USING BTREE,
+  CONSTRAINT `fk_token_credentials_token_id` FOREIGN KEY (`token_id`) REFERENCES `tokens` (`id`) ON DELETE CASCADE
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci ROW_FORMAT = Dynamic;
+
 SET FOREIGN_KEY_CHECKS = 1;
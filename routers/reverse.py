@@ -11,8 +11,10 @@ import os
 import shutil
 import tiktoken
 from starlette.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 
-from db import get_db
+from db import get_db, session_scope
 from models.tokens import Token, increment_count
 from utils.register import refresh_silent_cookies
 from datetime import datetime, timedelta
@@ -21,11 +23,15 @@ from utils.auth import verify_admin
 from env import FILE_DOMAIN
 import requests
 # 导入账号管理器模块
-from utils.account_manager import pick_account, pick_paid_account, release_account
-from utils.ws_pool import get_ws, get_msg_queue, remove_msg_queue
+from utils.account_manager import pick_account, pick_paid_account, pick_affinity_account, release_account
+from utils.local_cache import CachedAccount, invalidate_account
+from utils.refresh_guard import run_refresh_async
+from utils.admission import get_admission_controller, INTERACTIVE, BATCH
+from utils.conversation_cache import normalize_messages, claim_conversation, remember_conversation
+from utils.response_cache import cache_policy, request_fingerprint, response_cache_key, get_cached_response, store_response
+from utils.single_flight import Subscription, coalescing_enabled, join_flight, start_flight
 
-# 本地 ws_pool 字典已移至 utils.ws_pool 管理，这里删除旧定义
-# ws_pool={} # sid-ws (已废弃)
+# 每个请求自行建立并消费上游websocket（连接无法跨进程共享），不再使用 utils.ws_pool 中的进程内连接池
 router = APIRouter(prefix="", tags=["reverse"])
 
 CHAT_WS_URL = "wss://app.chatbetter.com/ws/socket.io/?EIO=4&transport=websocket"
@@ -195,6 +201,50 @@ def convert_reasoning_details(content: str) -> str:
 
     return content
 
+# 构造非流式响应
+def build_completion_response(model: str, content: str, usage: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    complete_response = {
+        "id": f"chatcmpl-{str(uuid.uuid4())}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": content
+                },
+                "finish_reason": "stop"
+            }
+        ]
+    }
+
+    # 如果有usage数据，添加到响应中
+    if usage:
+        complete_response["usage"] = usage
+
+    return complete_response
+
+# 以SSE回放完整响应（响应缓存命中时使用），事件格式与实时的流式响应一致
+async def replay_completion_stream(model: str, content: str, usage: Optional[Dict[str, Any]] = None):
+    base = {
+        "id": "chatcmpl-dummy",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+    }
+    start_chunk = dict(base, choices=[{"delta": {"content": "", "role": "assistant"}, "logprobs": None, "finish_reason": None, "index": 0}], usage=None)
+    yield f"data: {json.dumps(start_chunk,separators=(',', ':'))}\n\n"
+    content_chunk = dict(base, choices=[{"delta": {"content": content}, "logprobs": None, "finish_reason": None, "index": 0}], usage=None)
+    yield f"data: {json.dumps(content_chunk)}\n\n"
+    if usage:
+        usage_chunk = dict(base, choices=[{"delta": {}, "index": 0}], usage=usage)
+        yield f"data: {json.dumps(usage_chunk,separators=(',', ':'))}\n\n"
+    end_chunk = dict(base, choices=[{"delta": {}, "logprobs": None, "finish_reason": "stop", "index": 0}], usage=None)
+    yield f"data: {json.dumps(end_chunk,separators=(',', ':'))}\n\n"
+    yield "data: [DONE]\n\n"
+
 @router.get("/v1/models")
 async def get_models(_: bool = Depends(verify_admin)):
     """返回支持的模型列表"""
@@ -207,7 +257,7 @@ async def get_models(_: bool = Depends(verify_admin)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to load models: {str(e)}")
 
-async def ensure_socket_connection(account: Token) -> Optional["AsyncWebSocket"]:
+async def ensure_socket_connection(account: CachedAccount) -> Optional["AsyncWebSocket"]:
     start_time = time.time()
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
@@ -230,26 +280,40 @@ async def ensure_socket_connection(account: Token) -> Optional["AsyncWebSocket"]
         print(f"WebSocket connection failed after {duration:.2f}s: {e}")
         return None
 
-async def refresh_account_cookies(db: Session, account: Token) -> bool:
-    cookies_dict = json.loads(account.silent_cookies or "{}")
-    # 使用线程池执行阻塞的同步 HTTP 请求，避免阻塞事件循环
-    loop = asyncio.get_running_loop()
-    success, new_cookies, new_access_token = await loop.run_in_executor(
-        None, refresh_silent_cookies, cookies_dict
-    )
-    if not success:
-        account.enable = 0
+def _refresh_account_cookies_sync(account_id: int) -> bool:
+    """刷新账号的 silent cookies（在线程池中执行，使用独立的数据库会话）"""
+    with session_scope() as db:
+        # 缓存的账号记录不包含 silent_cookies，刷新时回表读取完整记录
+        db_account = db.query(Token).filter(Token.id == account_id).first()
+        if not db_account:
+            return False
+        cookies_dict = json.loads(db_account.silent_cookies or "{}")
+        success, new_cookies, new_access_token = refresh_silent_cookies(cookies_dict)
+        if not success:
+            db_account.enable = 0
+            db.commit()
+            invalidate_account(account_id)
+            return False
+        db_account.silent_cookies = json.dumps(new_cookies)
+        db_account.access_token = new_access_token
+        db_account.cookies_expires = datetime.now() + timedelta(days=30)
+        # 刷新成功后，将 token_expires 置为 15 分钟后，避免短时间内重复刷新
+        db_account.token_expires = datetime.now() + timedelta(minutes=15)
         db.commit()
-        return False
-    account.silent_cookies = json.dumps(new_cookies)
-    account.access_token = new_access_token
-    account.cookies_expires = datetime.now() + timedelta(days=30)
-    # 刷新成功后，将 token_expires 置为 15 分钟后，避免短时间内重复刷新
-    account.token_expires = datetime.now() + timedelta(minutes=15)
-    db.commit()
-    return True
-
-async def get_authed_socket(account: Token) -> Optional["AsyncWebSocket"]:
+        invalidate_account(account_id)
+        return True
+
+async def refresh_account_cookies(db: Session, account: CachedAccount) -> bool:
+    # 同一账号的并发刷新只会真正执行一次，其余请求等待并共享结果
+    success = await run_refresh_async(account.id, _refresh_account_cookies_sync)
+    if success:
+        # 读取刷新后的 access_token（可能由其他请求或其他副本刷新）
+        row = db.query(Token.access_token).filter(Token.id == account.id).first()
+        if row:
+            account.access_token = row.access_token
+    return success
+
+async def get_authed_socket(account: CachedAccount) -> Optional["AsyncWebSocket"]:
     """建立并认证一个websocket连接"""
     ws = await ensure_socket_connection(account)
     if ws:
@@ -294,11 +358,8 @@ def is_image_output_model(model_name: str) -> bool:
         return False
 
 @router.post("/v1/chat/completions")
-async def chat_completions(request: Request, db: Session = Depends(get_db), _: bool = Depends(verify_admin)):
+async def chat_completions(request: Request, _: bool = Depends(verify_admin)):
     time1=int(time.time()*1000)
-    time2: int
-    time3: int
-    time4: int
     body = await request.json()
     messages: List[Dict[str, Any]] = body.get("messages", [])
     model = body.get("model", "gpt-5")
@@ -307,6 +368,78 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
 
     if not messages:
         raise HTTPException(status_code=400, detail="messages required")
+
+    # 会话缓存和响应缓存按原始消息计算，需要在下面改写 messages 之前取快照
+    normalized_messages = normalize_messages(messages)
+
+    # 响应缓存（默认关闭）：完全相同的请求直接返回缓存结果，不占用准入名额和账号
+    cache_lookup, cache_store = cache_policy(request.headers.get("cache-control"))
+    cache_key = response_cache_key(body, normalized_messages, model) if cache_lookup or cache_store else None
+    cache_headers = {"X-Cache": "MISS" if cache_lookup else "BYPASS"} if cache_key else None
+    if cache_lookup:
+        cached = get_cached_response(cache_key)
+        if cached:
+            if stream:
+                return StreamingResponse(
+                    replay_completion_stream(model, cached["content"], cached.get("usage")),
+                    media_type="text/event-stream",
+                    headers={"X-Cache": "HIT"},
+                )
+            return JSONResponse(
+                content=build_completion_response(model, cached["content"], cached.get("usage")),
+                headers={"X-Cache": "HIT"},
+            )
+
+    # 相同请求的并发合并（默认关闭）：相同的请求正在生成时直接挂到这次生成上，不占用准入名额和账号
+    subscription = None
+    if coalescing_enabled(request.headers.get("x-coalesce")):
+        flight_key = f"{'stream' if stream else 'json'}:{request_fingerprint(body, normalized_messages, model)}"
+        subscription = join_flight(flight_key)
+        if subscription:
+            try:
+                await subscription.flight.wait_started()
+            except BaseException:
+                subscription.release()
+                raise
+            flight_headers = dict(cache_headers or {}, **{"X-Coalesced": "true"})
+            if stream:
+                # 客户端在开始读取前断开时 stream() 的 finally 不会执行，由后台任务兜底释放订阅
+                return StreamingResponse(
+                    subscription.stream(),
+                    media_type="text/event-stream",
+                    headers=flight_headers,
+                    background=BackgroundTask(subscription.release),
+                )
+            return JSONResponse(content=await subscription.result(), headers=flight_headers)
+        subscription = start_flight(flight_key)
+
+    try:
+        return await generate_completion(
+            messages, model, stream, normalized_messages,
+            cache_key, cache_store, cache_headers, subscription, time1,
+        )
+    except BaseException as e:
+        # 上游建立之前失败时，挂在这次生成上的请求一起失败
+        if subscription:
+            subscription.flight.fail(e)
+            subscription.release()
+        raise
+
+async def generate_completion(
+    messages: List[Dict[str, Any]],
+    model: str,
+    stream: bool,
+    normalized_messages: List[Dict[str, Any]],
+    cache_key: Optional[str],
+    cache_store: bool,
+    cache_headers: Optional[Dict[str, str]],
+    subscription: Optional[Subscription],
+    time1: int,
+):
+    """挑选账号、建立上游对话并返回流式或非流式响应"""
+    time2: int
+    time3: int
+    time4: int
     last_message = messages[-1]
 
     # 计算所有消息的token数量
@@ -340,18 +473,149 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
     
     # 计算token并选择适当的账号
     token_count = count_message_tokens(messages)
-    
+
+    # 准入控制：流式请求优先；超出并发预算时排队，队列已满或排队超时立即返回 429/503（带 Retry-After）
+    admission = get_admission_controller()
+    permit = await admission.acquire("paid" if token_count > 8192 else "free", INTERACTIVE if stream else BATCH)
+
     # 如果token数大于8192，使用付费账号，否则使用普通账号
-    if token_count > 8192:
-        account = await pick_paid_account(db)
-    else:
-        account = await pick_account(db)
+    # 使用短生命周期会话，挑选完成后立即归还连接，流式响应期间不占用连接池
+    try:
+        with session_scope() as db:
+            # 会话亲和：历史消息与上一轮完全一致时，继续上一轮所在账号上的上游对话
+            account = None
+            conversation = claim_conversation(normalized_messages[:-1], model) if len(messages) > 1 else None
+            if conversation:
+                account = pick_affinity_account(db, conversation["account_id"], is_paid=token_count > 8192)
+                if account is None:
+                    conversation = None
+            if account is None:
+                if token_count > 8192:
+                    account = await pick_paid_account(db)
+                else:
+                    account = await pick_account(db)
+    except HTTPException as e:
+        permit.release()
+        if e.status_code == 503 and not e.headers:
+            e.headers = {"Retry-After": str(admission.retry_after())}
+        raise
+    except BaseException:
+        permit.release()
+        raise
     
     ws = None
     new_data = None
+    # 会话亲和成功时，本轮消息已在重试循环中patch到上一轮的上游对话
+    patched = False
     attempts = 0
     try:
+        # 处理最后一条消息（即当前用户提问）的 content 与 files
+        last_content = last_message.get("content", "")
+        if "files" not in last_message:
+            last_message["files"] = []
+        if isinstance(last_content, list):
+            text_parts: List[str] = []
+            for item in last_content:
+                if not isinstance(item, dict):
+                    continue
+                typ = item.get("type")
+                if typ == "image_url":
+                    image_url = item.get("image_url", {}).get("url") or item.get("url")
+                    if image_url:
+                        last_message["files"].append({"type": "image", "url": image_url})
+                elif typ == "text":
+                    text_parts.append(item.get("text", ""))
+            last_message["content"] = "\n".join(text_parts)
+
+        # 检查模型是否支持图像输出
+        output_type = "image-generation" if is_image_output_model(model) else "quick_answer"
+
+        # 构造patch数据：在 parent_id 之后追加本轮用户消息和待生成的回复，返回 (patch数据, 回复消息ID)
+        def build_patch_payload(parent_id: str, sid: str):
+            uuid1 = str(uuid.uuid4())
+            uuid2 = str(uuid.uuid4())
+            patch_payload = {
+                "generate_tags": False,
+                "generate_title": False,
+                "currentId": uuid1,
+                "messages": [
+                    {
+                        "id": uuid2,
+                        "parentId": parent_id,
+                        "childrenIds": [uuid1],
+                        "role": "user",
+                        "content": last_message["content"],
+                        "files": last_message.get("files", []),
+                        "timestamp": int(time.time()),
+                        "models": [model],
+                        "outputType": output_type
+                    },
+                    {
+                        "parentId": uuid2,
+                        "id": uuid1,
+                        "childrenIds": [],
+                        "role": "assistant",
+                        "content": "",
+                        "model": model,
+                        "modelName": model,
+                        "modelIdx": 0,
+                        "timestamp": int(time.time())
+                    }
+                ],
+                "session_id": sid,
+                "stream": True,
+                "tool_servers": [],
+                "features": {
+                    "image_generation": is_image_output_model(model),
+                    "code_interpreter": False,
+                    "web_search": False
+                },
+                "params": {},
+                "variables": {}
+            }
+            return patch_payload, uuid1
+
+        # 发送patch，返回是否成功
+        async def send_patch(chat_id: str, patch_payload: Dict[str, Any], headers: Dict[str, str]) -> bool:
+            async with aiohttp.ClientSession() as client:
+                patch_resp = await client.patch(
+                    f"https://app.chatbetter.com/api/v1/chats/{chat_id}",
+                    json=patch_payload, 
+                    headers=headers,
+                    timeout=60.0  # 增加超时时间到60秒
+                )
+            return patch_resp.status == 200 or patch_resp.status == 201
+
         while attempts < 5:
+            headers = {
+                "Authorization": f"Bearer {account.token}",
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
+                "Cookie": f"token={account.token}; ChatBetterJwt={account.access_token}",
+                "Content-Type": "application/json"
+            }
+
+            if conversation:
+                # 会话亲和：直接在上一轮的上游对话上追加本轮，无需新建对话和上传整段历史
+                time2=int(time.time()*1000)
+                try:
+                    ws = await get_authed_socket(account)
+                    if ws:
+                        patch_payload, assistant_id = build_patch_payload(conversation["current_id"], ws.sid)
+                        patched = await send_patch(conversation["chat_id"], patch_payload, headers)
+                except Exception as e:
+                    print(f"继续上游对话失败: {str(e)}")
+                time3=int(time.time()*1000)
+                if patched:
+                    chat_id = conversation["chat_id"]
+                    break
+                # 上游对话已不存在或无法连接：回退为新建对话，不计入重试次数
+                print(f"{account.account}----上游对话 {conversation['chat_id']} 无法继续，新建对话")
+                if ws:
+                    await ws.close()
+                    ws = None
+                conversation = None
+                continue
+
             # 构造 /api/v1/chats/new 请求
             adapt_messages = {}
             last_id = None
@@ -453,13 +717,6 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                     "timestamp": int(time.time()*1000)
                 }
             }
-            headers = {
-                "Authorization": f"Bearer {account.token}",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
-                "Cookie": f"token={account.token}; ChatBetterJwt={account.access_token}",
-                "Content-Type": "application/json"
-            }
-
             time2=int(time.time()*1000)
 
             async with aiohttp.ClientSession() as client:
@@ -498,90 +755,31 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                 await ws_or_exc.close()
             
             # 尝试刷新cookies，如果失败则更换账号
-            if not await refresh_account_cookies(db, account):
-                # 在更换账号前释放当前账号
-                release_account(account.id)
-                if token_count > 8192:
-                    account = await pick_paid_account(db)
-                else:
-                    account = await pick_account(db)
+            with session_scope() as db:
+                if not await refresh_account_cookies(db, account):
+                    # 在更换账号前释放当前账号
+                    release_account(account.id)
+                    if token_count > 8192:
+                        account = await pick_paid_account(db)
+                    else:
+                        account = await pick_account(db)
             
             attempts += 1
         
-        if not ws or not new_data:
+        if not ws or not (patched or new_data):
             release_account(account.id)
-            raise HTTPException(status_code=503, detail="Unable to establish connection and create chat after several retries")
+            raise HTTPException(
+                status_code=503,
+                detail="Unable to establish connection and create chat after several retries",
+                headers={"Retry-After": str(admission.retry_after())},
+            )
 
         account = ws.account
         sid = ws.sid
-        chat_id = new_data["id"]
-        # Get the dedicated message queue associated with this chat
-        queue = get_msg_queue(chat_id)
-        current_id = new_data["chat"]["history"]["currentId"]
-
-        # 处理最后一条消息（即当前用户提问）的 content 与 files
-        last_content = last_message.get("content", "")
-        if "files" not in last_message:
-            last_message["files"] = []
-        if isinstance(last_content, list):
-            text_parts: List[str] = []
-            for item in last_content:
-                if not isinstance(item, dict):
-                    continue
-                typ = item.get("type")
-                if typ == "image_url":
-                    image_url = item.get("image_url", {}).get("url") or item.get("url")
-                    if image_url:
-                        last_message["files"].append({"type": "image", "url": image_url})
-                elif typ == "text":
-                    text_parts.append(item.get("text", ""))
-            last_message["content"] = "\n".join(text_parts)
-
-        # 检查模型是否支持图像输出
-        output_type = "image-generation" if is_image_output_model(model) else "quick_answer"
-
-        # 构造patch数据
-        uuid1 = str(uuid.uuid4())
-        uuid2 = str(uuid.uuid4())
-        patch_payload = {
-            "generate_tags": False,
-            "generate_title": False,
-            "currentId": uuid1,
-            "messages": [
-                {
-                    "id": uuid2,
-                    "parentId": current_id,
-                    "childrenIds": [uuid1],
-                    "role": "user",
-                    "content": last_message["content"],
-                    "files": last_message.get("files", []),
-                    "timestamp": int(time.time()),
-                    "models": [model],
-                    "outputType": output_type
-                },
-                {
-                    "parentId": uuid2,
-                    "id": uuid1,
-                    "childrenIds": [],
-                    "role": "assistant",
-                    "content": "",
-                    "model": model,
-                    "modelName": model,
-                    "modelIdx": 0,
-                    "timestamp": int(time.time())
-                }
-            ],
-            "session_id": sid,
-            "stream": True,
-            "tool_servers": [],
-            "features": {
-                "image_generation": is_image_output_model(model),
-                "code_interpreter": False,
-                "web_search": False
-            },
-            "params": {},
-            "variables": {}
-        }
+        if not patched:
+            chat_id = new_data["id"]
+            current_id = new_data["chat"]["history"]["currentId"]
+            patch_payload, assistant_id = build_patch_payload(current_id, sid)
 
         time4=int(time.time()*1000)
         print(f"-------------\n"
@@ -591,24 +789,15 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
               f"ws到patch之前 {time4-time2}\n"
               f"进入到patch之前 {time4-time1}")
 
-        # 发送patch
-        async with aiohttp.ClientSession() as client:
-            patch_resp = await client.patch(
-                f"https://app.chatbetter.com/api/v1/chats/{chat_id}",
-                json=patch_payload, 
-                headers=headers,
-                timeout=60.0  # 增加超时时间到60秒
-            )
-        if patch_resp.status != 200 and patch_resp.status != 201:
+        # 发送patch（会话亲和时已经发送过）
+        if not patched and not await send_patch(chat_id, patch_payload, headers):
             await ws.close()
             raise HTTPException(status_code=502, detail="Patch chat failed")
 
-        # 准备StreamingResponse
-        from fastapi.responses import StreamingResponse, JSONResponse
-
         async def stream_generator():
             # 记录已经发送给客户端的完整内容，用于计算增量
             last_sent_content = ""  # 已发送的完整内容
+            last_usage = {}  # 最近一次收到的usage，写入响应缓存
             processed_image_ids = set()  # 已处理过的图片ID集合
             try:
                 start_chunk = {
@@ -675,6 +864,10 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                                     delta_content = full_content[common_prefix_len:]
                                     last_sent_content = full_content
                                     if finish:
+                                        # 记录本轮对话，客户端带着这次的回复继续提问时复用同一个上游对话
+                                        remember_conversation(normalized_messages, last_sent_content, model, account.id, chat_id, assistant_id)
+                                        if cache_store:
+                                            store_response(cache_key, last_sent_content, chunk.get("usage") or last_usage)
                                         # 发送结束 chunk
                                         end_chunk = {
                                             "id": "chatcmpl-dummy",
@@ -710,6 +903,7 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
 
                                     usage = chunk.get("usage",{})
                                     if usage:
+                                        last_usage = usage
                                         usage_chunk = {
                                             "id": "chatcmpl-dummy",
                                             "object": "chat.completion.chunk",
@@ -726,8 +920,9 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                         except Exception:
                             continue
             finally:
-                # 确保无论如何都释放账号锁定
+                # 确保无论如何都释放账号锁定和准入许可
                 release_account(account.id)
+                permit.release()
                 # 确保关闭WebSocket连接
                 if ws:
                     try:
@@ -739,6 +934,7 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
         async def collect_full_response():
             full_content = ""
             final_usage = {}
+            finished = False
             processed_image_ids = set()  # 已处理过的图片ID集合
             try:
                 # 监听ws消息并收集完整响应
@@ -768,6 +964,7 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                                     if usage:
                                         final_usage = usage
                                     if chunk.get("done"):
+                                        finished = True
                                         break
                         except Exception:
                             continue
@@ -784,50 +981,68 @@ async def chat_completions(request: Request, db: Session = Depends(get_db), _: b
                 full_content = await replace_image_links(full_content, headers, processed_image_ids)
             # 替换 reasoning 详情块为 <think> 标记
             full_content = convert_reasoning_details(full_content)
-            
+            if finished:
+                # 记录本轮对话，客户端带着这次的回复继续提问时复用同一个上游对话
+                remember_conversation(normalized_messages, full_content, model, account.id, chat_id, assistant_id)
+                if cache_store:
+                    store_response(cache_key, full_content, final_usage)
+
             # 构造非流式响应格式
-            complete_response = {
-                "id": f"chatcmpl-{str(uuid.uuid4())}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": full_content
-                        },
-                        "finish_reason": "stop"
-                    }
-                ]
-            }
-            
-            # 如果有usage数据，添加到响应中
-            if final_usage:
-                complete_response["usage"] = final_usage
-                
-            return complete_response
+            return build_completion_response(model, full_content, final_usage)
 
-        # 根据请求类型返回流式或非流式响应
-        if stream:
-            return StreamingResponse(stream_generator(), media_type="text/event-stream")
-        else:
+        # 非流式请求，等待收集完整响应
+        async def complete_response():
             try:
-                # 非流式请求，等待收集完整响应后返回
-                full_response = await collect_full_response()
-                return JSONResponse(content=full_response)
+                return await collect_full_response()
             finally:
-                # 释放账号锁定
+                # 释放账号锁定和准入许可
                 release_account(account.id)
+                permit.release()
                 # 关闭WebSocket连接
                 if ws:
                     try:
                         await ws.close()
                     except:
                         pass
-    except Exception as e:
-        # 发生异常时也要确保释放账号
+
+        # 根据请求类型返回流式或非流式响应
+        if subscription:
+            # 并发合并：上游生成交给后台任务，发起请求的客户端和之后合并进来的客户端都从同一个结果读取，
+            # 账号、准入许可和连接由后台任务在生成结束（或所有客户端断开后取消）时释放
+            if stream:
+                async def close_upstream():
+                    # 后台任务在开始读取上游之前就被取消时，stream_generator 的 finally 不会执行
+                    release_account(account.id)
+                    permit.release()
+                    try:
+                        await ws.close()
+                    except:
+                        pass
+
+                subscription.flight.run_stream(stream_generator(), close_upstream)
+                return StreamingResponse(
+                    subscription.stream(),
+                    media_type="text/event-stream",
+                    headers=cache_headers,
+                    background=BackgroundTask(subscription.release),
+                )
+            subscription.flight.run_result(complete_response())
+            return JSONResponse(content=await subscription.result(), headers=cache_headers)
+        if stream:
+            # 客户端在生成器启动前断开时 finally 不会执行，由后台任务兜底释放准入许可
+            return StreamingResponse(
+                stream_generator(),
+                media_type="text/event-stream",
+                headers=cache_headers,
+                background=BackgroundTask(permit.release),
+            )
+        return JSONResponse(content=await complete_response(), headers=cache_headers)
+    except BaseException as e:
+        if subscription and subscription.flight.started.is_set():
+            # 上游生成已交给并发合并的后台任务，由任务负责释放
+            raise
+        # 发生异常（包括客户端断开导致的取消）时也要确保释放账号和准入许可
+        permit.release()
         if account:
             release_account(account.id)
         # 关闭WebSocket连接
@@ -11,6 +11,13 @@ from db import get_db
 from models import tokens
 from utils.auth import verify_admin
 from utils.register import refresh_silent_cookies
+from utils.local_cache import invalidate_account
+from utils.usage_window import get_window_usage
+from utils.http_client import get_session
+from utils.scheduler import scheduler_status
+from utils.admission import get_admission_controller
+from utils.response_cache import response_cache_stats
+from utils.single_flight import coalescing_stats
 
 # 创建路由器
 router = APIRouter(
@@ -43,6 +50,7 @@ class Token(TokenBase):
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
     deleted_at: Optional[datetime] = None
+    usage_window: Optional[int] = None  # 滑动窗口内的使用次数（仅列表接口返回）
 
     class Config:
         orm_mode = True
@@ -97,7 +105,7 @@ async def refresh_models(db: Session = Depends(get_db), _: bool = Depends(verify
         }
 
         # 请求 ChatBetter 接口获取模型列表
-        response = requests.get("https://app.chatbetter.com/api/models", headers=headers)
+        response = get_session().get("https://app.chatbetter.com/api/models", headers=headers)
         response.raise_for_status()
 
         models_data = response.json()
@@ -118,6 +126,26 @@ async def refresh_models(db: Session = Depends(get_db), _: bool = Depends(verify
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error refreshing models: {str(e)}")
 
+# 本进程 /v1/chat/completions 准入控制的状态：并发数、排队数、拒绝次数和当前的 Retry-After
+@router.get("/admission/stats")
+def get_admission_stats(_: bool = Depends(verify_admin)):
+    return get_admission_controller().stats()
+
+# /v1/chat/completions 响应缓存的统计（所有进程共享）：命中/未命中/跳过/写入/淘汰次数、命中率和条目数
+@router.get("/response-cache/stats")
+def get_response_cache_stats(_: bool = Depends(verify_admin)):
+    return response_cache_stats()
+
+# 本进程相同请求并发合并的统计：进行中的生成数、发起/合并/取消次数
+@router.get("/coalescing/stats")
+def get_coalescing_stats(_: bool = Depends(verify_admin)):
+    return coalescing_stats()
+
+# 定时任务调度器状态：主实例、各任务的下次执行时间和最近的执行记录（耗时、结果）
+@router.get("/scheduler/jobs")
+def get_scheduler_jobs(_: bool = Depends(verify_admin)):
+    return scheduler_status()
+
 @router.get("/{token_id}", response_model=Token)
 def read_token(token_id: int, db: Session = Depends(get_db), _: bool = Depends(verify_admin)):
     """通过ID获取token"""
@@ -147,6 +175,10 @@ def read_tokens(
     """获取token列表（带分页），支持账号模糊搜索"""
     items = tokens.get_tokens(db, skip=skip, limit=limit, sort_by=sort_by, sort_desc=sort_desc, account=account)
     total = tokens.count_tokens(db, account=account)  # 传递 account 参数进行模糊搜索统计
+    # 附加滑动窗口内的使用次数，Redis不可用时为空
+    usage = get_window_usage(item.id for item in items)
+    for item in items:
+        item.usage_window = usage.get(item.id)
     return {"total": total, "items": items}
 
 @router.put("/{token_id}", response_model=Token)
@@ -155,6 +187,7 @@ def update_token_api(token_id: int, token_data: TokenUpdate, db: Session = Depen
     db_token = tokens.update_token(db, token_id=token_id, token_data=token_data.dict(exclude_unset=True))
     if db_token is None:
         raise HTTPException(status_code=404, detail="Token not found")
+    invalidate_account(token_id)
     return db_token
 
 @router.delete("/{token_id}", response_model=bool)
@@ -163,6 +196,7 @@ def delete_token(token_id: int, db: Session = Depends(get_db), _: bool = Depends
     result = tokens.soft_delete_token(db, token_id=token_id)
     if not result:
         raise HTTPException(status_code=404, detail="Token not found")
+    invalidate_account(token_id)
     return result
 
 @router.put("/{token_id}/increment", response_model=Token)
@@ -204,6 +238,7 @@ def upgrade_token(token_id: int, db: Session = Depends(get_db), _: bool = Depend
             account.cookies_expires = datetime.now() + timedelta(days=30)
             account.updated_at = datetime.now()
             db.commit()
+            invalidate_account(account.id)
 
     # 如果缺少 token 或 access_token，无法继续
     if not account.token or not account.access_token:
@@ -216,7 +251,7 @@ def upgrade_token(token_id: int, db: Session = Depends(get_db), _: bool = Depend
 
     try:
         # 跟随重定向获取最终链接
-        resp = requests.get("https://app.chatbetter.com/stripe/checkout", headers=headers, allow_redirects=True)
+        resp = get_session().get("https://app.chatbetter.com/stripe/checkout", headers=headers, allow_redirects=True)
         final_url = resp.url
         return {"url": final_url}
     except Exception as e:
@@ -0,0 +1,47 @@
+"""
+定时任务调度器进程：参与主实例选举，只执行集群任务（刷新到期账号、重建Redis账号缓存、每日重置、凭据主动刷新）
+
+用法：
+    python scheduler.py
+
+可以部署多个实例做热备，同一时刻只有持有主实例租约的实例执行任务；
+API 进程设置 EMBEDDED_SCHEDULER=false 后只执行各自的进程任务
+"""
+import os
+import signal
+
+from env import PROXY_URL, SHUTDOWN_TIMEOUT_SECONDS
+
+
+def main():
+    # 与 API 进程一致，设置全局代理（如果有配置）
+    if PROXY_URL:
+        os.environ["http_proxy"] = PROXY_URL
+        os.environ["https_proxy"] = PROXY_URL
+
+    import threading
+    import time
+    from models.tokens import check_schema
+    from utils.scheduler import Scheduler, build_jobs
+    from utils.token_refresher import token_refresher
+
+    # 凭据迁移未执行时拒绝启动
+    check_schema()
+    scheduler = Scheduler([job for job in build_jobs() if job.leader_only])
+    # 凭据主动刷新同样只在主实例上执行
+    refresher_thread = threading.Thread(target=token_refresher.run, args=(scheduler.is_leader,), daemon=True)
+    refresher_thread.start()
+
+    # 收到 SIGTERM/SIGINT 后停止调度，等待执行中的任务结束后释放主实例租约，备用实例随即接管
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+    scheduler.run()
+    # 停止调度和主动刷新共用同一个期限
+    deadline = time.time() + SHUTDOWN_TIMEOUT_SECONDS
+    token_refresher.stop()
+    scheduler.shutdown(SHUTDOWN_TIMEOUT_SECONDS)
+    refresher_thread.join(max(0.0, deadline - time.time()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from utils.admission import AdmissionController, INTERACTIVE, BATCH
+
+
+def _controller(limit=10, paid=2, free=10, interactive_reserved=0.0, paid_reserved=0.0, queue_size=10, queue_timeout=1.0):
+    return AdmissionController(
+        limit=limit,
+        route_limits={"paid": paid, "free": free},
+        interactive_reserved=interactive_reserved,
+        queue_size=queue_size,
+        queue_timeout=queue_timeout,
+        paid_reserved=paid_reserved,
+    )
+
+
+def test_route_capped_waiter_does_not_block_other_route():
+    async def main():
+        controller = _controller()
+        paid = [await controller.acquire("paid", INTERACTIVE) for _ in range(2)]
+        # paid 路由已满，排队的 paid 请求不应挡住 free 请求
+        waiter = asyncio.ensure_future(controller.acquire("paid", INTERACTIVE))
+        await asyncio.sleep(0)
+        free = await asyncio.wait_for(controller.acquire("free", INTERACTIVE), timeout=0.1)
+        assert not waiter.done()
+
+        paid[0].release()
+        permit = await asyncio.wait_for(waiter, timeout=0.1)
+        return controller, [permit, free, paid[1]]
+
+    controller, permits = asyncio.run(main())
+    assert controller.stats()["active_by_route"] == {"paid": 2, "free": 1}
+    for permit in permits:
+        permit.release()
+    assert controller.stats()["active"] == 0
+
+
+def test_same_route_waiter_is_not_overtaken():
+    async def main():
+        controller = _controller(paid=1)
+        first = await controller.acquire("paid", INTERACTIVE)
+        waiter = asyncio.ensure_future(controller.acquire("paid", INTERACTIVE))
+        await asyncio.sleep(0)
+        late = asyncio.ensure_future(controller.acquire("paid", INTERACTIVE))
+        await asyncio.sleep(0)
+
+        first.release()
+        # 先排队的请求先被放行
+        permit = await asyncio.wait_for(waiter, timeout=0.1)
+        assert not late.done()
+        permit.release()
+        (await asyncio.wait_for(late, timeout=0.1)).release()
+
+    asyncio.run(main())
+
+
+def test_paid_reserved_share():
+    async def main():
+        controller = _controller(limit=10, paid=5, paid_reserved=0.2)
+        free = [await controller.acquire("free", INTERACTIVE) for _ in range(8)]
+        # free 路由最多占用全局并发的 80%
+        with pytest.raises(HTTPException) as excinfo:
+            await controller.acquire("free", INTERACTIVE)
+        assert excinfo.value.status_code == 503
+        paid = [await asyncio.wait_for(controller.acquire("paid", INTERACTIVE), timeout=0.1) for _ in range(2)]
+        return controller, free + paid
+
+    controller, permits = asyncio.run(main())
+    assert controller.stats()["active"] == 10
+    for permit in permits:
+        permit.release()
+
+
+def test_interactive_dequeued_before_batch():
+    async def main():
+        controller = _controller(limit=1)
+        first = await controller.acquire("free", BATCH)
+        batch = asyncio.ensure_future(controller.acquire("free", BATCH))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(controller.acquire("free", INTERACTIVE))
+        await asyncio.sleep(0)
+
+        first.release()
+        permit = await asyncio.wait_for(interactive, timeout=0.1)
+        assert not batch.done()
+        permit.release()
+        (await asyncio.wait_for(batch, timeout=0.1)).release()
+
+    asyncio.run(main())
+
+
+def test_queue_full_rejected_with_retry_after():
+    async def main():
+        controller = _controller(limit=1, queue_size=1, queue_timeout=0.05)
+        permit = await controller.acquire("free", INTERACTIVE)
+        waiter = asyncio.ensure_future(controller.acquire("free", INTERACTIVE))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as excinfo:
+            await controller.acquire("free", INTERACTIVE)
+        with pytest.raises(HTTPException):
+            await waiter
+        permit.release()
+        return controller, excinfo.value
+
+    controller, error = asyncio.run(main())
+    assert error.status_code == 429
+    assert "Retry-After" in error.headers
+    assert controller.stats()["active"] == 0
+    assert controller.stats()["queued"] == {INTERACTIVE: 0, BATCH: 0}
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils import refresh_guard
+
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    # 只验证进程内的去重，不经过跨副本锁
+    monkeypatch.setattr(refresh_guard, "is_redis_healthy", lambda: False)
+
+
+def test_cancelled_waiter_does_not_affect_others():
+    release = threading.Event()
+    calls = []
+
+    def refresh(account_id):
+        calls.append(account_id)
+        release.wait(5)
+        return True
+
+    async def main():
+        leader = asyncio.ensure_future(refresh_guard.run_refresh_async(1, refresh))
+        await asyncio.sleep(0.05)
+        a = asyncio.ensure_future(refresh_guard.run_refresh_async(1, refresh))
+        b = asyncio.ensure_future(refresh_guard.run_refresh_async(1, refresh))
+        await asyncio.sleep(0.05)
+        a.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        results = await asyncio.gather(leader, a, b, return_exceptions=True)
+        return results
+
+    leader_result, a_result, b_result = asyncio.run(main())
+    assert calls == [1]
+    assert leader_result is True
+    assert isinstance(a_result, asyncio.CancelledError)
+    assert b_result is True
+    assert 1 not in refresh_guard._inflight
+
+
+def test_cancelled_coro_leader_still_completes():
+    async def main():
+        started = asyncio.Event()
+        release = asyncio.Event()
+        calls = []
+
+        async def refresh(account_id):
+            calls.append(account_id)
+            started.set()
+            await release.wait()
+            return True
+
+        leader = asyncio.ensure_future(refresh_guard.run_refresh_coro(2, refresh))
+        await started.wait()
+        follower = asyncio.ensure_future(refresh_guard.run_refresh_coro(2, refresh))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(leader, follower, return_exceptions=True)
+        return calls, results
+
+    calls, (leader_result, follower_result) = asyncio.run(main())
+    assert calls == [2]
+    assert isinstance(leader_result, asyncio.CancelledError)
+    assert follower_result is True
+    assert 2 not in refresh_guard._inflight
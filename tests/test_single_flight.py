@@ -0,0 +1,113 @@
+import asyncio
+
+from utils.single_flight import start_flight, join_flight
+
+
+async def _source(count, closed):
+    try:
+        for i in range(count):
+            await asyncio.sleep(0.01)
+            yield f"e{i}"
+    finally:
+        closed.append(True)
+
+
+def test_follower_disconnect_does_not_cut_leader():
+    async def main():
+        closed = []
+        leader = start_flight("follower-disconnect")
+        leader.flight.run_stream(_source(5, closed))
+        follower = join_flight("follower-disconnect")
+
+        # 合并进来的请求先读取并断开，发起请求的客户端之后才开始读取
+        reader = follower.stream()
+        assert await reader.__anext__() == "e0"
+        await reader.aclose()
+
+        events = [event async for event in leader.stream()]
+        return events, closed, leader.flight
+
+    events, closed, flight = asyncio.run(main())
+    assert events == ["e0", "e1", "e2", "e3", "e4"]
+    assert closed == [True]
+    assert flight.error is None
+    assert flight.subscribers == 0
+
+
+def test_late_joiner_gets_full_sequence():
+    async def main():
+        leader = start_flight("late-joiner")
+        leader.flight.run_stream(_source(4, []))
+        await asyncio.sleep(0.025)
+        follower = join_flight("late-joiner")
+        return await asyncio.gather(
+            _collect(leader.stream()),
+            _collect(follower.stream()),
+        )
+
+    leader_events, follower_events = asyncio.run(main())
+    assert leader_events == follower_events == ["e0", "e1", "e2", "e3"]
+
+
+def test_unread_subscriber_released_cancels_upstream_with_error_event():
+    async def main():
+        closed = []
+        leader = start_flight("released")
+        leader.flight.run_stream(_source(100, closed))
+        follower = join_flight("released")
+        reader = follower.stream()
+        assert await reader.__anext__() == "e0"
+        # 发起请求的客户端在开始读取前断开：由后台任务释放订阅
+        leader.release()
+        await asyncio.sleep(0.02)
+        assert not leader.flight.done
+        # 只剩的订阅者被服务端取消上游时以错误事件结束
+        leader.flight.task.cancel()
+        rest = await _collect(reader)
+        return rest, closed
+
+    rest, closed = asyncio.run(main())
+    assert closed == [True]
+    assert '"upstream_error"' in rest[-2]
+    assert rest[-1] == "data: [DONE]\n\n"
+
+
+def test_all_subscribers_gone_cancels_upstream():
+    async def main():
+        closed = []
+        leader = start_flight("all-gone")
+        leader.flight.run_stream(_source(100, closed))
+        follower = join_flight("all-gone")
+        await asyncio.sleep(0.015)
+        leader.release()
+        follower.release()
+        await asyncio.sleep(0.02)
+        return closed, leader.flight
+
+    closed, flight = asyncio.run(main())
+    assert closed == [True]
+    assert flight.done
+    assert join_flight("all-gone") is None
+
+
+def test_cancelled_before_pump_starts_runs_cleanup():
+    async def main():
+        cleaned = []
+
+        async def cleanup():
+            cleaned.append(True)
+
+        leader = start_flight("before-start")
+        leader.flight.run_stream(_source(100, []), cleanup)
+        # 上游任务还没执行第一步，所有订阅者就已释放
+        leader.release()
+        await asyncio.sleep(0.02)
+        return cleaned, leader.flight
+
+    cleaned, flight = asyncio.run(main())
+    assert cleaned == [True]
+    assert flight.done
+
+
+async def _collect(stream):
+    return [event async for event in stream]
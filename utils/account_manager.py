@@ -5,15 +5,19 @@ from typing import Optional, Dict, Any, List
 import json
 from utils.redis_cache import (
     cache_account, 
-    get_cached_account, 
-    increment_account_usage,
     refresh_account_cache,
     test_connection as test_redis_connection,
+    is_redis_healthy,
     remove_cached_account,
     lock_account,
     unlock_account,
     is_account_locked
 )
+from utils.local_cache import CachedAccount, get_local_account, put_local_account
+from utils.usage_counter import record_usage
+from utils.memory_pool import get_memory_pool, refresh_memory_pools
+from utils.usage_window import pick_least_used, record_window_usage
+from env import ACCOUNT_POOL_BACKEND, ACCOUNT_CANDIDATE_BATCH
 
 def token_to_dict(token: Token) -> Dict[str, Any]:
     """将Token对象转换为可序列化的字典"""
@@ -30,45 +34,97 @@ def token_to_dict(token: Token) -> Dict[str, Any]:
         "enable": token.enable
     }
 
-async def pick_account(db: Session) -> Token:
+def load_account(db: Session, account_id: int) -> Optional[CachedAccount]:
     """
-    挑选使用次数最少且启用的账号
-    优先从Redis缓存获取，如果缓存无数据则从数据库获取并更新缓存
+    根据ID获取账号记录
+    优先读取进程内L1缓存，未命中时查询数据库并写入L1缓存
+    
+    Args:
+        db: 数据库会话
+        account_id: 账号ID
+        
+    Returns:
+        账号记录，账号不存在或已删除时返回None
+    """
+    record = get_local_account(account_id)
+    if record:
+        return record
+    
+    db_account = db.query(Token).filter(Token.id == account_id, Token.deleted_at == None).first()
+    if not db_account:
+        return None
+    
+    record = CachedAccount.from_token(db_account)
+    put_local_account(record)
+    return record
+
+def use_memory_pool() -> bool:
+    """是否使用进程内账号池挑选账号：配置为memory，或Redis当前不可用"""
+    return ACCOUNT_POOL_BACKEND == "memory" or not is_redis_healthy()
+
+def _pick_from_memory_pool(db: Session, is_paid: bool = False) -> Optional[CachedAccount]:
+    """
+    从内存账号池中挑选使用次数最少的可用账号
+    
+    Args:
+        db: 数据库会话，仅在账号池未加载或L1缓存未命中时使用
+        is_paid: 是否挑选付费账号
+        
+    Returns:
+        账号记录，账号池为空时返回None
+    """
+    pool = get_memory_pool(is_paid)
+    if not pool.loaded:
+        # 首次使用（例如Redis刚刚不可用）时同步加载
+        refresh_memory_pools(db)
+    
+    for _ in range(len(pool)):
+        account_id = pool.acquire()
+        if account_id is None:
+            return None
+        record = load_account(db, account_id)
+        if record and record.enable == 1:
+            record_usage(account_id)
+            return record
+        # 账号已被禁用或删除，移出账号池
+        pool.remove(account_id)
+    return None
+
+async def pick_account(db: Session) -> CachedAccount:
+    """
+    挑选使用量最少且启用的账号
+    Redis账号池按滑动窗口内的使用量挑选，内存账号池和数据库按使用次数挑选
+    优先从账号池（Redis或内存）获取，如果账号池无数据则从数据库获取并更新缓存
     会锁定选中的账号，防止被同时使用
     """
-    # 尝试从Redis缓存中获取账号
-    try:
-        if test_redis_connection():
-            cached_account = get_cached_account(is_paid=False)
-            if cached_account and cached_account.get("id"):
-                # 从缓存获取到账号，需要从数据库中获取完整的Token对象
-                account_id = cached_account.get("id")
-                db_account = db.query(Token).filter(Token.id == account_id).first()
+    if use_memory_pool():
+        # 内存账号池模式，或Redis不可用时自动回退到内存账号池
+        memory_account = _pick_from_memory_pool(db, is_paid=False)
+        if memory_account:
+            return memory_account
+    else:
+        # 从Redis候选账号中挑选滑动窗口内使用量最少的账号（挑选时已记入窗口）
+        try:
+            account_id = pick_least_used(is_paid=False)
+            if account_id:
+                # 优先使用进程内L1缓存的账号记录
+                db_account = load_account(db, account_id)
                 
-                if db_account and db_account.enable == 1 and db_account.deleted_at is None:
-                    # 更新使用次数
-                    increment_count(db, db_account.id)
-                    db.commit()
-                    db.refresh(db_account)
-                    
-                    # 更新Redis中的使用次数
-                    increment_account_usage(account_id, is_paid=False)
-                    
-                    # 注意：此时账号已经被锁定，由调用者负责在适当时机解锁
+                if db_account and db_account.enable == 1:
+                    # 使用次数先记在内存中，由后台线程批量写回数据库
+                    record_usage(account_id)
                     return db_account
-    except Exception as e:
-        print(f"Redis缓存获取账号失败: {str(e)}")
+        except Exception as e:
+            print(f"Redis缓存获取账号失败: {str(e)}")
     
-    # 如果Redis不可用或者没有缓存数据，从数据库获取
-    # 获取所有可用账号
-    accounts = (
+    # 如果账号池中没有可用账号，从数据库获取
+    # 只取使用次数最少的一个账号（走 ix_tokens_selection 索引，LIMIT 1）
+    account = (
         db.query(Token)
         .filter(Token.enable == 1, Token.deleted_at == None)
         .order_by(Token.count.asc(), desc(Token.token_expires))
-        .all()
+        .first()
     )
-    
-    account = accounts[0]
 
     if not account:
         from fastapi import HTTPException
@@ -81,53 +137,51 @@ async def pick_account(db: Session) -> Token:
 
     # 尝试更新Redis缓存
     try:
-        if test_redis_connection():
+        if not use_memory_pool():
             account_data = token_to_dict(account)
             cache_account(account.id, account_data, is_paid=False)
+            record_window_usage(account.id)
     except Exception as e:
         print(f"更新Redis缓存账号失败: {str(e)}")
     
-    return account
+    record = CachedAccount.from_token(account)
+    put_local_account(record)
+    return record
 
-async def pick_paid_account(db: Session) -> Token:
+async def pick_paid_account(db: Session) -> CachedAccount:
     """
     挑选account_type为paid的账号，如果没有则选择普通账号
-    优先从Redis缓存获取，如果缓存无数据则从数据库获取并更新缓存
+    优先从账号池（Redis或内存）获取，如果账号池无数据则从数据库获取并更新缓存
     会锁定选中的账号，防止被同时使用
     """
-    # 尝试从Redis缓存中获取付费账号
-    try:
-        if test_redis_connection():
-            cached_account = get_cached_account(is_paid=True)
-            if cached_account and cached_account.get("id"):
-                # 从缓存获取到付费账号
-                account_id = cached_account.get("id")
-                db_account = db.query(Token).filter(Token.id == account_id).first()
+    if use_memory_pool():
+        # 内存账号池模式，或Redis不可用时自动回退到内存账号池
+        memory_account = _pick_from_memory_pool(db, is_paid=True)
+        if memory_account:
+            return memory_account
+    else:
+        # 从Redis候选账号中挑选滑动窗口内使用量最少的付费账号（挑选时已记入窗口）
+        try:
+            account_id = pick_least_used(is_paid=True)
+            if account_id:
+                # 优先使用进程内L1缓存的账号记录
+                db_account = load_account(db, account_id)
                 
-                if db_account and db_account.enable == 1 and db_account.deleted_at is None:
-                    # 更新使用次数
-                    increment_count(db, db_account.id)
-                    db.commit()
-                    db.refresh(db_account)
-                    
-                    # 更新Redis中的使用次数
-                    increment_account_usage(account_id, is_paid=True)
-                    
-                    # 注意：此时账号已经被锁定，由调用者负责在适当时机解锁
+                if db_account and db_account.enable == 1:
+                    # 使用次数先记在内存中，由后台线程批量写回数据库
+                    record_usage(account_id)
                     return db_account
-    except Exception as e:
-        print(f"Redis缓存获取付费账号失败: {str(e)}")
+        except Exception as e:
+            print(f"Redis缓存获取付费账号失败: {str(e)}")
     
-    # 如果Redis不可用或者没有缓存数据，从数据库获取
-    # 获取所有可用的付费账号
-    paid_accounts = (
+    # 如果账号池中没有可用账号，从数据库获取
+    # 只取使用次数最少的一个付费账号（走 ix_tokens_paid_selection 索引，LIMIT 1）
+    account = (
         db.query(Token)
         .filter(Token.enable == 1, Token.deleted_at == None, Token.account_type == 'paid')
         .order_by(Token.count.asc(), desc(Token.token_expires))
-        .all()
+        .first()
     )
-    
-    account = paid_accounts[0] if paid_accounts else None
 
     # 如果所有付费账号都被锁定，尝试获取普通账号
     if not account:
@@ -140,13 +194,38 @@ async def pick_paid_account(db: Session) -> Token:
     
     # 尝试更新Redis缓存
     try:
-        if test_redis_connection():
+        if not use_memory_pool():
             account_data = token_to_dict(account)
             cache_account(account.id, account_data, is_paid=True)
+            record_window_usage(account.id)
     except Exception as e:
         print(f"更新Redis缓存付费账号失败: {str(e)}")
     
-    return account
+    record = CachedAccount.from_token(account)
+    put_local_account(record)
+    return record
+
+def pick_affinity_account(db: Session, account_id: int, is_paid: bool = False) -> Optional[CachedAccount]:
+    """
+    使用指定账号（会话亲和：继续该账号上的上游对话）
+
+    Args:
+        db: 数据库会话，仅在L1缓存未命中时使用
+        account_id: 上一轮对话所在的账号ID
+        is_paid: 是否要求付费账号
+
+    Returns:
+        账号记录，账号已禁用、删除或类型不符时返回None（此时应重新挑选账号）
+    """
+    record = load_account(db, account_id)
+    if not record or record.enable != 1:
+        return None
+    if is_paid and record.account_type != "paid":
+        return None
+    record_usage(account_id)
+    if not use_memory_pool():
+        record_window_usage(account_id)
+    return record
 
 def release_account(account_id: int) -> bool:
     """
@@ -162,30 +241,35 @@ def release_account(account_id: int) -> bool:
 
 def refresh_accounts_cache(db: Session):
     """
-    刷新Redis中的账号缓存
-    将数据库中的可用账号加载到Redis缓存中
+    刷新账号缓存
+    将数据库中的可用账号加载到Redis缓存中；内存账号池模式或Redis不可用时刷新内存账号池
     """
+    if use_memory_pool():
+        return refresh_memory_pools(db)
+
     try:
         if not test_redis_connection():
             print("Redis连接不可用，无法刷新缓存")
             return False
         
-        # 加载普通账号
+        # 加载使用次数最少的一批普通账号作为候选
         normal_accounts = (
             db.query(Token)
             .filter(Token.enable == 1, Token.deleted_at == None)
             .order_by(Token.count.asc(), desc(Token.token_expires))
+            .limit(ACCOUNT_CANDIDATE_BATCH)
             .all()
         )
         
         normal_account_data = [token_to_dict(account) for account in normal_accounts]
         refresh_account_cache(normal_account_data, is_paid=False)
         
-        # 加载付费账号
+        # 加载使用次数最少的一批付费账号作为候选
         paid_accounts = (
             db.query(Token)
             .filter(Token.enable == 1, Token.deleted_at == None, Token.account_type == 'paid')
             .order_by(Token.count.asc(), desc(Token.token_expires))
+            .limit(ACCOUNT_CANDIDATE_BATCH)
             .all()
         )
         
@@ -0,0 +1,227 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from env import (
+    ADMISSION_MAX_CONCURRENCY,
+    ADMISSION_PAID_CONCURRENCY,
+    ADMISSION_FREE_CONCURRENCY,
+    ADMISSION_INTERACTIVE_RESERVED,
+    ADMISSION_PAID_RESERVED,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_RETRY_AFTER_MAX,
+)
+
+# /v1/chat/completions 的准入控制（每个进程独立计数）：
+# - 全局并发上限 + 按账号类型（paid/free）的并发上限
+# - 优先级：流式请求为 interactive，非流式请求为 batch；
+#   全局并发中预留 ADMISSION_INTERACTIVE_RESERVED 比例只给 interactive 使用，batch 无法占满
+# - 账号路由：全局并发中预留 ADMISSION_PAID_RESERVED 比例只给 paid 路由（长上下文）使用，free 路由无法占满
+# - 超出并发时进入有界等待队列，interactive 优先出队；队列已满立即返回 429，等待超时返回 503
+# - Retry-After 按最近完成请求的速率估算排队中的请求多久能处理完
+INTERACTIVE = "interactive"
+BATCH = "batch"
+_PRIORITIES = (INTERACTIVE, BATCH)
+
+# 估算完成速率时保留的最近完成时间数量
+_RATE_SAMPLES = 200
+
+
+class AdmissionPermit:
+    """准入许可，请求结束时释放（可重复调用）"""
+
+    __slots__ = ("controller", "route", "priority", "_released")
+
+    def __init__(self, controller: "AdmissionController", route: str, priority: str):
+        self.controller = controller
+        self.route = route
+        self.priority = priority
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    准入控制器
+
+    Args:
+        limit: 全局并发上限
+        route_limits: 账号类型 -> 并发上限
+        interactive_reserved: 全局并发中只给 interactive 请求使用的比例
+        paid_reserved: 全局并发中只给 paid 路由使用的比例
+        queue_size: 等待队列长度上限
+        queue_timeout: 单个请求在队列中的最长等待时间（秒）
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        route_limits: Dict[str, int],
+        interactive_reserved: float,
+        queue_size: int,
+        queue_timeout: float,
+        paid_reserved: float = 0,
+    ):
+        self.limit = limit
+        self.route_limits = route_limits
+        self.batch_limit = max(1, int(limit * (1 - interactive_reserved)))
+        self.free_limit = max(1, int(limit * (1 - paid_reserved)))
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._active_by_route: Dict[str, int] = {route: 0 for route in route_limits}
+        self._waiters: Dict[str, Deque[Tuple[str, asyncio.Future]]] = {priority: deque() for priority in _PRIORITIES}
+        self._completions: Deque[float] = deque(maxlen=_RATE_SAMPLES)
+        self.rejected = 0
+
+    def _fits(self, route: str, priority: str) -> bool:
+        limit = self.limit if priority == INTERACTIVE else self.batch_limit
+        if route != "paid":
+            limit = min(limit, self.free_limit)
+        return self._active < limit and self._active_by_route.get(route, 0) < self.route_limits.get(route, self.limit)
+
+    def _has_waiter_ahead(self, route: str, priority: str) -> bool:
+        """
+        是否有排在前面、新请求不应插队的等待者：同等或更高优先级中，同一路由的等待者，
+        或者当前就能放行的等待者；因其他路由的并发上限而等待的请求不阻塞新请求
+        """
+        for waiting_priority in _PRIORITIES:
+            for waiting_route, future in self._waiters[waiting_priority]:
+                if future.done():
+                    continue
+                if waiting_route == route or self._fits(waiting_route, waiting_priority):
+                    return True
+            if waiting_priority == priority:
+                break
+        return False
+
+    def _queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _admit(self, route: str, priority: str) -> AdmissionPermit:
+        self._active += 1
+        self._active_by_route[route] = self._active_by_route.get(route, 0) + 1
+        return AdmissionPermit(self, route, priority)
+
+    def _release(self, permit: AdmissionPermit):
+        self._active -= 1
+        self._active_by_route[permit.route] -= 1
+        self._completions.append(time.monotonic())
+        self._wake()
+
+    def _wake(self):
+        """按优先级唤醒能够放行的等待者"""
+        for priority in _PRIORITIES:
+            waiters = self._waiters[priority]
+            for entry in list(waiters):
+                route, future = entry
+                if future.done():
+                    waiters.remove(entry)
+                    continue
+                if self._fits(route, priority):
+                    waiters.remove(entry)
+                    future.set_result(self._admit(route, priority))
+
+    def retry_after(self) -> int:
+        """按最近的完成速率估算排队请求处理完所需的秒数"""
+        now = time.monotonic()
+        recent = [t for t in self._completions if now - t <= 60]
+        if len(recent) >= 2 and now > recent[0]:
+            rate = len(recent) / (now - recent[0])
+            seconds = math.ceil((self._queued() + 1) / rate)
+        else:
+            seconds = ADMISSION_RETRY_AFTER_MAX
+        return max(1, min(ADMISSION_RETRY_AFTER_MAX, seconds))
+
+    def _reject(self, status_code: int, detail: str):
+        self.rejected += 1
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    async def acquire(self, route: str, priority: str) -> AdmissionPermit:
+        """
+        申请准入许可
+
+        Args:
+            route: 账号类型（paid/free）
+            priority: INTERACTIVE 或 BATCH
+
+        Returns:
+            准入许可，请求结束时调用 release
+
+        Raises:
+            HTTPException: 队列已满时 429，排队超时时 503，均带 Retry-After 头
+        """
+        # 同等或更高优先级中有可能先被放行的等待者时不插队
+        if not self._has_waiter_ahead(route, priority) and self._fits(route, priority):
+            return self._admit(route, priority)
+
+        if self._queued() >= self.queue_size:
+            self._reject(429, "Too many requests, please retry later")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (route, future)
+        self._waiters[priority].append(entry)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超时的同时被放行，直接使用许可
+                return future.result()
+            future.cancel()
+            self._discard(priority, entry)
+            self._reject(503, "Service overloaded, please retry later")
+        except BaseException:
+            # 客户端断开等情况：已拿到的许可要归还
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                future.cancel()
+                self._discard(priority, entry)
+            raise
+
+    def _discard(self, priority: str, entry):
+        try:
+            self._waiters[priority].remove(entry)
+        except ValueError:
+            pass
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "active": self._active,
+            "active_by_route": dict(self._active_by_route),
+            "queued": {priority: len(waiters) for priority, waiters in self._waiters.items()},
+            "rejected": self.rejected,
+            "retry_after": self.retry_after(),
+        }
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """本进程的准入控制器（在事件循环中首次使用时创建）"""
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(
+            limit=ADMISSION_MAX_CONCURRENCY,
+            route_limits={"paid": ADMISSION_PAID_CONCURRENCY, "free": ADMISSION_FREE_CONCURRENCY},
+            interactive_reserved=ADMISSION_INTERACTIVE_RESERVED,
+            paid_reserved=ADMISSION_PAID_RESERVED,
+            queue_size=ADMISSION_QUEUE_SIZE,
+            queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        )
+    return _controller
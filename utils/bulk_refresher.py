@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+
+from db import session_scope
+from env import (
+    PROXY_URL,
+    REFRESH_CONCURRENCY,
+    AUTH_RATE_LIMIT,
+    AUTH_RATE_BURST,
+)
+from models.tokens import Token
+from utils.check_cookies import parse_cookies_to_dict, disable_account
+from utils.redis_cache import redis_client, KEY_PREFIX
+from utils.refresh_guard import run_refresh_coro
+from utils.register import (
+    build_silent_refresh_request,
+    parse_silent_refresh_response,
+    build_signin_request,
+    parse_signin_response,
+    build_auth_info_request,
+    parse_auth_info_response,
+)
+from utils.token_writer import token_collector
+
+logger = logging.getLogger("cookies_checker")
+
+# 单次HTTP请求超时（秒）
+HTTP_TIMEOUT_SECONDS = 20
+
+# 最近一次批量刷新的统计信息（本进程），LAST_SWEEP_KEY 中保存集群内最近一次的统计
+last_sweep_stats: Dict[str, float] = {}
+LAST_SWEEP_KEY = f"{KEY_PREFIX}refresh:last_sweep"
+
+
+class TokenBucket:
+    """令牌桶限流：平均每秒 rate 个请求，最多突发 capacity 个"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _NullCookieJar(CookieJar):
+    """不保存任何cookie，防止共享客户端在不同账号之间串用cookie"""
+
+    def set_cookie(self, cookie):
+        pass
+
+    def extract_cookies(self, response, request):
+        pass
+
+
+class BulkRefresher:
+    """
+    异步批量刷新账号凭据
+    使用共享连接池的 HTTP 客户端，限制并发数，并对 auth.chatbetter.com 做令牌桶限流
+
+    Args:
+        client: HTTP 客户端
+        concurrency: 并发刷新的账号数
+        disable_failed: 刷新失败时是否禁用账号并记录退避（定时刷新禁用，管理后台手动触发的批量刷新只报告结果）
+    """
+
+    def __init__(self, client: httpx.AsyncClient, concurrency: int = REFRESH_CONCURRENCY, disable_failed: bool = True):
+        self.client = client
+        self.disable_failed = disable_failed
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.auth_bucket = TokenBucket(AUTH_RATE_LIMIT, AUTH_RATE_BURST)
+
+    # 以下三个方法与 utils.register 中的同名函数共用请求构造和响应解析，这里只负责用 httpx 发送请求
+
+    async def refresh_silent_cookies(self, cookies: dict) -> Tuple[bool, Optional[dict], Optional[str]]:
+        """utils.register.refresh_silent_cookies 的异步版本"""
+        await self.auth_bucket.acquire()
+        url, payload, headers = build_silent_refresh_request(cookies)
+        response = await self.client.post(url, json=payload, headers=headers)
+        return parse_silent_refresh_response(response, response.cookies.jar)
+
+    async def signin_with_access_token(self, access_token: str) -> Optional[dict]:
+        """utils.register.signin_with_access_token 的异步版本"""
+        url, payload, headers = build_signin_request(access_token)
+        return parse_signin_response(await self.client.post(url, json=payload, headers=headers))
+
+    async def fetch_auth_info(self, token: str, chat_better_jwt: str) -> Optional[dict]:
+        """utils.register.fetch_auth_info 的异步版本"""
+        url, headers = build_auth_info_request(token, chat_better_jwt)
+        return parse_auth_info_response(await self.client.get(url, headers=headers))
+
+    async def _refresh(self, account_id: int) -> bool:
+        """刷新单个账号：读库 -> 刷新cookies -> 获取auth -> 写库（成功结果批量写入）"""
+        loop = asyncio.get_running_loop()
+        credentials = await loop.run_in_executor(None, _load_credentials, account_id)
+        if not credentials:
+            return False
+
+        cookies = parse_cookies_to_dict(credentials["silent_cookies"])
+        try:
+            success, new_cookies, access_token = await self.refresh_silent_cookies(cookies) if cookies else (False, None, None)
+        except Exception as e:
+            logger.error(f"账号 {credentials['account']} 刷新cookies时发生异常: {str(e)}")
+            success = False
+        if success:
+            token = credentials["token"]
+            auth_data = None
+            # cookies 已经轮换，之后的请求失败也不能丢弃新cookies
+            try:
+                if not token:
+                    signin_data = await self.signin_with_access_token(access_token)
+                    token = signin_data.get('token') if signin_data else None
+                if token:
+                    auth_data = await self.fetch_auth_info(token, access_token)
+            except Exception as e:
+                logger.error(f"账号 {credentials['account']} 获取auth时发生异常: {str(e)}")
+            if not auth_data:
+                logger.error(f"账号 {credentials['account']} 的auth为空")
+            token_data = {
+                # 旧接口创建的账号 account 可能为空，按ID更新
+                "id": account_id,
+                "account": credentials["account"],
+                "cookies": new_cookies,
+                "access_token": access_token,
+                "token": token,
+                "auth": auth_data,
+                "account_type": auth_data.get("account_type") if auth_data else None,
+                "token_expires": datetime.now() + timedelta(minutes=15),
+                "enable": 1,
+            }
+            # 与同一轮的其他账号合并为一次批量 upsert
+            if await asyncio.wrap_future(token_collector.submit(token_data)) is None:
+                logger.error(f"账号 ID {account_id} 刷新后的凭据未能写入")
+                return False
+            return True
+
+        if not self.disable_failed:
+            logger.info(f"账号 {credentials['account']} 刷新失败")
+            return False
+        return await loop.run_in_executor(None, _disable_failed, account_id)
+
+    async def refresh_account(self, account_id: int, cancelled: Optional[Callable[[], bool]] = None) -> Optional[bool]:
+        """刷新单个账号；排队期间 cancelled 返回 True 时跳过并返回 None"""
+        async with self.semaphore:
+            if cancelled and cancelled():
+                return None
+            try:
+                success = await run_refresh_coro(account_id, self._refresh)
+            except Exception as e:
+                logger.error(f"刷新账号 ID {account_id} 时发生错误: {str(e)}")
+                success = False
+            return success
+
+    async def sweep(self, account_ids, on_result: Optional[Callable[[int, bool], None]] = None,
+                    cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, float]:
+        """
+        刷新一批账号并返回统计信息
+
+        Args:
+            account_ids: 待刷新的账号ID列表
+            on_result: 每个账号刷新完成后的回调 (账号ID, 是否成功)
+            cancelled: 返回 True 后尚未开始的账号不再刷新（计入 skipped）
+
+        Returns:
+            包含总数、成功、失败、跳过、耗时和吞吐量的字典
+        """
+        async def refresh(account_id: int) -> Optional[bool]:
+            success = await self.refresh_account(account_id, cancelled)
+            if on_result and success is not None:
+                on_result(account_id, success)
+            return success
+
+        started = time.time()
+        results = await asyncio.gather(*(refresh(account_id) for account_id in account_ids))
+        duration = time.time() - started
+        success = sum(1 for ok in results if ok)
+        skipped = sum(1 for ok in results if ok is None)
+        return {
+            "total": len(account_ids),
+            "success": success,
+            "failed": len(account_ids) - success - skipped,
+            "skipped": skipped,
+            "duration": round(duration, 2),
+            "throughput": round(len(account_ids) / duration, 2) if duration > 0 else 0,
+        }
+
+
+def _load_credentials(account_id: int) -> Optional[dict]:
+    """读取刷新所需的凭据字段"""
+    with session_scope() as db:
+        account = db.query(Token).filter(Token.id == account_id, Token.deleted_at == None).first()
+        if not account:
+            return None
+        return {
+            "account": account.account,
+            "silent_cookies": account.silent_cookies,
+            "token": account.token,
+        }
+
+
+def _disable_failed(account_id: int) -> bool:
+    """刷新失败：禁用账号并记录退避"""
+    with session_scope() as db:
+        account = db.query(Token).filter(Token.id == account_id, Token.deleted_at == None).first()
+        if account:
+            disable_account(account, db)
+            logger.info(f"账号 {account.account} 刷新失败并已禁用")
+    return False
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """创建带连接池的异步HTTP客户端"""
+    limits = httpx.Limits(max_connections=REFRESH_CONCURRENCY, max_keepalive_connections=REFRESH_CONCURRENCY)
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT_SECONDS,
+        limits=limits,
+        proxies=PROXY_URL or None,
+        cookies=_NullCookieJar(),
+    )
+
+
+async def refresh_accounts_async(account_ids) -> Dict[str, float]:
+    """批量刷新指定账号，记录并返回统计信息"""
+    async with create_http_client() as client:
+        stats = await BulkRefresher(client).sweep(list(account_ids))
+    last_sweep_stats.clear()
+    last_sweep_stats.update(stats)
+    # 批量刷新可能在调度器进程中执行，统计信息同时写入Redis供所有进程读取
+    try:
+        redis_client.hset(LAST_SWEEP_KEY, mapping=stats)
+    except Exception as e:
+        logger.error(f"保存批量刷新统计失败: {str(e)}")
+    logger.info(
+        f"批量刷新完成: 共 {stats['total']} 个账号, "
+        f"成功 {stats['success']}, 失败 {stats['failed']}, "
+        f"耗时 {stats['duration']} 秒, 吞吐 {stats['throughput']} 个/秒"
+    )
+    return stats
@@ -5,19 +5,30 @@ import schedule
 import logging
 import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from datetime import datetime, timedelta
+from sqlalchemy import or_, func, update
 from sqlalchemy.orm import Session
 from typing import List, Optional
 
 # 导入数据库相关模块
-from db import get_db
+from db import get_db, session_scope
 from models.tokens import Token
 from utils.register import refresh_silent_cookies, signin_with_access_token, fetch_auth_info
 
 # 导入Redis缓存相关模块
-from utils.redis_cache import test_connection as test_redis_connection
+from utils.redis_cache import test_connection as test_redis_connection, is_redis_healthy, acquire_task_lock, reset_cached_usage_counts
 from utils.account_manager import token_to_dict, cache_account, remove_cached_account
+from utils.local_cache import invalidate_account
+from utils.refresh_guard import run_refresh
+from utils.memory_pool import normal_pool, paid_pool
+from utils.usage_counter import discard_pending_usage
+from env import (
+    REFRESH_CHECK_INTERVAL_SECONDS,
+    MAX_REFRESH_FAILURES,
+    REFRESH_BACKOFF_BASE_SECONDS,
+    REFRESH_BACKOFF_MAX_SECONDS,
+)
 
 # 配置日志
 logging.basicConfig(
@@ -31,30 +42,51 @@ logging.basicConfig(
 logger = logging.getLogger("cookies_checker")
 
 # 常量设置
-# 刷新调度间隔（秒），每10分钟执行一次
-CHECK_INTERVAL_SECONDS = 600
+# 刷新调度间隔（秒）：每次只刷新到期的账号，因此可以比全量刷新更频繁；
+# access_token 的到期刷新由 token_refresher 负责，这里只处理 cookies 即将过期和禁用账号的重试
+CHECK_INTERVAL_SECONDS = REFRESH_CHECK_INTERVAL_SECONDS
 EXPIRY_WARNING_DAYS = 7    # 过期警告天数
-# 多线程刷新时的最大线程数
-MAX_WORKER_THREADS = 20
+DAILY_RESET_LOCK_TTL = 3600  # 每日重置锁的有效期（秒），覆盖各副本定时任务的时间偏差
 
-def find_expiring_accounts(db: Session) -> List[Token]:
+def find_expiring_accounts(db: Session) -> List[int]:
     """
-    查找即将过期的账号（cookies过期时间在7天内）
+    查找cookies过期时间在7天内（或未记录）的启用账号ID
+    条件只涉及 cookies_expires 一列，走 ix_tokens_cookies_due 索引的范围扫描
     """
-    now = datetime.now()
-    expiry_date = now + timedelta(days=EXPIRY_WARNING_DAYS)
+    cookies_horizon = datetime.now() + timedelta(days=EXPIRY_WARNING_DAYS)
     
-    # 查询启用状态的、cookies过期时间在当前到7天后之间的账号
-    query = db.query(Token).filter(
+    rows = db.query(Token.id).filter(
         Token.enable == 1,
         Token.deleted_at == None,
-        Token.cookies_expires <= expiry_date,
-        Token.cookies_expires >= now
-    )
+        or_(Token.cookies_expires == None, Token.cookies_expires <= cookies_horizon)
+    ).all()
     
-    accounts = query.all()
-    logger.info(f"发现 {len(accounts)} 个cookies即将过期的账号")
-    return accounts
+    logger.info(f"发现 {len(rows)} 个cookies即将过期的账号")
+    return [row.id for row in rows]
+
+def find_retry_accounts(db: Session) -> List[int]:
+    """
+    查找到了重试时间的已禁用账号ID
+    连续失败达到 MAX_REFRESH_FAILURES 次的账号视为永久失效，不再重试
+    """
+    now = datetime.now()
+    rows = db.query(Token.id).filter(
+        Token.enable == 0,
+        Token.deleted_at == None,
+        func.coalesce(Token.refresh_failures, 0) < MAX_REFRESH_FAILURES,
+        or_(Token.next_refresh_at == None, Token.next_refresh_at <= now)
+    ).all()
+    
+    logger.info(f"发现 {len(rows)} 个到达重试时间的禁用账号")
+    return [row.id for row in rows]
+
+def find_due_accounts(db: Session) -> List[int]:
+    """查找本轮需要刷新的账号ID"""
+    return find_expiring_accounts(db) + find_retry_accounts(db)
+
+def refresh_backoff_seconds(failures: int) -> int:
+    """第 failures 次连续失败后的退避时间（秒），指数增长"""
+    return min(REFRESH_BACKOFF_MAX_SECONDS, REFRESH_BACKOFF_BASE_SECONDS * (2 ** max(0, failures - 1)))
 
 def parse_cookies_to_dict(cookies_str: str) -> dict:
     """
@@ -133,9 +165,13 @@ def refresh_cookies(account: Token, db: Session) -> bool:
     return False
 
 def disable_account(account: Token, db: Session):
-    """禁用账号，阻止其被使用"""
+    """禁用账号，阻止其被使用，并按连续失败次数安排下次重试时间"""
     account.enable = 0
+    account.refresh_failures = (account.refresh_failures or 0) + 1
+    account.next_refresh_at = datetime.now() + timedelta(seconds=refresh_backoff_seconds(account.refresh_failures))
     db.commit()
+    # 通知所有副本清除L1缓存
+    invalidate_account(account.id)
     
     # 同时从Redis缓存中移除账号
     try:
@@ -148,9 +184,13 @@ def disable_account(account: Token, db: Session):
         logger.error(f"从Redis缓存移除账号失败: {str(e)}")
 
 def enable_account(account: Token, db: Session):
-    """启用账号"""
+    """启用账号，并清除刷新失败记录"""
     account.enable = 1
+    account.refresh_failures = 0
+    account.next_refresh_at = None
     db.commit()
+    # 刷新后的凭据需要让所有副本重新加载
+    invalidate_account(account.id)
     
     # 同时更新Redis缓存
     try:
@@ -164,13 +204,8 @@ def enable_account(account: Token, db: Session):
     except Exception as e:
         logger.error(f"更新Redis缓存账号失败: {str(e)}")
 
-def refresh_single_account(account_id: int):
-    """
-    在独立的线程中刷新单个账号
-    
-    Args:
-        account_id: 账号ID
-    """
+def _refresh_single_account(account_id: int) -> bool:
+    """刷新单个账号并根据结果启用或禁用账号"""
     db = None
     try:
         db = next(get_db())
@@ -178,7 +213,7 @@ def refresh_single_account(account_id: int):
         
         if not account:
             logger.error(f"找不到ID为 {account_id} 的账号")
-            return
+            return False
         
         success = refresh_cookies(account, db)
         
@@ -189,40 +224,57 @@ def refresh_single_account(account_id: int):
             # 如果刷新失败，禁用账号
             disable_account(account, db)
             logger.info(f"账号 {account.account} 刷新失败并已禁用")
+        return success
             
     except Exception as e:
         logger.exception(f"刷新账号 ID {account_id} 时发生错误: {str(e)}")
+        return False
     finally:
         if db:
             db.close()
 
+def refresh_single_account(account_id: int) -> bool:
+    """
+    在独立的线程中刷新单个账号
+    同一账号的并发刷新（包括其他副本和请求链路上的刷新）只会执行一次
+    
+    Args:
+        account_id: 账号ID
+        
+    Returns:
+        刷新是否成功
+    """
+    return run_refresh(account_id, _refresh_single_account)
+
 def check_and_refresh_accounts():
     """
-    主处理函数：每 10 分钟执行一次，多线程刷新所有账号（包括已禁用的账号）。
+    主处理函数：定期执行，只刷新到期的账号：
+    cookies即将过期的启用账号，以及到达退避重试时间的禁用账号。
     如果刷新成功，则重新启用账号。
     """
+    # 延迟导入，避免与 bulk_refresher 循环导入
+    from utils.bulk_refresher import refresh_accounts_async
+
     logger.info("开始执行批量刷新任务...")
 
     db = None
     try:
         db = next(get_db())
         
-        # 查询所有未删除的账号（包括已禁用的）
-        accounts = db.query(Token).filter(Token.deleted_at == None).all()
+        # 只查询到期账号的ID，负载与需要处理的账号数成正比
+        account_ids = find_due_accounts(db)
         
-        if not accounts:
+        if not account_ids:
             logger.info("没有账号需要刷新")
             return
             
-        logger.info(f"找到 {len(accounts)} 个账号需要刷新")
+        logger.info(f"找到 {len(account_ids)} 个账号需要刷新")
+        # 尽早归还数据库连接，刷新过程中每个账号使用独立的短会话
+        db.close()
+        db = None
         
-        # 创建线程池
-        with ThreadPoolExecutor(max_workers=MAX_WORKER_THREADS) as executor:
-            # 将每个账号的ID提交到线程池
-            for account in accounts:
-                executor.submit(refresh_single_account, account.id)
-                
-        logger.info(f"已完成 {len(accounts)} 个账号的刷新任务")
+        # 在独立的事件循环中并发刷新（限流、退避和统计见 bulk_refresher）
+        asyncio.run(refresh_accounts_async(account_ids))
 
     except Exception as e:
         logger.exception(f"批量刷新账号时发生错误: {str(e)}")
@@ -231,57 +283,55 @@ def check_and_refresh_accounts():
         if db:
             db.close()
 
+def reset_local_counts():
+    """
+    清零本进程内账号池的使用次数并丢弃未写回的使用次数
+    与 reset_account_counts 同时在每天0点执行，每个进程各自执行
+    """
+    discard_pending_usage()
+    normal_pool.reset_counts()
+    paid_pool.reset_counts()
+
 def reset_account_counts():
     """
     重置所有账号的使用次数（count字段）为0
     在每天24:00（午夜）执行
+
+    数据库和Redis各只需一次操作，耗时与账号数量基本无关；
+    由调度器的主实例执行，Redis任务锁再保证多个主实例（如Redis故障期间）也只执行一次；
+    进程内的账号池和写缓冲由 reset_local_counts 在每个进程中清零
     """
     logger.info("开始执行每日账号使用次数重置...")
     
-    db = None
+    redis_available = is_redis_healthy()
+    if redis_available:
+        try:
+            lock_name = f"reset_account_counts:{datetime.now().strftime('%Y-%m-%d')}"
+            if not acquire_task_lock(lock_name, DAILY_RESET_LOCK_TTL):
+                logger.info("其他副本已执行今日的使用次数重置，跳过")
+                return
+        except Exception as e:
+            # 拿不到锁时仍然执行：重置是幂等的，重复执行没有副作用
+            logger.error(f"获取每日重置锁失败: {str(e)}")
+    
     try:
-        db = next(get_db())
-        
-        # 查询所有启用且未删除的账号
-        accounts = (
-            db.query(Token)
-            .filter(Token.enable == 1, Token.deleted_at == None)
-            .all()
-        )
-        
-        if not accounts:
-            logger.info("没有需要重置的账号")
-            return
-            
-        # 重置所有账号的count为0
-        count = 0
-        for account in accounts:
-            if account.count > 0:
-                account.count = 0
-                count += 1
-                
-                # 同时更新Redis缓存
-                try:
-                    if test_redis_connection():
-                        account_data = token_to_dict(account)
-                        # 更新普通账号缓存
-                        cache_account(account.id, account_data, is_paid=False)
-                        # 如果是付费账号，也更新付费账号缓存
-                        if account.account_type == 'paid':
-                            cache_account(account.id, account_data, is_paid=True)
-                except Exception as e:
-                    logger.error(f"更新Redis缓存账号失败: {str(e)}")
-        
-        # 提交数据库更改
-        db.commit()
-        logger.info(f"成功重置 {count} 个账号的使用次数为0")
-        
+        with session_scope() as db:
+            result = db.execute(
+                update(Token)
+                .where(Token.enable == 1, Token.deleted_at == None, Token.count != 0)
+                .values(count=0)
+            )
+            db.commit()
+        logger.info(f"成功重置 {result.rowcount} 个账号的使用次数为0")
     except Exception as e:
         logger.exception(f"重置账号使用次数时发生错误: {str(e)}")
-    finally:
-        # 确保数据库连接被关闭
-        if db:
-            db.close()
+        return
+    
+    if redis_available:
+        try:
+            logger.info(f"已重置 {reset_cached_usage_counts()} 个Redis缓存账号的使用次数")
+        except Exception as e:
+            logger.error(f"重置Redis缓存使用次数失败: {str(e)}")
 
 # 标志位，用于控制run_scheduler函数中的循环
 _running = False
@@ -302,10 +352,11 @@ def run_scheduler():
     _running = True
     
     try:
-        # 每 10 分钟执行一次刷新任务
+        # 定期刷新到期的账号
         schedule.every(CHECK_INTERVAL_SECONDS).seconds.do(check_and_refresh_accounts)
         # 每天0点重置使用次数
         schedule.every().day.at("00:00").do(reset_account_counts)
+        schedule.every().day.at("00:00").do(reset_local_counts)
         
         logger.info(
             f"批量刷新调度器已启动，每 {CHECK_INTERVAL_SECONDS} 秒（{CHECK_INTERVAL_SECONDS/60} 分钟）执行一次"
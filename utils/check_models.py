@@ -5,13 +5,13 @@ import time
 import schedule
 import os
 import traceback
-import requests
 import re
 from sqlalchemy import desc
 from datetime import datetime
 from models.tokens import Token
 from db import get_db
 from sqlalchemy.orm import Session
+from utils.http_client import get_session
 
 # 配置日志
 logging.basicConfig(
@@ -60,7 +60,7 @@ def refresh_models():
         
         # 获取模型信息
         try:
-            response = requests.get("https://app.chatbetter.com/api/v1/models", headers=headers)
+            response = get_session().get("https://app.chatbetter.com/api/v1/models", headers=headers)
             if response.status_code == 200:
                 models_data = response.json()
                 
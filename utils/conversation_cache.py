@@ -0,0 +1,99 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from env import CONVERSATION_CACHE_TTL
+from utils.redis_cache import redis_client, KEY_PREFIX, is_redis_healthy
+
+# 会话亲和缓存：多轮对话的客户端每次都会带上完整历史，
+# 若 messages[:-1] 恰好是上一轮请求的 messages + 上一轮返回的回复，就可以在同一账号的同一个上游对话上
+# 直接 PATCH 新的一轮，省去 /api/v1/chats/new 以及整段历史的上传
+#   conversation:<sha256(model + 规范化后的消息)>  ->  {"account_id", "chat_id", "current_id"}
+# 条目带 TTL，被使用时即删除（同一前缀的并发请求/重新生成只有一个会复用，其余新建对话），
+# 本轮完成后再写入下一轮的条目
+CONVERSATION_KEY = f"{KEY_PREFIX}conversation:"
+
+
+def _normalize_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """只保留决定对话内容的字段：角色、文本和图片链接"""
+    content = message.get("content", "")
+    images = [item.get("url") for item in message.get("files", []) or [] if isinstance(item, dict)]
+    if isinstance(content, list):
+        text_parts = []
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "text":
+                text_parts.append(item.get("text", ""))
+            elif item.get("type") == "image_url":
+                images.append(item.get("image_url", {}).get("url") or item.get("url"))
+        content = "\n".join(text_parts)
+    return {"role": message.get("role", "user"), "content": content or "", "images": images}
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """规范化消息列表（需要在请求处理修改 messages 之前调用）"""
+    return [_normalize_message(message) for message in messages]
+
+
+def _conversation_key(normalized: List[Dict[str, Any]], model: str) -> str:
+    raw = json.dumps([model, normalized], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return CONVERSATION_KEY + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def claim_conversation(history: List[Dict[str, Any]], model: str) -> Optional[Dict[str, Any]]:
+    """
+    查找并占用可以继续的上游对话
+
+    Args:
+        history: 规范化后的历史消息（本次请求的 messages[:-1]）
+        model: 模型名称
+
+    Returns:
+        {"account_id", "chat_id", "current_id"}，没有可继续的对话时返回None
+    """
+    if CONVERSATION_CACHE_TTL <= 0 or not history or not is_redis_healthy():
+        return None
+    key = _conversation_key(history, model)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        value, _ = pipe.execute()
+    except Exception as e:
+        print(f"读取会话缓存失败: {str(e)}")
+        return None
+    return json.loads(value) if value else None
+
+
+def remember_conversation(
+    messages: List[Dict[str, Any]],
+    reply: str,
+    model: str,
+    account_id: int,
+    chat_id: str,
+    current_id: str,
+) -> None:
+    """
+    记录本轮结束后的上游对话，供下一轮请求继续
+
+    Args:
+        messages: 规范化后的本次请求消息
+        reply: 返回给客户端的完整回复
+        model: 模型名称
+        account_id: 对话所在的账号
+        chat_id: 上游对话ID
+        current_id: 本轮回复消息的ID（下一轮消息的 parentId）
+    """
+    if CONVERSATION_CACHE_TTL <= 0 or not is_redis_healthy():
+        return
+    history = messages + [{"role": "assistant", "content": reply or "", "images": []}]
+    value = json.dumps({
+        "account_id": account_id,
+        "chat_id": chat_id,
+        "current_id": current_id,
+    })
+    try:
+        redis_client.setex(_conversation_key(history, model), CONVERSATION_CACHE_TTL, value)
+    except Exception as e:
+        print(f"写入会话缓存失败: {str(e)}")
@@ -0,0 +1,88 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from env import (
+    PROXY_URL,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_POOL_MAXSIZE,
+    HTTP_MAX_RETRIES,
+    HTTP_RETRY_BACKOFF,
+)
+
+# 同步 HTTP 调用（ChatBetter / Frontegg / Outlook）共用的客户端：
+# - 每个主机一个连接池，复用 TCP/TLS 连接
+# - 默认超时，避免上游无响应时线程被永久占用
+# - 幂等请求（GET/HEAD/OPTIONS）在 429/5xx 和读超时时按指数退避重试；
+#   连接建立失败时请求尚未发出，所有方法都会重试
+# - 不保存任何 cookie，多个账号共用同一个会话也不会串用 cookie，
+#   需要 cookie 的调用通过 cookies 参数或 Cookie 请求头显式传入
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class _RejectAllCookies(DefaultCookiePolicy):
+    """拒绝把响应中的 cookie 写入会话（response.cookies 不受影响）"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class _PooledSession(requests.Session):
+    """未指定 timeout 时使用默认超时的会话"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES,
+        status=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+        respect_retry_after_header=True,
+        # 重试用尽后返回最后一次响应，由调用方按状态码处理
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+
+    session = _PooledSession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.cookies.set_policy(_RejectAllCookies())
+    if PROXY_URL:
+        session.proxies = {"http": PROXY_URL, "https": PROXY_URL}
+    return session
+
+
+def close_session():
+    """关闭共享会话及其连接池（停机时调用）"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session() -> requests.Session:
+    """获取共享的 HTTP 会话（线程安全，首次调用时创建）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
@@ -0,0 +1,377 @@
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from env import (
+    JOB_WORKER_CONCURRENCY,
+    JOB_LEASE_SECONDS,
+    JOB_POLL_INTERVAL,
+    JOB_MAX_ATTEMPTS,
+    TASK_STATUS_TTL,
+)
+from utils import task_status
+from utils.redis_cache import redis_client, KEY_PREFIX, is_redis_healthy
+
+# 基于 Redis 的后台作业队列（批量注册、批量刷新）：
+#   jobs:queue    LIST  待执行的作业ID，LPUSH 入队、RPOP 取出，超时重新入队的作业 RPUSH 回队首优先执行
+#   jobs:running  ZSET  执行中的作业ID -> 租约到期时间，worker 定期续约
+#   job:<id>      HASH  kind/payload/attempts/status/worker
+#   job:<id>:done SET   已处理完成的条目，作业重新执行时跳过
+# worker 崩溃或失联后租约过期，下一个取作业的 worker 会把它重新放回队列，从未完成的条目继续执行
+# 每次领取都会增加 attempts，worker 以 (作业ID, attempts) 标识自己持有的租约：
+# 续约和完成时租约已被接管（不在执行中集合，或 attempts/worker 已变化）的作业视为丢失，不再续约也不标记完成，
+# 执行中的处理函数通过 JobContext.cancelled() 得知后停止处理剩余条目
+# 作业ID与任务状态（utils.task_status）的任务ID相同，进度直接写入任务状态
+JOB_QUEUE_KEY = f"{KEY_PREFIX}jobs:queue"
+JOB_RUNNING_KEY = f"{KEY_PREFIX}jobs:running"
+JOB_KEY = f"{KEY_PREFIX}job:"
+
+# KEYS[1]: 队列，KEYS[2]: 执行中集合
+# ARGV[1]: 当前时间，ARGV[2]: 新租约到期时间，ARGV[3]: 作业键前缀，ARGV[4]: worker 标识
+# 先把租约过期的作业放回队首，再取出一个作业并登记租约，返回 {作业ID, attempts}
+_CLAIM_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job_id in ipairs(expired) do
+    redis.call('zrem', KEYS[2], job_id)
+    redis.call('rpush', KEYS[1], job_id)
+end
+local job_id = redis.call('rpop', KEYS[1])
+if not job_id then
+    return nil
+end
+redis.call('zadd', KEYS[2], ARGV[2], job_id)
+local attempts = redis.call('hincrby', ARGV[3] .. job_id, 'attempts', 1)
+redis.call('hset', ARGV[3] .. job_id, 'status', 'running', 'worker', ARGV[4])
+return {job_id, attempts}
+"""
+
+# 租约仍由本 worker 的这次领取持有：在执行中集合里，且 worker/attempts 未变化
+_OWNS_LEASE = """
+local function owns(job_id, attempts)
+    if not redis.call('zscore', KEYS[1], job_id) then
+        return false
+    end
+    local job = redis.call('hmget', ARGV[1] .. job_id, 'worker', 'attempts')
+    return job[1] == ARGV[2] and job[2] == attempts
+end
+"""
+
+# KEYS[1]: 执行中集合
+# ARGV[1]: 作业键前缀，ARGV[2]: worker 标识，ARGV[3]: 新租约到期时间，ARGV[4..]: 作业ID、attempts 交替
+# 续约仍持有的租约，返回已丢失租约的作业ID
+_RENEW_SCRIPT = _OWNS_LEASE + """
+local lost = {}
+for i = 4, #ARGV, 2 do
+    if owns(ARGV[i], ARGV[i + 1]) then
+        redis.call('zadd', KEYS[1], ARGV[3], ARGV[i])
+    else
+        table.insert(lost, ARGV[i])
+    end
+end
+return lost
+"""
+
+# KEYS[1]: 执行中集合
+# ARGV[1]: 作业键前缀，ARGV[2]: worker 标识，ARGV[3]: 作业ID，ARGV[4]: attempts，ARGV[5]: 结束状态，ARGV[6]: 保留时间
+# 仍持有租约时移出执行中集合并记录结束状态，返回1；租约已丢失返回0
+_COMPLETE_SCRIPT = _OWNS_LEASE + """
+if not owns(ARGV[3], ARGV[4]) then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[3])
+redis.call('hset', ARGV[1] .. ARGV[3], 'status', ARGV[5])
+redis.call('expire', ARGV[1] .. ARGV[3], ARGV[6])
+redis.call('expire', ARGV[1] .. ARGV[3] .. ':done', ARGV[6])
+return 1
+"""
+
+_claim_script = redis_client.register_script(_CLAIM_SCRIPT)
+_renew_script = redis_client.register_script(_RENEW_SCRIPT)
+_complete_script = redis_client.register_script(_COMPLETE_SCRIPT)
+
+# 作业处理函数：kind -> fn(JobContext)
+_handlers: Dict[str, Callable[["JobContext"], None]] = {}
+
+
+def job_handler(kind: str):
+    """注册作业处理函数的装饰器"""
+    def decorator(fn):
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def _get_handler(kind: str) -> Optional[Callable[["JobContext"], None]]:
+    # 处理函数定义在 utils.jobs 中，延迟导入避免循环依赖
+    import utils.jobs  # noqa: F401
+    return _handlers.get(kind)
+
+
+def _job_key(job_id: str) -> str:
+    return f"{JOB_KEY}{job_id}"
+
+
+def _done_key(job_id: str) -> str:
+    return f"{JOB_KEY}{job_id}:done"
+
+
+class JobContext:
+    """
+    作业执行上下文：读取参数、上报进度、记录已完成的条目
+    租约被其他 worker 接管后 cancelled() 返回 True，处理函数应尽快停止，之后的进度不再上报
+    """
+
+    def __init__(self, job_id: str, kind: str, payload: Dict[str, Any], durable: bool = True,
+                 lease_lost: Optional[Callable[[], bool]] = None):
+        self.job_id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.durable = durable
+        self._lease_lost = lease_lost
+        self._local_done = set()
+
+    def cancelled(self) -> bool:
+        """租约是否已被其他 worker 接管"""
+        return bool(self._lease_lost and self._lease_lost())
+
+    def done_items(self) -> set:
+        """之前的执行中已经完成的条目（作业重新执行时跳过）"""
+        if not self.durable:
+            return set(self._local_done)
+        try:
+            return redis_client.smembers(_done_key(self.job_id))
+        except Exception as e:
+            print(f"读取作业 {self.job_id} 已完成条目失败: {str(e)}")
+            return set()
+
+    def report(self, item: Any, detail: str, success: Optional[bool] = None):
+        """上报条目进度；success 不为 None 时条目视为已完成。租约已丢失时忽略，由接管的 worker 上报"""
+        if self.cancelled():
+            return
+        task_status.report_item(self.job_id, item, detail, success)
+        if success is None:
+            return
+        if not self.durable:
+            self._local_done.add(str(item))
+            return
+        try:
+            pipe = redis_client.pipeline()
+            pipe.sadd(_done_key(self.job_id), str(item))
+            pipe.expire(_done_key(self.job_id), TASK_STATUS_TTL)
+            pipe.execute()
+        except Exception as e:
+            print(f"记录作业 {self.job_id} 完成条目失败: {str(e)}")
+
+
+def _run_inline(job_id: str, kind: str, payload: Dict[str, Any]):
+    """Redis 不可用时在当前进程的后台线程中直接执行作业（不支持崩溃后恢复）"""
+    handler = _get_handler(kind)
+    if handler is None:
+        print(f"未知的作业类型: {kind}")
+        task_status.finish_task(job_id, "failed")
+        return
+
+    def run():
+        try:
+            handler(JobContext(job_id, kind, payload, durable=False))
+            task_status.finish_task(job_id)
+        except Exception as e:
+            print(f"执行作业 {job_id} 失败: {str(e)}")
+            task_status.finish_task(job_id, "failed")
+
+    threading.Thread(target=run, name=f"job-{kind}", daemon=True).start()
+
+
+def enqueue_job(job_id: str, kind: str, payload: Dict[str, Any]) -> bool:
+    """
+    提交作业，由 worker 进程执行
+
+    Args:
+        job_id: 作业ID（同时也是任务状态的任务ID，调用前应先 task_status.create_task）
+        kind: 作业类型
+        payload: 作业参数，必须可JSON序列化
+
+    Returns:
+        进入Redis队列返回True；Redis不可用、在当前进程内执行时返回False
+    """
+    if is_redis_healthy():
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(_job_key(job_id), mapping={
+                "kind": kind,
+                "payload": json.dumps(payload, ensure_ascii=False),
+                "attempts": 0,
+                "status": "queued",
+                "created_at": int(time.time()),
+            })
+            pipe.lpush(JOB_QUEUE_KEY, job_id)
+            pipe.execute()
+            return True
+        except Exception as e:
+            print(f"作业入队失败，在当前进程内执行: {str(e)}")
+    _run_inline(job_id, kind, payload)
+    return False
+
+
+class JobWorker:
+    """
+    从Redis队列中取出作业并执行，每个进程同时执行 concurrency 个作业
+    执行期间后台线程定期续约，进程退出或失联后作业会被其他 worker 接管
+    """
+
+    def __init__(self, concurrency: int = JOB_WORKER_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # 执行中的作业ID -> 领取时的 attempts
+        self._running: Dict[str, int] = {}
+        # 租约已被其他 worker 接管的作业
+        self._lost: Set[Tuple[str, int]] = set()
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+        # 停机等待期间仍需续约，作业全部结束或释放后才停止续约
+        self._closed = threading.Event()
+
+    def _claim(self) -> Optional[Tuple[str, int]]:
+        now = time.time()
+        claimed = _claim_script(
+            keys=[JOB_QUEUE_KEY, JOB_RUNNING_KEY],
+            args=[now, now + JOB_LEASE_SECONDS, JOB_KEY, self.worker_id],
+        )
+        if not claimed:
+            return None
+        return claimed[0], int(claimed[1])
+
+    def _renew_leases(self):
+        """续约本进程执行中的作业；租约已被接管的作业标记为丢失"""
+        while not self._closed.wait(JOB_LEASE_SECONDS / 3):
+            with self._running_lock:
+                running = list(self._running.items())
+            if not running:
+                continue
+            args = [JOB_KEY, self.worker_id, time.time() + JOB_LEASE_SECONDS]
+            for job_id, attempts in running:
+                args.extend([job_id, attempts])
+            try:
+                lost = set(_renew_script(keys=[JOB_RUNNING_KEY], args=args))
+            except Exception as e:
+                print(f"作业续约失败: {str(e)}")
+                continue
+            for job_id, attempts in running:
+                if job_id in lost and (job_id, attempts) not in self._lost:
+                    print(f"[Worker] 作业 {job_id} 的租约已被其他 worker 接管，停止执行")
+                    self._lost.add((job_id, attempts))
+
+    def _complete(self, job_id: str, attempts: int, status: str):
+        """仍持有租约时记录作业结束；租约已丢失时由接管的 worker 负责，这里不做任何修改"""
+        owned = _complete_script(
+            keys=[JOB_RUNNING_KEY],
+            args=[JOB_KEY, self.worker_id, job_id, attempts, status, TASK_STATUS_TTL],
+        )
+        if not owned:
+            print(f"[Worker] 作业 {job_id} 的租约已丢失，不记录结束状态（{status}）")
+            return
+        task_status.finish_task(job_id, status)
+
+    def _execute(self, job_id: str, attempts: int):
+        job = redis_client.hgetall(_job_key(job_id))
+        kind = job.get("kind")
+        handler = _get_handler(kind) if kind else None
+        if handler is None:
+            print(f"[Worker] 作业 {job_id} 类型未知或数据已过期: {kind}")
+            self._complete(job_id, attempts, "failed")
+            return
+        if attempts > JOB_MAX_ATTEMPTS:
+            print(f"[Worker] 作业 {job_id} 已执行 {attempts - 1} 次仍未完成，放弃")
+            self._complete(job_id, attempts, "failed")
+            return
+
+        if attempts > 1:
+            print(f"[Worker] 恢复执行作业 {job_id}（{kind}，第 {attempts} 次）")
+        else:
+            print(f"[Worker] 开始执行作业 {job_id}（{kind}）")
+        try:
+            handler(JobContext(
+                job_id, kind, json.loads(job.get("payload") or "{}"),
+                lease_lost=lambda: (job_id, attempts) in self._lost,
+            ))
+        except Exception as e:
+            print(f"[Worker] 作业 {job_id} 执行失败: {str(e)}")
+            self._complete(job_id, attempts, "failed")
+            return
+        self._complete(job_id, attempts, "completed")
+        print(f"[Worker] 作业 {job_id} 完成")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                print(f"[Worker] 获取作业失败: {str(e)}")
+                self._stop.wait(JOB_POLL_INTERVAL * 5)
+                continue
+            if not claimed:
+                self._stop.wait(JOB_POLL_INTERVAL)
+                continue
+
+            job_id, attempts = claimed
+            with self._running_lock:
+                self._running[job_id] = attempts
+            try:
+                self._execute(job_id, attempts)
+            except Exception as e:
+                print(f"[Worker] 处理作业 {job_id} 时发生错误: {str(e)}")
+            finally:
+                with self._running_lock:
+                    if self._running.get(job_id) == attempts:
+                        del self._running[job_id]
+                self._lost.discard((job_id, attempts))
+
+    def start(self):
+        """在后台线程中启动（用于 API 进程内嵌 worker）"""
+        threading.Thread(target=self._renew_leases, name="job-lease", daemon=True).start()
+        for i in range(self.concurrency):
+            threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True).start()
+
+    def run(self, shutdown_timeout: float = 0):
+        """在当前线程阻塞运行，直到 stop 被调用，然后最多等待 shutdown_timeout 秒让作业结束"""
+        print(f"[Worker] {self.worker_id} 已启动，并发作业数 {self.concurrency}")
+        self.start()
+        while not self._stop.wait(1):
+            pass
+        self.drain(shutdown_timeout)
+
+    def stop(self):
+        """停止领取新作业（可在信号处理函数中调用）"""
+        self._stop.set()
+
+    def drain(self, timeout: float):
+        """
+        停止领取新作业并等待执行中的作业结束；超时仍未结束的作业立即释放租约，
+        由其他 worker 接管并跳过已完成的条目继续执行
+        """
+        self.stop()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._running_lock:
+                if not self._running:
+                    break
+            time.sleep(0.5)
+        self._closed.set()
+
+        with self._running_lock:
+            job_ids = list(self._running)
+        if not job_ids:
+            return
+        print(f"[Worker] 停机时仍有 {len(job_ids)} 个作业未完成，释放租约: {', '.join(job_ids)}")
+        try:
+            pipe = redis_client.pipeline()
+            # 租约到期时间置为0，下一次领取时重新入队
+            pipe.zadd(JOB_RUNNING_KEY, {job_id: 0 for job_id in job_ids}, xx=True)
+            for job_id in job_ids:
+                pipe.hset(_job_key(job_id), "status", "queued")
+            pipe.execute()
+        except Exception as e:
+            print(f"[Worker] 释放作业租约失败: {str(e)}")
@@ -0,0 +1,56 @@
+import asyncio
+
+from db import session_scope
+from models.tokens import Token
+from utils.bulk_refresher import BulkRefresher, create_http_client
+from utils.job_queue import JobContext, job_handler
+from utils.register_pipeline import run_registrations
+
+# 后台作业的处理函数，由 worker 进程（或 Redis 不可用时的 API 进程）执行
+# 作业可能在崩溃后重新执行，处理函数需跳过 ctx.done_items() 中已完成的条目，
+# 并在 ctx.cancelled()（租约已被其他 worker 接管）后停止处理剩余条目
+
+
+@job_handler("register")
+def run_register_job(ctx: JobContext):
+    """批量注册：payload = {"items": [{account, password, token, uuid}, ...], "thread_count": n}"""
+    done = ctx.done_items()
+    email_data = [item for item in ctx.payload.get("items", []) if str(item.get("account")) not in done]
+    # HTTP阶段（注册/激活）的并发数，限制在1-20之间；等待邮件的邮箱数不受此限制
+    thread_count = min(20, max(1, int(ctx.payload.get("thread_count", 5))))
+    print(f"[Register] 任务 {ctx.job_id}: 待处理 {len(email_data)} 个邮箱（已完成 {len(done)} 个），注册/激活阶段并发 {thread_count}")
+    run_registrations(email_data, thread_count, ctx.report, ctx.cancelled)
+    if ctx.cancelled():
+        print(f"[Register] 任务 {ctx.job_id} 的租约已被接管，提前结束")
+
+
+@job_handler("batch_refresh")
+def run_refresh_job(ctx: JobContext):
+    """
+    批量刷新：payload = {"include_disabled": bool, "thread_count": n, "disable_failed": bool}
+    disable_failed 默认为 False：手动触发的批量刷新只报告失败，不禁用账号
+    """
+    with session_scope() as db:
+        query = db.query(Token.id).filter(Token.deleted_at == None)
+        if not ctx.payload.get("include_disabled"):
+            query = query.filter(Token.enable == 1)
+        account_ids = [row[0] for row in query.all()]
+
+    done = ctx.done_items()
+    account_ids = [account_id for account_id in account_ids if str(account_id) not in done]
+    concurrency = min(20, max(1, int(ctx.payload.get("thread_count", 5))))
+    disable_failed = bool(ctx.payload.get("disable_failed", False))
+    print(f"[BatchRefresh] 任务 {ctx.job_id}: 待刷新 {len(account_ids)} 个账号（已完成 {len(done)} 个），并发 {concurrency}")
+
+    def on_result(account_id: int, success: bool):
+        ctx.report(account_id, "刷新成功" if success else "刷新失败", success)
+
+    async def sweep():
+        async with create_http_client() as client:
+            return await BulkRefresher(client, concurrency, disable_failed).sweep(account_ids, on_result, ctx.cancelled)
+
+    stats = asyncio.run(sweep())
+    if ctx.cancelled():
+        print(f"[BatchRefresh] 任务 {ctx.job_id} 的租约已被接管，提前结束，跳过 {stats['skipped']} 个账号")
+        return
+    print(f"[BatchRefresh] 任务 {ctx.job_id} 完成: 成功 {stats['success']}, 失败 {stats['failed']}, 耗时 {stats['duration']} 秒")
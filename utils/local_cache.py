@@ -0,0 +1,127 @@
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple
+
+from env import ACCOUNT_L1_CACHE_TTL
+from utils.redis_cache import redis_client, INVALIDATION_CHANNEL, publish_account_invalidation
+
+# 进程内 L1 账号缓存：account_id -> (写入时间, CachedAccount)
+# 请求链路挑选账号时优先从这里取，避免每次都回表查询 MySQL
+_l1_cache: Dict[int, Tuple[float, "CachedAccount"]] = {}
+_l1_lock = threading.Lock()
+
+# 订阅线程
+_listener_thread = None
+
+
+class CachedAccount:
+    """进程内缓存的账号记录，只包含请求链路需要的字段"""
+
+    __slots__ = ("id", "account", "token", "access_token", "account_type", "enable", "count")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_token(cls, token) -> "CachedAccount":
+        """从 Token ORM 对象构造缓存记录"""
+        return cls(**{name: getattr(token, name, None) for name in cls.__slots__})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def copy(self) -> "CachedAccount":
+        return CachedAccount(**self.to_dict())
+
+    def __repr__(self):
+        return f"CachedAccount({self.id}, {self.account})"
+
+
+def get_local_account(account_id: int) -> Optional[CachedAccount]:
+    """
+    从L1缓存读取账号记录
+
+    Returns:
+        账号记录的副本，未命中或已过期返回None
+    """
+    with _l1_lock:
+        entry = _l1_cache.get(account_id)
+        if not entry:
+            return None
+        cached_at, record = entry
+        if time.time() - cached_at > ACCOUNT_L1_CACHE_TTL:
+            _l1_cache.pop(account_id, None)
+            return None
+        # 返回副本，避免调用方修改共享对象
+        return record.copy()
+
+
+def put_local_account(record: CachedAccount) -> None:
+    """写入L1缓存"""
+    if record is None or record.id is None:
+        return
+    with _l1_lock:
+        _l1_cache[record.id] = (time.time(), record.copy())
+
+
+def evict_local_account(account_id: int) -> None:
+    """仅从本进程的L1缓存中移除账号"""
+    with _l1_lock:
+        _l1_cache.pop(account_id, None)
+
+
+def clear_local_accounts() -> None:
+    """清空本进程的L1缓存"""
+    with _l1_lock:
+        _l1_cache.clear()
+
+
+def invalidate_account(account_id: int) -> None:
+    """
+    账号信息发生变更后调用：先清除本进程缓存，再通过Redis通知其他副本
+
+    Args:
+        account_id: 发生变更的账号ID
+    """
+    if account_id is None:
+        return
+    evict_local_account(account_id)
+    publish_account_invalidation(account_id)
+
+
+def _listen_invalidations():
+    """订阅失效通知并清除对应的L1缓存，连接断开后自动重连"""
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # 断线期间可能漏掉通知，重新订阅后清空整个L1缓存
+            clear_local_accounts()
+            for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    evict_local_account(int(message.get("data")))
+                except (TypeError, ValueError):
+                    # 无法识别的消息按全量失效处理
+                    clear_local_accounts()
+        except Exception as e:
+            print(f"账号缓存失效订阅异常: {str(e)}")
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        time.sleep(5)
+
+
+def start_invalidation_listener():
+    """启动失效通知订阅线程（每个进程只启动一次）"""
+    global _listener_thread
+    if _listener_thread is not None and _listener_thread.is_alive():
+        return
+    _listener_thread = threading.Thread(target=_listen_invalidations, daemon=True)
+    _listener_thread.start()
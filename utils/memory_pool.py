@@ -0,0 +1,133 @@
+import heapq
+import threading
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+
+from env import MEMORY_POOL_LOAD_BATCH
+from models.tokens import Token
+from utils.local_cache import CachedAccount, put_local_account
+
+
+class MemoryAccountPool:
+    """
+    进程内账号池，按使用次数组织成最小堆
+    用于单节点部署或Redis不可用时挑选账号
+
+    堆中只保存 (使用次数, 账号ID) 元组，账号详情放在L1缓存中；
+    被移除或计数已变化的堆元素在弹出时惰性丢弃
+    """
+
+    def __init__(self, paid_only: bool = False):
+        self.paid_only = paid_only
+        self._heap: List[Tuple[int, int]] = []
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._counts)
+
+    def reload(self, db: Session) -> int:
+        """
+        从数据库分批加载可用账号并整体替换当前的堆
+
+        Args:
+            db: 数据库会话
+
+        Returns:
+            加载的账号数量
+        """
+        counts: Dict[int, int] = {}
+        last_id = 0
+        while True:
+            query = db.query(
+                Token.id, Token.account, Token.token, Token.access_token,
+                Token.account_type, Token.enable, Token.count
+            ).filter(Token.enable == 1, Token.deleted_at == None, Token.id > last_id)
+            if self.paid_only:
+                query = query.filter(Token.account_type == 'paid')
+            rows = query.order_by(Token.id.asc()).limit(MEMORY_POOL_LOAD_BATCH).all()
+            if not rows:
+                break
+            for row in rows:
+                counts[row.id] = row.count or 0
+                # 顺便预热L1缓存，挑选账号时无需再回表
+                put_local_account(CachedAccount(**row._asdict()))
+            last_id = rows[-1].id
+            if len(rows) < MEMORY_POOL_LOAD_BATCH:
+                break
+
+        heap = [(count, account_id) for account_id, count in counts.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._counts = counts
+            self.loaded = True
+        return len(counts)
+
+    def acquire(self) -> Optional[int]:
+        """
+        取出使用次数最少的账号ID，并将其使用次数加一
+
+        Returns:
+            账号ID，池为空时返回None
+        """
+        with self._lock:
+            while self._heap:
+                count, account_id = self._heap[0]
+                if self._counts.get(account_id) != count:
+                    # 已移除或已过时的元素，直接丢弃
+                    heapq.heappop(self._heap)
+                    continue
+                self._counts[account_id] = count + 1
+                heapq.heapreplace(self._heap, (count + 1, account_id))
+                return account_id
+            return None
+
+    def add(self, account_id: int, count: int = 0):
+        """加入或更新一个账号"""
+        with self._lock:
+            self._counts[account_id] = count
+            heapq.heappush(self._heap, (count, account_id))
+
+    def remove(self, account_id: int):
+        """移除账号（堆中的旧元素会在弹出时丢弃）"""
+        with self._lock:
+            self._counts.pop(account_id, None)
+            # 惰性删除积累过多时重建堆，保持内存紧凑
+            if len(self._heap) > 2 * len(self._counts) + 64:
+                self._heap = [(count, account_id) for account_id, count in self._counts.items()]
+                heapq.heapify(self._heap)
+
+    def reset_counts(self):
+        """将所有账号的使用次数清零"""
+        with self._lock:
+            self._counts = {account_id: 0 for account_id in self._counts}
+            self._heap = [(0, account_id) for account_id in self._counts]
+            heapq.heapify(self._heap)
+
+
+# 普通账号池与付费账号池
+normal_pool = MemoryAccountPool(paid_only=False)
+paid_pool = MemoryAccountPool(paid_only=True)
+
+
+def get_memory_pool(is_paid: bool = False) -> MemoryAccountPool:
+    return paid_pool if is_paid else normal_pool
+
+
+def refresh_memory_pools(db: Session) -> bool:
+    """刷新内存账号池"""
+    try:
+        normal_pool.reload(db)
+        paid_pool.reload(db)
+        return True
+    except Exception as e:
+        print(f"刷新内存账号池失败: {str(e)}")
+        return False
+
+
+def remove_from_memory_pools(account_id: int):
+    """从所有内存账号池中移除账号"""
+    normal_pool.remove(account_id)
+    paid_pool.remove(account_id)
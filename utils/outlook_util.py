@@ -1,14 +1,22 @@
+import asyncio
 import base64
 import time
 import email
 import re
-import requests
 import imaplib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from email.header import decode_header
 from bs4 import BeautifulSoup
-from typing import List, Dict, Tuple, Optional
+from typing import Iterator, List, Dict, Tuple, Optional
 import os
 
+from utils.http_client import get_session
+from utils.redis_cache import redis_client, KEY_PREFIX
+
 # ----------- 配置 -----------
 _OUTLOOK_IMAP_SERVER = "outlook.office365.com"
 _CHATBETTER_TITLE_KEY = "ChatBetter"
@@ -16,6 +24,13 @@ _MAGIC_LINK_PREFIX = "https://auth.chatbetter.com/oauth/account/activate"
 _LOGIN_MAGIC_LINK_PREFIX = "https://auth.chatbetter.com/oauth/account/login/magic-link"
 _LUNXUN = 15
 _MAIL_TIMEOUT = 3   # 每次查询验证码时的等待时间
+_POLL_INITIAL_WAIT = 8   # 邮件到达通常需要几秒，计入轮询总时长
+_MAIL_FOLDERS = ["INBOX", "Junk", "Junk Email", "Spam", "Bulk Mail", "Clutter"]
+_MAX_FETCH_PER_FOLDER = 20   # 每个文件夹每轮最多检查的新邮件数
+_TOKEN_EXPIRY_MARGIN = 300   # access token 提前过期的安全余量（秒）
+_TOKEN_CACHE_MAX = 4096   # access token 缓存的最大条目数，超出时淘汰最久未使用的
+_ROTATED_TOKEN_KEY = f"{KEY_PREFIX}outlook_refresh_token:"   # 轮换后的 refresh token
+_ROTATED_TOKEN_TTL = 90 * 24 * 3600
 
 # ----------- 解码辅助 -----------
 def _safe_decode(payload: bytes, charset: str = "utf-8", errors: str = "ignore") -> str:
@@ -29,22 +44,136 @@ def _safe_decode(payload: bytes, charset: str = "utf-8", errors: str = "ignore")
             return payload.decode("latin-1", errors)
 
 
-def _get_access_token(client_id: str, refresh_token: str) -> Optional[str]:
-    """使用刷新令牌换取 access token。"""
+# access token 缓存：(client_id, refresh_token) -> (access_token, 过期时间戳)
+# 注册线程之间共享，同一邮箱的多次轮询/多个流程只需换取一次；
+# 按最近使用排序，写入时清理已过期的条目，仍超过 _TOKEN_CACHE_MAX 时淘汰最久未使用的
+_token_cache: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+# 正在换取 token 的 (client_id, refresh_token) -> [锁, 使用中的线程数]，避免多个线程同时换取同一个 token；
+# 没有线程使用时立即移除
+_token_fetch_locks: Dict[Tuple[str, str], list] = {}
+
+
+@contextmanager
+def _fetching(key: Tuple[str, str]) -> Iterator[None]:
+    with _token_cache_lock:
+        entry = _token_fetch_locks.get(key)
+        if entry is None:
+            entry = _token_fetch_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _token_cache_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _token_fetch_locks[key]
+
+
+def _cached_token(key: Tuple[str, str]) -> Optional[str]:
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is None:
+            return None
+        if cached[1] <= time.time():
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return cached[0]
+
+
+def _store_token(key: Tuple[str, str], access_token: str, expires_at: float):
+    """写入缓存（调用方持有 _token_cache_lock）"""
+    _token_cache[key] = (access_token, expires_at)
+    _token_cache.move_to_end(key)
+    if len(_token_cache) <= _TOKEN_CACHE_MAX:
+        return
+    now = time.time()
+    for expired in [k for k, (_, expiry) in _token_cache.items() if expiry <= now]:
+        del _token_cache[expired]
+    while len(_token_cache) > _TOKEN_CACHE_MAX:
+        _token_cache.popitem(last=False)
+
+
+def _load_rotated_refresh_token(account: "OutlookAccount") -> Optional[str]:
+    """读取之前保存的轮换后的 refresh token"""
+    try:
+        return redis_client.get(f"{_ROTATED_TOKEN_KEY}{account.client_id}:{account.email.lower()}")
+    except Exception:
+        return None
+
+
+def _save_rotated_refresh_token(account: "OutlookAccount", refresh_token: str):
+    """保存微软返回的新 refresh token，之后的流程优先使用"""
+    try:
+        redis_client.setex(
+            f"{_ROTATED_TOKEN_KEY}{account.client_id}:{account.email.lower()}",
+            _ROTATED_TOKEN_TTL,
+            refresh_token,
+        )
+    except Exception as e:
+        print(f"[Outlook] 保存新的 refresh_token 失败: {e}")
+
+
+def _request_access_token(client_id: str, refresh_token: str) -> Optional[dict]:
+    """调用微软令牌接口，返回响应 JSON"""
     data = {
         "client_id": client_id,
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
     }
     try:
-        resp = requests.post("https://login.live.com/oauth20_token.srf", data=data, timeout=15)
+        resp = get_session().post("https://login.live.com/oauth20_token.srf", data=data, timeout=15)
         resp.raise_for_status()
-        return resp.json().get("access_token")
+        result = resp.json()
+        return result if result.get("access_token") else None
     except Exception as e:
         print(f"[Outlook] 获取 access_token 失败: {e}")
         return None
 
 
+def _get_access_token(account: "OutlookAccount") -> Optional[str]:
+    """
+    使用刷新令牌换取 access token（带缓存）
+
+    缓存按 expires_in 减去安全余量过期；微软返回新的 refresh token 时
+    更新 account 并保存，之后的流程使用新的 refresh token
+    """
+    key = (account.client_id, account.refresh_token)
+    access_token = _cached_token(key)
+    if access_token:
+        return access_token
+
+    with _fetching(key):
+        # 等锁期间其他线程可能已经换取成功
+        access_token = _cached_token(key)
+        if access_token:
+            return access_token
+
+        candidates = [account.refresh_token]
+        rotated = _load_rotated_refresh_token(account)
+        if rotated and rotated != account.refresh_token:
+            candidates.insert(0, rotated)
+
+        for refresh_token in candidates:
+            result = _request_access_token(account.client_id, refresh_token)
+            if not result:
+                continue
+            access_token = result["access_token"]
+            expires_at = time.time() + max(0, int(result.get("expires_in", 3600)) - _TOKEN_EXPIRY_MARGIN)
+            new_refresh_token = result.get("refresh_token") or refresh_token
+            with _token_cache_lock:
+                # 原始的和新的 refresh token 都指向同一个 access token
+                _store_token(key, access_token, expires_at)
+                _store_token((account.client_id, new_refresh_token), access_token, expires_at)
+            if new_refresh_token != account.refresh_token:
+                account.refresh_token = new_refresh_token
+                _save_rotated_refresh_token(account, new_refresh_token)
+            return access_token
+        return None
+
+
 def _generate_auth_string(user: str, token: str) -> str:
     auth_string = f"user={user}\1auth=Bearer {token}\1\1"
     return auth_string
@@ -142,6 +271,151 @@ def _process_email(msg, expected_recipient: str) -> Tuple[Optional[str], bool]:
     return None, recipient_match
 
 
+# --------------------------------- IMAP 会话 ---------------------------------
+
+class _MailboxSession:
+    """
+    单个邮箱的持久 IMAP 会话
+
+    - 只登录一次，文件夹列表只查询一次
+    - 使用服务端 SEARCH 过滤 ChatBetter 邮件，先取邮件头核对收件人，只下载匹配邮件的正文
+    - 已检查过的邮件不再重复下载（每轮只检查最新的 _MAX_FETCH_PER_FOLDER 封，其余留到下一轮）
+    - 等待新邮件使用标准库的 IMAP4.idle（Python 3.14+），不支持时按 _MAIL_TIMEOUT 间隔轮询
+    """
+
+    def __init__(self, account: "OutlookAccount"):
+        self.account = account
+        self.mail: Optional[imaplib.IMAP4_SSL] = None
+        self.folders: List[str] = []
+        self.supports_idle = False
+        self._seen: Dict[str, set] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self.mail is not None
+
+    def connect(self) -> bool:
+        """建立连接并完成 XOAUTH2 认证"""
+        access_token = _get_access_token(self.account)
+        if not access_token:
+            return False
+        mail = imaplib.IMAP4_SSL(_OUTLOOK_IMAP_SERVER)
+        mail.authenticate("XOAUTH2", lambda x: _generate_auth_string(self.account.email, access_token).encode())
+        self.mail = mail
+        self.supports_idle = hasattr(mail, "idle") and "IDLE" in mail.capabilities
+        self.folders = self._list_folders()
+        return True
+
+    def close(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except Exception:
+            pass
+        self.mail = None
+
+    def _list_folders(self) -> List[str]:
+        """返回邮箱中实际存在的待检查文件夹"""
+        try:
+            status, data = self.mail.list()
+        except Exception:
+            status, data = "NO", []
+        if status != "OK":
+            return ["INBOX"]
+        existing = {}
+        for line in data:
+            if not isinstance(line, bytes):
+                continue
+            match = re.search(rb'"?([^"]+)"?\s*$', line)
+            if match:
+                name = match.group(1).decode("utf-8", errors="ignore").strip()
+                existing[name.lower()] = name
+        folders = [existing[name.lower()] for name in _MAIL_FOLDERS if name.lower() in existing]
+        return folders or ["INBOX"]
+
+    def _search(self) -> List[bytes]:
+        """在当前文件夹中搜索最近的 ChatBetter 邮件，返回 UID 列表"""
+        since = (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
+        status, data = self.mail.uid(
+            "SEARCH", None, "SINCE", since,
+            "OR", "OR", "FROM", '"chatbetter"', "SUBJECT", f'"{_CHATBETTER_TITLE_KEY}"', "BODY", '"auth.chatbetter.com"'
+        )
+        if status != "OK" or not data or not data[0]:
+            return []
+        return data[0].split()
+
+    def _matching_uids(self, uids: List[bytes]) -> List[bytes]:
+        """只取邮件头，筛选出收件人匹配的邮件 UID（按 UID 从新到旧）"""
+        status, data = self.mail.uid("FETCH", b",".join(uids), "(UID BODY.PEEK[HEADER.FIELDS (TO)])")
+        if status != "OK":
+            return []
+        expected = self.account.email.lower()
+        matched = []
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            uid_match = re.search(rb"UID (\d+)", item[0])
+            if not uid_match:
+                continue
+            to_field = email.message_from_bytes(item[1]).get("To", "")
+            if any(expected in r.strip().lower() for r in re.split(r",|;", to_field)):
+                matched.append(uid_match.group(1))
+        return sorted(matched, key=int, reverse=True)
+
+    def find_link(self, link_prefix: str) -> Optional[str]:
+        """在所有文件夹中查找包含指定前缀链接的新邮件"""
+        for folder in self.folders:
+            status, _ = self.mail.select(folder, readonly=True)
+            if status != "OK":
+                continue
+            seen = self._seen.setdefault(folder, set())
+            uids = [uid for uid in self._search() if uid not in seen]
+            if not uids:
+                continue
+            checked = uids[-_MAX_FETCH_PER_FOLDER:]
+            matched = self._matching_uids(checked)
+            # 收件人不匹配的邮件已检查完毕；匹配的邮件下载正文后才标记
+            seen.update(set(checked) - set(matched))
+            for uid in matched:
+                status, msg_data = self.mail.uid("FETCH", uid, "(BODY.PEEK[])")
+                if status != "OK" or not msg_data or not isinstance(msg_data[0], tuple):
+                    continue
+                seen.add(uid)
+                msg = email.message_from_bytes(msg_data[0][1])
+                magic_link, _ = _process_email(msg, self.account.email)
+                if magic_link and magic_link.startswith(link_prefix):
+                    return magic_link
+        return None
+
+    def wait_for_mail(self, timeout: float) -> bool:
+        """
+        等待新邮件：支持 IDLE 时在 INBOX 上等待服务器推送，否则直接休眠（下一轮重新搜索）
+
+        Returns:
+            是否收到新邮件通知
+        """
+        if timeout <= 0:
+            return False
+        if not self.supports_idle:
+            time.sleep(timeout)
+            return False
+
+        mail = self.mail
+        mail.select("INBOX", readonly=True)
+        try:
+            with mail.idle(duration=timeout) as idler:
+                for response_type, _ in idler:
+                    if response_type in ("EXISTS", "RECENT"):
+                        return True
+        except imaplib.IMAP4.error as e:
+            # 服务器拒绝 IDLE，之后改为休眠轮询
+            print(f"[Outlook] IDLE 不可用，改为轮询: {e}")
+            self.supports_idle = False
+            time.sleep(timeout)
+        return False
+
+
 # --------------------------------- 主逻辑 ---------------------------------
 
 class OutlookAccount:
@@ -164,120 +438,110 @@ class OutlookMailManager:
         """初始化邮箱管理器，不再从文件读取账户"""
         pass
 
-    # ------------------- 获取 magic link -------------------
+    # ------------------- 轮询 magic link -------------------
 
-    def get_magic_link(self, account: OutlookAccount) -> Dict[str, str]:
+    def _poll_link(self, account: OutlookAccount, link_prefix: str, label: str) -> Optional[str]:
+        """
+        在同一个 IMAP 会话中轮询包含指定前缀链接的邮件
+
+        支持 IDLE 时在 INBOX 上等待新邮件通知，否则按 _MAIL_TIMEOUT 间隔轮询；
+        连接异常时在下一轮重新建立会话
+        """
+        deadline = time.time() + _POLL_INITIAL_WAIT + _LUNXUN * _MAIL_TIMEOUT
+        session = _MailboxSession(account)
         attempt = 0
-        time.sleep(8)
-        while attempt < _LUNXUN:
-            attempt += 1
-            print(f"[Outlook] 第 {attempt}/{_LUNXUN} 次尝试获取 magic link")
-            access_token = _get_access_token(account.client_id, account.refresh_token)
-            if not access_token:
-                time.sleep(_MAIL_TIMEOUT)
-                continue
-            try:
-                mail = imaplib.IMAP4_SSL(_OUTLOOK_IMAP_SERVER)
-                mail.authenticate("XOAUTH2", lambda x: _generate_auth_string(account.email, access_token).encode())
-                folders = ["INBOX", "Junk", "Junk Email", "Spam", "Bulk Mail", "Clutter"]
-                id_list = []
-                for fld in folders:
-                    try:
-                        mail.select(fld)
-                        # 先抓 UNSEEN，再抓 ALL
-                        status, data = mail.search(None, "UNSEEN")
-                        if status != "OK" or not data[0]:
-                            status, data = mail.search(None, "ALL")
-                        if status == "OK" and data[0]:
-                            ids = data[0].split()
-                            id_list.extend([(fld, mid) for mid in ids])
-                    except Exception:
+        try:
+            while time.time() < deadline:
+                attempt += 1
+                print(f"[Outlook] 第 {attempt} 次尝试获取 {label}")
+                try:
+                    if not session.connected and not session.connect():
+                        time.sleep(_MAIL_TIMEOUT)
                         continue
-                if not id_list:
-                    mail.logout()
+                    link = session.find_link(link_prefix)
+                    if link:
+                        return link
+                    session.wait_for_mail(min(_MAIL_TIMEOUT, max(0.0, deadline - time.time())))
+                except Exception as e:
+                    print(f"[Outlook] 处理邮箱时异常: {e}")
+                    session.close()
                     time.sleep(_MAIL_TIMEOUT)
-                    continue
-                # 只保留最近 20 封
-                id_list = id_list[-20:]
-                found_recipient = False
-                for fld, msg_id in reversed(id_list):
-                    try:
-                        mail.select(fld)
-                        _, msg_data = mail.fetch(msg_id, "(RFC822)")
-                        msg = email.message_from_bytes(msg_data[0][1])
-                    except Exception:
-                        continue
-                    magic_link, recipient_matched = _process_email(msg, account.email)
-                    if recipient_matched:
-                        found_recipient = True
-                    if magic_link and magic_link.startswith(_MAGIC_LINK_PREFIX):
-                        mail.logout()
-                        return {"type": "True", "link": magic_link}
-                mail.logout()
-                if found_recipient:
-                    # print("[Outlook] 找到收件人匹配邮件，但未提取到链接 (包含其他文件夹)")
-                    pass
-            except Exception as e:
-                print(f"[Outlook] 处理邮箱时异常: {e}")
-            time.sleep(_MAIL_TIMEOUT)
+        finally:
+            session.close()
+        return None
+
+    @staticmethod
+    def _check_once(session: _MailboxSession, link_prefix: str) -> Optional[str]:
+        if not session.connected and not session.connect():
+            return None
+        return session.find_link(link_prefix)
+
+    async def _poll_link_async(
+        self,
+        account: OutlookAccount,
+        link_prefix: str,
+        label: str,
+        limiter: Optional[asyncio.Semaphore] = None,
+        executor: Optional[Executor] = None,
+    ) -> Optional[str]:
+        """
+        _poll_link 的异步版本，用于注册流水线
+
+        两次检查之间只是 asyncio 定时器，不占用线程；每次检查在线程池中执行，
+        limiter 限制同时检查邮箱的数量
+        """
+        loop = asyncio.get_running_loop()
+        limiter = limiter or asyncio.Semaphore(1)
+        session = _MailboxSession(account)
+        await asyncio.sleep(_POLL_INITIAL_WAIT)
+        deadline = time.time() + _LUNXUN * _MAIL_TIMEOUT
+        try:
+            while True:
+                try:
+                    async with limiter:
+                        link = await loop.run_in_executor(executor, self._check_once, session, link_prefix)
+                    if link:
+                        return link
+                except Exception as e:
+                    print(f"[Outlook] 获取 {label} 时异常: {e}")
+                    await loop.run_in_executor(executor, session.close)
+                if time.time() >= deadline:
+                    return None
+                await asyncio.sleep(_MAIL_TIMEOUT)
+        finally:
+            await loop.run_in_executor(executor, session.close)
+
+    async def get_magic_link_async(self, account: OutlookAccount, limiter=None, executor=None) -> Dict[str, str]:
+        magic_link = await self._poll_link_async(account, _MAGIC_LINK_PREFIX, "magic link", limiter, executor)
+        if magic_link:
+            return {"type": "True", "link": magic_link}
+        return {"type": "error", "msg": "已到轮询阈值,停止获取"}
+
+    async def get_login_link_async(self, account: OutlookAccount, limiter=None, executor=None) -> Dict[str, str]:
+        magic_link = await self._poll_link_async(account, _LOGIN_MAGIC_LINK_PREFIX, "login magic link", limiter, executor)
+        if magic_link:
+            return {"type": "True", "link": magic_link}
+        return {"type": "error", "msg": "已到轮询阈值,停止获取登录链接"}
+
+    # ------------------- 获取 magic link -------------------
+
+    def get_magic_link(self, account: OutlookAccount) -> Dict[str, str]:
+        magic_link = self._poll_link(account, _MAGIC_LINK_PREFIX, "magic link")
+        if magic_link:
+            return {"type": "True", "link": magic_link}
         return {"type": "error", "msg": "已到轮询阈值,停止获取"}
 
     # ------------------- 获取登录 magic link -------------------
     def get_login_link(self, account: OutlookAccount) -> Dict[str, str]:
         """专门用于获取登录邮件中的 magic link。"""
-        attempt = 0
-        time.sleep(8)
-        while attempt < _LUNXUN:
-            attempt += 1
-            print(f"[Outlook] 第 {attempt}/{_LUNXUN} 次尝试获取 login magic link")
-            access_token = _get_access_token(account.client_id, account.refresh_token)
-            if not access_token:
-                time.sleep(_MAIL_TIMEOUT)
-                continue
-            try:
-                mail = imaplib.IMAP4_SSL(_OUTLOOK_IMAP_SERVER)
-                mail.authenticate("XOAUTH2", lambda x: _generate_auth_string(account.email, access_token).encode())
-                folders = ["INBOX", "Junk", "Junk Email", "Spam", "Bulk Mail", "Clutter"]
-                id_list = []
-                for fld in folders:
-                    try:
-                        mail.select(fld)
-                        status, data = mail.search(None, "UNSEEN")
-                        if status != "OK" or not data[0]:
-                            status, data = mail.search(None, "ALL")
-                        if status == "OK" and data[0]:
-                            ids = data[0].split()
-                            id_list.extend([(fld, mid) for mid in ids])
-                    except Exception:
-                        continue
-                if not id_list:
-                    mail.logout()
-                    time.sleep(_MAIL_TIMEOUT)
-                    continue
-                id_list = id_list[-20:]
-                found_recipient = False
-                for fld, msg_id in reversed(id_list):
-                    try:
-                        mail.select(fld)
-                        _, msg_data = mail.fetch(msg_id, "(RFC822)")
-                        msg = email.message_from_bytes(msg_data[0][1])
-                    except Exception:
-                        continue
-                    magic_link, recipient_matched = _process_email(msg, account.email)
-                    if recipient_matched:
-                        found_recipient = True
-                    if magic_link and magic_link.startswith(_LOGIN_MAGIC_LINK_PREFIX):
-                        mail.logout()
-                        return {"type": "True", "link": magic_link}
-                mail.logout()
-            except Exception as e:
-                print(f"[Outlook] 处理邮箱时异常: {e}")
-            time.sleep(_MAIL_TIMEOUT)
+        magic_link = self._poll_link(account, _LOGIN_MAGIC_LINK_PREFIX, "login magic link")
+        if magic_link:
+            return {"type": "True", "link": magic_link}
         return {"type": "error", "msg": "已到轮询阈值,停止获取登录链接"}
 
     def print_all_emails(self, account: OutlookAccount, limit: int = 100):
         """打印指定邮箱最近 limit 封邮件的标题。"""
-        access_token = _get_access_token(account.client_id, account.refresh_token)
+        access_token = _get_access_token(account)
         if not access_token:
             print("[Outlook] 无法获取 access_token，终止")
             return
@@ -2,7 +2,8 @@ from redis import Redis
 from typing import Dict, List, Optional, Any, Union
 import json
 import time
-from env import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_ACCOUNT_CACHE_TTL
+import uuid
+from env import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_ACCOUNT_CACHE_TTL, REDIS_HEALTH_CHECK_INTERVAL
 
 # 创建Redis客户端连接
 redis_client = Redis(
@@ -19,6 +20,45 @@ ACCOUNT_KEY = f"{KEY_PREFIX}account:"
 PAID_ACCOUNT_KEY = f"{KEY_PREFIX}paid_account:"
 LOCK_KEY = f"{KEY_PREFIX}account_lock:"  # 账号锁定的键前缀
 LOCK_EXPIRY = 300  # 锁定过期时间（秒），防止死锁
+INVALIDATION_CHANNEL = f"{KEY_PREFIX}account_invalidate"  # 账号缓存失效通知频道
+REFRESH_LOCK_KEY = f"{KEY_PREFIX}refresh_lock:"  # 凭据刷新锁的键前缀（跨副本去重）
+REFRESH_RESULT_KEY = f"{KEY_PREFIX}refresh_result:"  # 最近一次凭据刷新结果的键前缀
+TASK_LOCK_KEY = f"{KEY_PREFIX}task_lock:"  # 定时任务锁的键前缀（多副本只执行一次）
+
+# 只有持有者才能释放锁（比较令牌后删除）
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# 将集合中所有账号缓存的 count 清零，保留原有的过期时间
+# KEYS[1]: 账号ID集合，ARGV[1]: 账号数据键前缀
+_RESET_USAGE_SCRIPT = """
+local reset = 0
+for _, account_id in ipairs(redis.call('smembers', KEYS[1])) do
+    local key = ARGV[1] .. account_id
+    local value = redis.call('get', key)
+    if value then
+        local data = cjson.decode(value)
+        if data['count'] ~= 0 then
+            data['count'] = 0
+            local ttl = redis.call('pttl', key)
+            if ttl > 0 then
+                redis.call('set', key, cjson.encode(data), 'px', ttl)
+            else
+                redis.call('set', key, cjson.encode(data))
+            end
+            reset = reset + 1
+        end
+    end
+end
+return reset
+"""
+
+# 最近一次健康检查的时间与结果
+_health_state = {"checked_at": 0.0, "healthy": False}
 
 def test_connection() -> bool:
     """测试Redis连接是否正常"""
@@ -28,6 +68,24 @@ def test_connection() -> bool:
         print(f"Redis连接测试失败: {str(e)}")
         return False
 
+def is_redis_healthy() -> bool:
+    """
+    返回Redis的健康状态
+    结果缓存 REDIS_HEALTH_CHECK_INTERVAL 秒，避免请求链路上每次都ping
+    """
+    now = time.time()
+    if now - _health_state["checked_at"] < REDIS_HEALTH_CHECK_INTERVAL:
+        return _health_state["healthy"]
+    try:
+        healthy = bool(redis_client.ping())
+    except Exception:
+        healthy = False
+    if healthy != _health_state["healthy"]:
+        print(f"Redis健康状态变更: {'正常' if healthy else '不可用'}")
+    _health_state["checked_at"] = now
+    _health_state["healthy"] = healthy
+    return healthy
+
 def cache_account(account_id: int, account_data: Dict[str, Any], is_paid: bool = False) -> bool:
     """
     缓存账号信息到Redis
@@ -60,6 +118,97 @@ def cache_account(account_id: int, account_data: Dict[str, Any], is_paid: bool =
         print(f"缓存账号失败: {str(e)}")
         return False
 
+def publish_account_invalidation(account_id: int) -> bool:
+    """
+    发布账号缓存失效通知，所有副本收到后会清除本地L1缓存
+    
+    Args:
+        account_id: 账号ID
+        
+    Returns:
+        成功返回True，失败返回False
+    """
+    try:
+        redis_client.publish(INVALIDATION_CHANNEL, str(account_id))
+        return True
+    except Exception as e:
+        print(f"发布账号缓存失效通知失败: {str(e)}")
+        return False
+
+def acquire_refresh_lock(account_id: int, ttl: int) -> Optional[str]:
+    """
+    获取账号凭据刷新锁，同一时刻只有一个副本刷新同一账号
+    
+    Args:
+        account_id: 账号ID
+        ttl: 锁的过期时间（秒），防止持有者崩溃后死锁
+        
+    Returns:
+        获取成功返回锁令牌，锁已被其他副本持有返回None
+    """
+    token = uuid.uuid4().hex
+    if redis_client.set(f"{REFRESH_LOCK_KEY}{account_id}", token, nx=True, ex=ttl):
+        return token
+    return None
+
+def release_refresh_lock(account_id: int, token: str) -> bool:
+    """释放凭据刷新锁（仅当令牌匹配时）"""
+    try:
+        return bool(redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, f"{REFRESH_LOCK_KEY}{account_id}", token))
+    except Exception as e:
+        print(f"释放刷新锁失败: {str(e)}")
+        return False
+
+def is_refresh_locked(account_id: int) -> bool:
+    """检查账号是否正在被其他副本刷新"""
+    try:
+        return redis_client.exists(f"{REFRESH_LOCK_KEY}{account_id}") == 1
+    except Exception:
+        return False
+
+def set_refresh_result(account_id: int, success: bool, ttl: int) -> None:
+    """记录最近一次刷新结果，供等待中的副本读取"""
+    try:
+        redis_client.setex(f"{REFRESH_RESULT_KEY}{account_id}", ttl, "1" if success else "0")
+    except Exception as e:
+        print(f"记录刷新结果失败: {str(e)}")
+
+def get_refresh_result(account_id: int) -> Optional[bool]:
+    """读取最近一次刷新结果，不存在时返回None"""
+    try:
+        value = redis_client.get(f"{REFRESH_RESULT_KEY}{account_id}")
+    except Exception:
+        return None
+    if value is None:
+        return None
+    return value == "1"
+
+def acquire_task_lock(name: str, ttl: int) -> bool:
+    """
+    获取定时任务锁，多个副本中只有一个能执行该任务
+    锁不主动释放，到期自动失效，因此同一个 name 在 ttl 内只会执行一次
+    
+    Args:
+        name: 任务名称（可包含日期等区分执行批次的信息）
+        ttl: 锁的过期时间（秒）
+        
+    Returns:
+        获取成功返回True，已被其他副本获取返回False
+    """
+    return bool(redis_client.set(f"{TASK_LOCK_KEY}{name}", str(int(time.time())), nx=True, ex=ttl))
+
+def reset_cached_usage_counts() -> int:
+    """
+    在Redis端一次性将普通与付费账号缓存的使用次数清零
+    
+    Returns:
+        被清零的缓存条目数量
+    """
+    reset = 0
+    for base_key in (ACCOUNT_KEY, PAID_ACCOUNT_KEY):
+        reset += int(redis_client.eval(_RESET_USAGE_SCRIPT, 1, base_key + "set", base_key))
+    return reset
+
 def lock_account(account_id: int) -> bool:
     """
     锁定账号，防止其被其他请求同时使用
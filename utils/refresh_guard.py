@@ -0,0 +1,188 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Tuple
+
+from env import REFRESH_LOCK_TTL
+from utils.redis_cache import (
+    is_redis_healthy,
+    acquire_refresh_lock,
+    release_refresh_lock,
+    is_refresh_locked,
+    set_refresh_result,
+    get_refresh_result,
+)
+
+# 同一账号的凭据刷新去重（single-flight）：
+# 1. 进程内：同一账号同一时刻只有一个刷新在执行，其他调用方等待共享的 Future
+# 2. 跨副本：通过 Redis 短锁保证只有一个副本调用 Frontegg，其他副本等待并读取结果
+# 并发刷新会轮换 refresh cookie，互相覆盖后可能导致凭据失效，所以必须去重
+# 共享 Future 登记时即置为运行状态，不能被取消；异步等待方通过 shield 等待，
+# 某个等待的请求被取消（例如客户端断开）只影响它自己，刷新照常完成并通知其他等待方
+
+_inflight: Dict[int, Future] = {}
+_inflight_lock = threading.Lock()
+# 执行中的异步刷新任务（保持引用，避免任务被回收）
+_tasks = set()
+
+# 等待其他副本刷新时的轮询间隔（秒）
+_WAIT_POLL_SECONDS = 0.2
+
+
+def _claim(account_id: int) -> Tuple[Future, bool]:
+    """登记刷新任务，返回 (共享Future, 是否由当前调用方执行)"""
+    with _inflight_lock:
+        future = _inflight.get(account_id)
+        if future is not None:
+            return future, False
+        future = Future()
+        future.set_running_or_notify_cancel()
+        _inflight[account_id] = future
+        return future, True
+
+
+def _finish(account_id: int, future: Future):
+    with _inflight_lock:
+        if _inflight.get(account_id) is future:
+            _inflight.pop(account_id, None)
+
+
+def _resolve(future: Future, result: bool = False, error: BaseException = None):
+    """写入刷新结果；Future 已经有结果时忽略"""
+    if future.done():
+        return
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except Exception:
+        # 与其他线程并发写入时 Future 可能已经完成
+        pass
+
+
+async def _wait(future: Future) -> bool:
+    """等待共享 Future，当前协程被取消时不影响 Future 和其他等待方"""
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+
+def _refresh_across_replicas(account_id: int, refresh_fn: Callable[[int], bool]) -> bool:
+    """持有跨副本锁执行刷新；锁被其他副本持有时等待其结果"""
+    if not is_redis_healthy():
+        return refresh_fn(account_id)
+
+    try:
+        lock_token = acquire_refresh_lock(account_id, REFRESH_LOCK_TTL)
+    except Exception as e:
+        print(f"获取刷新锁失败，直接刷新: {str(e)}")
+        return refresh_fn(account_id)
+
+    if lock_token is None:
+        # 其他副本正在刷新，等待锁释放后读取其结果
+        deadline = time.time() + REFRESH_LOCK_TTL
+        while time.time() < deadline and is_refresh_locked(account_id):
+            time.sleep(_WAIT_POLL_SECONDS)
+        result = get_refresh_result(account_id)
+        return bool(result)
+
+    try:
+        success = refresh_fn(account_id)
+        set_refresh_result(account_id, success, REFRESH_LOCK_TTL)
+        return success
+    finally:
+        release_refresh_lock(account_id, lock_token)
+
+
+def _lead(account_id: int, refresh_fn: Callable[[int], bool], future: Future):
+    """执行刷新并把结果写入共享 Future（在当前线程中运行）"""
+    try:
+        _resolve(future, _refresh_across_replicas(account_id, refresh_fn))
+    except Exception as e:
+        _resolve(future, error=e)
+    finally:
+        _finish(account_id, future)
+
+
+def run_refresh(account_id: int, refresh_fn: Callable[[int], bool]) -> bool:
+    """
+    以 single-flight 方式刷新账号凭据（同步版本，用于后台线程）
+
+    Args:
+        account_id: 账号ID
+        refresh_fn: 实际执行刷新的函数，接收账号ID，返回是否成功
+
+    Returns:
+        刷新是否成功；并发调用方得到的是同一次刷新的结果
+    """
+    future, leader = _claim(account_id)
+    if leader:
+        _lead(account_id, refresh_fn, future)
+    return future.result()
+
+
+async def run_refresh_async(account_id: int, refresh_fn: Callable[[int], bool]) -> bool:
+    """
+    以 single-flight 方式刷新账号凭据（异步版本，用于请求链路）
+    阻塞的刷新逻辑在线程池中执行，等待方只挂起协程，不占用线程；
+    即使发起刷新的请求被取消，刷新也会在线程中完成并通知其他等待方
+    """
+    future, leader = _claim(account_id)
+    if leader:
+        asyncio.get_running_loop().run_in_executor(None, _lead, account_id, refresh_fn, future)
+    return await _wait(future)
+
+
+async def _refresh_across_replicas_async(account_id: int, refresh_coro_fn: Callable[[int], Awaitable[bool]]) -> bool:
+    """_refresh_across_replicas 的协程版本，等待其他副本时不阻塞事件循环"""
+    if not is_redis_healthy():
+        return await refresh_coro_fn(account_id)
+
+    try:
+        lock_token = acquire_refresh_lock(account_id, REFRESH_LOCK_TTL)
+    except Exception as e:
+        print(f"获取刷新锁失败，直接刷新: {str(e)}")
+        return await refresh_coro_fn(account_id)
+
+    if lock_token is None:
+        deadline = time.time() + REFRESH_LOCK_TTL
+        while time.time() < deadline and is_refresh_locked(account_id):
+            await asyncio.sleep(_WAIT_POLL_SECONDS)
+        return bool(get_refresh_result(account_id))
+
+    try:
+        success = await refresh_coro_fn(account_id)
+        set_refresh_result(account_id, success, REFRESH_LOCK_TTL)
+        return success
+    finally:
+        release_refresh_lock(account_id, lock_token)
+
+
+async def run_refresh_coro(account_id: int, refresh_coro_fn: Callable[[int], Awaitable[bool]]) -> bool:
+    """
+    以 single-flight 方式执行异步刷新逻辑（用于异步批量刷新器）
+
+    Args:
+        account_id: 账号ID
+        refresh_coro_fn: 实际执行刷新的协程函数，接收账号ID，返回是否成功
+    """
+    future, leader = _claim(account_id)
+    if leader:
+        # 刷新放在独立的任务中执行，发起刷新的协程被取消时刷新仍会完成并通知其他等待方
+        task = asyncio.ensure_future(_refresh_across_replicas_async(account_id, refresh_coro_fn))
+        _tasks.add(task)
+
+        def on_done(task: asyncio.Task):
+            _tasks.discard(task)
+            try:
+                if task.cancelled():
+                    _resolve(future, error=RuntimeError("刷新任务被取消"))
+                elif task.exception() is not None:
+                    _resolve(future, error=task.exception())
+                else:
+                    _resolve(future, task.result())
+            finally:
+                _finish(account_id, future)
+
+        task.add_done_callback(on_done)
+    return await _wait(future)
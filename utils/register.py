@@ -1,4 +1,3 @@
-import requests
 import random
 import string
 import re
@@ -7,6 +6,7 @@ from typing import Dict, Optional, Tuple, Any
 from datetime import datetime
 
 from utils.outlook_util import OutlookAccount, OutlookMailManager
+from utils.http_client import get_session
 
 # API设置
 HEADERS = {
@@ -20,6 +20,11 @@ HEADERS = {
 PRELOGIN_URL = "https://auth.chatbetter.com/frontegg/identity/resources/auth/v1/passwordless/magiclink/prelogin"
 POSTLOGIN_URL = "https://auth.chatbetter.com/frontegg/identity/resources/auth/v1/passwordless/magiclink/postlogin"
 
+# ----------------- 凭据刷新相关配置 -----------------
+SILENT_REFRESH_URL = "https://auth.chatbetter.com/frontegg/oauth/authorize/silent"
+SIGNIN_URL = "https://app.chatbetter.com/api/v1/auths/signin"
+AUTHS_URL = "https://app.chatbetter.com/api/v1/auths/"
+
 
 # ----------------- 辅助函数 -----------------
 
@@ -41,7 +46,7 @@ def send_prelogin_email(email: str) -> bool:
         "username": ""
     }
     try:
-        resp = requests.post(PRELOGIN_URL, json=payload, headers=HEADERS)
+        resp = get_session().post(PRELOGIN_URL, json=payload, headers=HEADERS)
         if resp.status_code in (200, 201):
             print(f"[ChatBetter] 已发送login magic link到 {email}")
             return True
@@ -52,47 +57,39 @@ def send_prelogin_email(email: str) -> bool:
         return False
 
 
+# 以下 build_*/parse_* 函数只负责构造请求和解析响应，不发送请求：
+# 同步版本（本模块，requests）和异步批量刷新（utils.bulk_refresher，httpx）共用，上游接口变化时只需修改这里
+
+def build_auth_info_request(token: str, chat_better_jwt: str) -> Tuple[str, dict]:
+    """构造 /api/v1/auths/ 请求，返回 (url, headers)"""
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': HEADERS['User-Agent'],
+        'Cookie': f'token={token}; ChatBetterJwt={chat_better_jwt}',
+        'Authorization': f'Bearer {token}'
+    }
+    return AUTHS_URL, headers
+
+
+def parse_auth_info_response(response) -> Optional[dict]:
+    """解析 /api/v1/auths/ 的响应，失败返回 None"""
+    if response.status_code not in (200, 201):
+        print(f"[ChatBetter] API请求失败, 状态码: {response.status_code}, 响应: {response.text}")
+        return None
+    try:
+        auth_data = response.json()
+    except Exception as e:
+        print(f"[ChatBetter] 解析API响应失败: {str(e)}")
+        return None
+    if not auth_data.get('token'):
+        print("[ChatBetter] API响应中没有token")
+    return auth_data
+
+
 def fetch_auth_info(token:str, chat_better_jwt: str) -> Optional[dict]:
     try:
-        # 准备请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': HEADERS['User-Agent'],
-            'Cookie': f'token={token}; ChatBetterJwt={chat_better_jwt}',
-            'Authorization': f'Bearer {token}'
-        }
-        
-        # 发送请求
-        response = requests.get(
-            "https://app.chatbetter.com/api/v1/auths/",
-            headers=headers
-        )
-        
-        # 检查响应状态
-        if response.status_code not in (200, 201):
-            error_msg = f"API请求失败, 状态码: {response.status_code}, 响应: {response.text}"
-            print(f"[ChatBetter] {error_msg}")
-            return None
-            
-        # 解析响应数据
-        try:
-            auth_data = response.json()
-            token = auth_data.get('token')
-            account_type = auth_data.get('account_type')
-            
-            if not token:
-                error_msg = "API响应中没有token"
-                print(f"[ChatBetter] {error_msg}")
-                return auth_data
-                
-            # print(f"[ChatBetter] 获取到token: {token[:20]}... 账号类型: {account_type}")
-            return auth_data
-            
-        except Exception as e:
-            error_msg = f"解析API响应失败: {str(e)}"
-            print(f"[ChatBetter] {error_msg}")
-            return None
-            
+        url, headers = build_auth_info_request(token, chat_better_jwt)
+        return parse_auth_info_response(get_session().get(url, headers=headers))
     except Exception as e:
         error_msg = f"API请求异常: {str(e)}"
         print(f"[ChatBetter] {error_msg}")
@@ -102,50 +99,43 @@ def fetch_auth_info(token:str, chat_better_jwt: str) -> Optional[dict]:
 # ----------------- 新增: 通过 accessToken 调用 /api/v1/auths/signin -----------------
 
 
-def signin_with_access_token(access_token: str) -> Optional[dict]:
-    """使用 accessToken 调用 /api/v1/auths/signin 获取认证信息
-
-    Args:
-        access_token: 登录流程中获取到的 ChatBetterJwt (即 accessToken)
-
-    Returns:
-        解析后的响应 JSON, 如果失败则返回 None
-    """
-    # 准备请求头, 只需要在 Cookie 中携带 ChatBetterJwt
+def build_signin_request(access_token: str) -> Tuple[str, dict, dict]:
+    """构造 /api/v1/auths/signin 请求，返回 (url, json, headers)；只需要在 Cookie 中携带 ChatBetterJwt"""
     headers = {
         'Content-Type': 'application/json',
         'User-Agent': HEADERS['User-Agent'],
         'Cookie': f'ChatBetterJwt={access_token}'
     }
+    return SIGNIN_URL, {"email": "", "password": ""}, headers
 
-    try:
-        response = requests.post(
-            "https://app.chatbetter.com/api/v1/auths/signin",
-            json={"email":"","password":""},
-            headers=headers
-        )
 
-        # 状态码校验
-        if response.status_code not in (200, 201):
-            print(f"[ChatBetter] signin 失败, 状态码: {response.status_code}, 响应: {response.text}")
-            return None
-
-        # 解析 JSON
-        try:
-            auth_data = response.json()
-        except Exception as e:
-            print(f"[ChatBetter] 解析 signin 响应失败: {str(e)}")
-            return None
+def parse_signin_response(response) -> Optional[dict]:
+    """解析 /api/v1/auths/signin 的响应，失败返回 None"""
+    if response.status_code not in (200, 201):
+        print(f"[ChatBetter] signin 失败, 状态码: {response.status_code}, 响应: {response.text}")
+        return None
+    try:
+        auth_data = response.json()
+    except Exception as e:
+        print(f"[ChatBetter] 解析 signin 响应失败: {str(e)}")
+        return None
+    if not auth_data.get('token'):
+        print("[ChatBetter] signin 响应中未包含 token")
+    return auth_data
 
-        token = auth_data.get('token')
 
-        if token:
-            pass
-        else:
-            print("[ChatBetter] signin 响应中未包含 token")
+def signin_with_access_token(access_token: str) -> Optional[dict]:
+    """使用 accessToken 调用 /api/v1/auths/signin 获取认证信息
 
-        return auth_data
+    Args:
+        access_token: 登录流程中获取到的 ChatBetterJwt (即 accessToken)
 
+    Returns:
+        解析后的响应 JSON, 如果失败则返回 None
+    """
+    try:
+        url, payload, headers = build_signin_request(access_token)
+        return parse_signin_response(get_session().post(url, json=payload, headers=headers))
     except Exception as e:
         print(f"[ChatBetter] signin 请求异常: {str(e)}")
         return None
@@ -175,6 +165,19 @@ def login_account(email: str, outlook_account: OutlookAccount) -> Tuple[Optional
     login_link = magic_link_result["link"]
     print(f"[ChatBetter] 获取到登录链接: {login_link[:50]}...")
 
+    return complete_login(login_link)
+
+
+def complete_login(login_link: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    使用登录magic link完成登录（postlogin并获取认证信息）
+
+    Args:
+        login_link: 登录邮件中的magic link
+
+    Returns:
+        (结果字典, 错误信息)
+    """
     # 3. 解析token
     token = extract_login_token(login_link)
     if not token:
@@ -186,7 +189,7 @@ def login_account(email: str, outlook_account: OutlookAccount) -> Tuple[Optional
         "invitationToken": ""
     }
     try:
-        resp = requests.post(POSTLOGIN_URL, json=payload, headers=HEADERS)
+        resp = get_session().post(POSTLOGIN_URL, json=payload, headers=HEADERS)
         if resp.status_code not in (200, 201):
             return None, f"postlogin失败, 状态码: {resp.status_code}, 响应: {resp.text}"
 
@@ -284,7 +287,7 @@ def register_chatbetter(email: str) -> Tuple[bool, Optional[str]]:
     
     try:
         # 发送注册请求
-        response = requests.post(
+        response = get_session().post(
             "https://auth.chatbetter.com/frontegg/identity/resources/users/v1/signUp",
             json=payload,
             headers=headers
@@ -361,7 +364,7 @@ def activate_account(activation_link: str) -> Tuple[Optional[Dict[str, Any]], Op
     
     try:
         # 发送激活请求
-        response = requests.post(
+        response = get_session().post(
             "https://auth.chatbetter.com/frontegg/identity/resources/users/v1/activate",
             json=payload,
             headers=headers
@@ -438,6 +441,48 @@ def activate_account(activation_link: str) -> Tuple[Optional[Dict[str, Any]], Op
         return None, msg
 
 
+def build_silent_refresh_request(cookies: dict) -> Tuple[str, dict, dict]:
+    """
+    构造 silent 刷新请求，返回 (url, json, headers)
+    cookies 直接写入 Cookie 请求头，不经过客户端的 cookie jar，避免不同账号之间串用
+    """
+    cookie_header = "; ".join(f"{name}={value}" for name, value in cookies.items())
+    return SILENT_REFRESH_URL, {"tenantId": None}, dict(HEADERS, Cookie=cookie_header)
+
+
+def parse_silent_refresh_response(response, response_cookies) -> Tuple[bool, Optional[dict], Optional[str]]:
+    """
+    解析 silent 刷新的响应
+
+    Args:
+        response: 响应对象（requests 或 httpx）
+        response_cookies: 响应设置的 cookie 对象（有 name/value 属性）的可迭代对象
+
+    Returns:
+        (成功标志, 新cookies字典, access_token)，如果刷新失败则返回(False, None, None)
+    """
+    if response.status_code not in (200, 201):
+        print(f"[ChatBetter] 刷新失败，状态码: {response.status_code}")
+        return False, None, None
+
+    # 从响应体中获取access_token
+    try:
+        access_token = response.json().get('access_token')
+    except Exception as e:
+        print(f"[ChatBetter] 解析响应体失败: {str(e)}")
+        return False, None, None
+    if not access_token:
+        print("[ChatBetter] 响应中没有access_token")
+        return False, None, None
+
+    cookie_dict = {cookie.name: cookie.value for cookie in response_cookies}
+    # 检查必需cookie
+    if not any(name.startswith('fe_device') for name in cookie_dict) or not any(name.startswith('fe_refresh') for name in cookie_dict):
+        print("[ChatBetter] 刷新失败，未找到所需的cookies")
+        return False, None, None
+    return True, cookie_dict, access_token
+
+
 def refresh_silent_cookies(cookies: dict) -> Tuple[bool, Optional[dict], Optional[str]]:
     """
     刷新silent cookies
@@ -453,46 +498,9 @@ def refresh_silent_cookies(cookies: dict) -> Tuple[bool, Optional[dict], Optiona
         return False, None, None
     
     try:
-        # 准备请求
-        payload = {
-            "tenantId": None
-        }
-        
-        # 发送请求
-        response = requests.post(
-            "https://auth.chatbetter.com/frontegg/oauth/authorize/silent",
-            json=payload,
-            headers=HEADERS,
-            cookies=cookies
-        )
-        
-        # 检查响应状态
-        if response.status_code not in (200, 201):
-            print(f"[ChatBetter] 刷新失败，状态码: {response.status_code}")
-            return False, None, None
-        
-        # 从响应体中获取access_token
-        try:
-            response_data = response.json()
-            access_token = response_data.get('access_token')
-            if not access_token:
-                print("[ChatBetter] 响应中没有access_token")
-                return False, None, None
-        except Exception as e:
-            print(f"[ChatBetter] 解析响应体失败: {str(e)}")
-            return False, None, None
-        
-        # 直接使用response.cookies获取字典
-        cookie_dict = {cookie.name: cookie.value for cookie in response.cookies}
-        
-        # 检查必需cookie
-        if not any(name.startswith('fe_device') for name in cookie_dict) or not any(name.startswith('fe_refresh') for name in cookie_dict):
-            print("[ChatBetter] 刷新失败，未找到所需的cookies")
-            return False, None, None
-        
-        #print(f"[ChatBetter] cookies刷新成功，获取到access_token: {access_token[:20]}...")
-        return True, cookie_dict, access_token
-    
+        url, payload, headers = build_silent_refresh_request(cookies)
+        response = get_session().post(url, json=payload, headers=headers)
+        return parse_silent_refresh_response(response, response.cookies)
     except Exception as e:
         print(f"[ChatBetter] 刷新cookies时发生异常: {str(e)}")
         return False, None, None
@@ -0,0 +1,159 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from env import (
+    REGISTER_MAIL_CONCURRENCY,
+    REGISTER_RATE_LIMIT,
+    REGISTER_RATE_BURST,
+    REGISTER_MAX_INFLIGHT,
+)
+from utils.bulk_refresher import TokenBucket
+from utils.outlook_util import OutlookAccount, OutlookMailManager
+from utils.register import register_chatbetter, send_prelogin_email, activate_account, complete_login
+from utils.token_writer import token_collector
+
+# 进度回调：(邮箱, 状态描述, 是否成功)；是否成功为 None 表示仍在处理中
+ReportFn = Callable[[str, str, Optional[bool]], None]
+# 是否应停止处理（例如作业租约已被其他 worker 接管）
+CancelledFn = Callable[[], bool]
+
+
+class RegistrationPipeline:
+    """
+    分阶段的异步注册流水线：注册/prelogin -> 等待邮件 -> 激活/登录 -> 入库（批量 upsert）
+
+    每个阶段有独立的并发上限，访问 auth.chatbetter.com 的阶段共用一个令牌桶限流；
+    等待邮件期间只是 asyncio 定时器，不占用线程，因此单个进程可以同时处理上千个邮箱。
+    阻塞的 HTTP/IMAP/数据库调用在流水线自己的线程池中执行。
+    cancelled 返回 True 后，尚未开始的邮箱不再处理，处理中的邮箱在等待邮件前停止
+    """
+
+    def __init__(self, http_concurrency: int, report: ReportFn, cancelled: Optional[CancelledFn] = None):
+        self.report = report
+        self.cancelled = cancelled or (lambda: False)
+        self.register_limiter = asyncio.Semaphore(http_concurrency)
+        self.mail_limiter = asyncio.Semaphore(REGISTER_MAIL_CONCURRENCY)
+        self.activate_limiter = asyncio.Semaphore(http_concurrency)
+        self.inflight_limiter = asyncio.Semaphore(REGISTER_MAX_INFLIGHT)
+        self.auth_bucket = TokenBucket(REGISTER_RATE_LIMIT, REGISTER_RATE_BURST)
+        self.executor = ThreadPoolExecutor(
+            max_workers=2 * http_concurrency + REGISTER_MAIL_CONCURRENCY,
+            thread_name_prefix="register",
+        )
+        self.mail_manager = OutlookMailManager()
+
+    async def _call(self, limiter: asyncio.Semaphore, fn, *args, rate_limited: bool = False):
+        """在指定阶段的并发上限内执行阻塞调用"""
+        async with limiter:
+            if rate_limited:
+                await self.auth_bucket.acquire()
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _login(self, email: str, outlook_account: OutlookAccount, reg_err: Optional[str]) -> Tuple[Optional[dict], Optional[str]]:
+        """注册失败时走登录流程"""
+        print(f"[Register] 注册失败，尝试登录流程: {email}")
+        if not await self._call(self.register_limiter, send_prelogin_email, email, rate_limited=True):
+            return None, f"注册失败且登录失败: {reg_err}; prelogin发送失败"
+
+        self.report(email, "等待登录邮件...", None)
+        link_result = await self.mail_manager.get_login_link_async(outlook_account, self.mail_limiter, self.executor)
+        if link_result.get("type") != "True" or not link_result.get("link"):
+            return None, f"注册失败且登录失败: {reg_err}; 获取登录链接失败"
+
+        login_result, login_err = await self._call(self.activate_limiter, complete_login, link_result["link"], rate_limited=True)
+        if not login_result:
+            return None, f"注册失败且登录失败: {reg_err}; {login_err}"
+        return login_result, None
+
+    async def _register(self, email: str, outlook_account: OutlookAccount) -> Tuple[Optional[dict], Optional[str]]:
+        """注册新账号并通过激活邮件获取凭据"""
+        self.report(email, "等待激活邮件...", None)
+        link_result = await self.mail_manager.get_magic_link_async(outlook_account, self.mail_limiter, self.executor)
+        if link_result["type"] != "True" or not link_result.get("link"):
+            return None, "获取激活链接失败"
+
+        activation_link = link_result["link"]
+        print(f"[Register] 获取到激活链接: {activation_link[:50]}...")
+        activation_result, act_err = await self._call(self.activate_limiter, activate_account, activation_link, rate_limited=True)
+        if not activation_result:
+            return None, f"激活失败: {act_err}"
+        return activation_result, None
+
+    async def _persist(self, email: str, result: dict):
+        token_data = {
+            "account": email,
+            "cookies": result.get("cookies"),
+            "access_token": result.get("access_token"),
+            "token": result.get("token"),
+        }
+        # 交给收集器与其他邮箱的结果一起批量写入
+        await asyncio.wrap_future(token_collector.submit(token_data))
+
+    async def process(self, item: Dict[str, Any]):
+        """处理单个邮箱，结果通过 report 回调上报"""
+        email = item.get("account")
+        password = item.get("password")
+        refresh_token = item.get("token")
+        client_id = item.get("uuid")
+
+        if not all([email, password, refresh_token, client_id]):
+            self.report(email, "缺少必要参数", False)
+            return
+
+        async with self.inflight_limiter:
+            if self.cancelled():
+                return
+            try:
+                print(f"[Register] 正在处理邮箱: {email}")
+                self.report(email, "处理中...", None)
+                outlook_account = OutlookAccount(email, password, refresh_token, client_id)
+
+                register_success, reg_err = await self._call(self.register_limiter, register_chatbetter, email, rate_limited=True)
+                # 等待邮件耗时最长，开始前再检查一次；已经拿到的凭据照常入库（upsert 可重复执行）
+                if self.cancelled():
+                    print(f"[Register] 任务已取消，停止处理邮箱: {email}")
+                    return
+                if register_success:
+                    result, err = await self._register(email, outlook_account)
+                    success_detail = "注册成功"
+                else:
+                    result, err = await self._login(email, outlook_account, reg_err)
+                    success_detail = "登录成功"
+                if not result:
+                    self.report(email, err, False)
+                    return
+
+                try:
+                    await self._persist(email, result)
+                except Exception as e:
+                    print(f"[Register] 保存到数据库失败: {e}")
+                    self.report(email, f"保存到数据库失败: {str(e)}", False)
+                    return
+
+                if register_success and not result.get("token"):
+                    self.report(email, "注册部分成功，但未获取到token", False)
+                else:
+                    self.report(email, success_detail, True)
+            except Exception as e:
+                print(f"[Register] 处理邮箱 {email} 时发生错误: {str(e)}")
+                self.report(email, f"处理错误: {str(e)}", False)
+
+    async def run(self, email_data: List[Dict[str, Any]]):
+        try:
+            await asyncio.gather(*(self.process(item) for item in email_data))
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def run_registrations(email_data: List[Dict[str, Any]], http_concurrency: int, report: ReportFn,
+                      cancelled: Optional[CancelledFn] = None):
+    """
+    运行注册流水线直到所有邮箱处理完成（或 cancelled 返回 True）
+
+    注意：此函数会阻塞当前线程，应在单独的线程中运行
+    """
+    async def _run():
+        await RegistrationPipeline(http_concurrency, report, cancelled).run(email_data)
+
+    asyncio.run(_run())
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from env import (
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_ENTRY_BYTES,
+)
+from utils.redis_cache import redis_client, KEY_PREFIX, is_redis_healthy
+
+# /v1/chat/completions 精确匹配响应缓存（默认关闭，RESPONSE_CACHE_ENABLED 开启）：
+#   response_cache:<sha256>  STRING  {"content", "usage"}，TTL 为 RESPONSE_CACHE_TTL
+#   response_cache_index     ZSET    缓存键 -> 写入时间，超过 RESPONSE_CACHE_MAX_ENTRIES 时淘汰最早写入的条目
+#   response_cache_stats     HASH    命中/未命中/跳过等计数，所有进程共享
+# 缓存键由模型、规范化后的消息和影响输出的参数计算，命中时按请求的 stream 参数以 SSE 或 JSON 返回
+# 客户端可用 Cache-Control 头跳过缓存：no-cache 不读缓存（仍写入新结果），no-store 既不读也不写
+RESPONSE_CACHE_KEY = f"{KEY_PREFIX}response_cache:"
+RESPONSE_CACHE_INDEX_KEY = f"{KEY_PREFIX}response_cache_index"
+RESPONSE_CACHE_STATS_KEY = f"{KEY_PREFIX}response_cache_stats"
+
+# 参与请求指纹计算的请求参数（stream 只影响返回格式，不参与）
+CACHE_KEY_PARAMS = (
+    "temperature",
+    "top_p",
+    "max_tokens",
+    "max_completion_tokens",
+    "stop",
+    "seed",
+    "n",
+    "presence_penalty",
+    "frequency_penalty",
+    "response_format",
+    "tools",
+    "tool_choice",
+    "reasoning_effort",
+)
+
+# KEYS[1]: 缓存条目，KEYS[2]: 索引
+# ARGV[1]: 缓存内容，ARGV[2]: TTL，ARGV[3]: 当前时间，ARGV[4]: 条目数上限
+# 写入条目并登记到索引，清理索引中已过期的条目，超出上限时删除最早写入的条目，返回淘汰的条目数
+_STORE_SCRIPT = """
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+redis.call('zremrangebyscore', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local overflow = redis.call('zcard', KEYS[2]) - tonumber(ARGV[4])
+if overflow <= 0 then
+    return 0
+end
+local oldest = redis.call('zrange', KEYS[2], 0, overflow - 1)
+for _, key in ipairs(oldest) do
+    redis.call('del', key)
+end
+redis.call('zremrangebyrank', KEYS[2], 0, overflow - 1)
+return overflow
+"""
+
+_store_script = redis_client.register_script(_STORE_SCRIPT)
+
+
+def _incr(field: str, amount: int = 1):
+    try:
+        redis_client.hincrby(RESPONSE_CACHE_STATS_KEY, field, amount)
+    except Exception as e:
+        print(f"更新响应缓存统计失败: {str(e)}")
+
+
+def cache_policy(cache_control: Optional[str]) -> Tuple[bool, bool]:
+    """
+    根据配置和请求的 Cache-Control 头决定是否读取/写入缓存
+
+    Returns:
+        (是否读取缓存, 是否写入缓存)
+    """
+    if not RESPONSE_CACHE_ENABLED or not is_redis_healthy():
+        return False, False
+    directives = {item.strip().lower() for item in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        _incr("bypass")
+        return False, False
+    if "no-cache" in directives:
+        _incr("bypass")
+        return False, True
+    return True, True
+
+
+def request_fingerprint(body: Dict[str, Any], normalized_messages: List[Dict[str, Any]], model: str) -> str:
+    """
+    计算请求的指纹（模型、消息和影响输出的参数），响应缓存和并发合并共用
+
+    Args:
+        body: 请求体
+        normalized_messages: 规范化后的消息（utils.conversation_cache.normalize_messages）
+        model: 模型名称
+    """
+    params = {name: body[name] for name in CACHE_KEY_PARAMS if body.get(name) is not None}
+    raw = json.dumps([model, normalized_messages, params], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def response_cache_key(body: Dict[str, Any], normalized_messages: List[Dict[str, Any]], model: str) -> str:
+    """计算请求的缓存键"""
+    return RESPONSE_CACHE_KEY + request_fingerprint(body, normalized_messages, model)
+
+
+def get_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    """读取缓存的响应 {"content", "usage"}，未命中返回None"""
+    try:
+        value = redis_client.get(key)
+    except Exception as e:
+        print(f"读取响应缓存失败: {str(e)}")
+        return None
+    _incr("hits" if value else "misses")
+    return json.loads(value) if value else None
+
+
+def store_response(key: str, content: str, usage: Optional[Dict[str, Any]] = None):
+    """写入完整响应；内容为空或超过 RESPONSE_CACHE_MAX_ENTRY_BYTES 时不缓存"""
+    if not content:
+        return
+    value = json.dumps({"content": content, "usage": usage or {}}, ensure_ascii=False)
+    if len(value.encode("utf-8")) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+        _incr("too_large")
+        return
+    try:
+        evicted = _store_script(
+            keys=[key, RESPONSE_CACHE_INDEX_KEY],
+            args=[value, RESPONSE_CACHE_TTL, int(time.time()), RESPONSE_CACHE_MAX_ENTRIES],
+        )
+    except Exception as e:
+        print(f"写入响应缓存失败: {str(e)}")
+        return
+    _incr("stores")
+    if evicted:
+        _incr("evicted", int(evicted))
+
+
+def response_cache_stats() -> Dict[str, Any]:
+    """响应缓存的统计：命中/未命中/跳过/写入/淘汰次数、命中率和当前条目数"""
+    stats: Dict[str, Any] = {"enabled": RESPONSE_CACHE_ENABLED}
+    try:
+        counters = {name: int(value) for name, value in redis_client.hgetall(RESPONSE_CACHE_STATS_KEY).items()}
+        stats["entries"] = redis_client.zcard(RESPONSE_CACHE_INDEX_KEY)
+    except Exception as e:
+        stats["error"] = str(e)
+        return stats
+    for name in ("hits", "misses", "bypass", "stores", "too_large", "evicted"):
+        stats[name] = counters.get(name, 0)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
@@ -0,0 +1,355 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from env import SCHEDULER_LEASE_SECONDS, SCHEDULER_JITTER_SECONDS, SCHEDULER_HISTORY_MAX
+from utils.redis_cache import redis_client, KEY_PREFIX, is_redis_healthy
+
+# 定时任务调度器
+# 任务分两类：
+#   集群任务（leader_only）：整个集群只需执行一次（刷新到期账号、重建Redis账号缓存、每日重置），
+#                           只在持有主实例租约的调度器上执行，下次执行时间保存在Redis中，主实例切换后按原计划继续
+#   进程任务：作用于进程内状态（写回使用次数缓冲、内存账号池、本地模型文件），每个进程各自执行
+# Redis 不可用时无法选举，每个调度器都执行集群任务（与单实例部署的行为一致）
+SCHEDULER_LEADER_KEY = f"{KEY_PREFIX}scheduler:leader"
+SCHEDULER_NEXT_RUN_KEY = f"{KEY_PREFIX}scheduler:next_run"
+SCHEDULER_HISTORY_KEY = f"{KEY_PREFIX}scheduler:history:"
+
+# 调度循环的检查间隔（秒）
+TICK_SECONDS = 1
+
+# 持有者续约，否则在租约空闲时获取；返回 1 表示当前实例是主实例
+# KEYS[1]: 租约键，ARGV[1]: 实例标识，ARGV[2]: 租约毫秒数
+_LEADER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('set', KEYS[1], ARGV[1], 'nx', 'px', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+_leader_script = redis_client.register_script(_LEADER_SCRIPT)
+
+# 只有持有者才能释放租约
+_RESIGN_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class ScheduledJob:
+    """
+    定时任务定义
+
+    Args:
+        name: 任务名称（用于执行记录和Redis中的下次执行时间）
+        fn: 任务函数，无参数
+        interval: 执行间隔（秒），与 daily_at 二选一
+        daily_at: 每天的执行时间，如 "00:00"
+        leader_only: 是否只在主实例上执行
+        initial_delay: 首次执行前的等待时间（秒）
+        jitter: 每次执行时间的随机延后上限（秒），避免多个任务或实例同时执行
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[], Any],
+        interval: Optional[int] = None,
+        daily_at: Optional[str] = None,
+        leader_only: bool = True,
+        initial_delay: int = 0,
+        jitter: int = SCHEDULER_JITTER_SECONDS,
+    ):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.daily_at = daily_at
+        self.leader_only = leader_only
+        self.initial_delay = initial_delay
+        self.jitter = jitter
+
+    def next_after(self, now: float) -> float:
+        """计算 now 之后的下一次执行时间（时间戳）"""
+        delay = random.uniform(0, self.jitter) if self.jitter > 0 else 0
+        if self.interval:
+            return now + self.interval + delay
+        hour, minute = (int(part) for part in self.daily_at.split(":"))
+        current = datetime.fromtimestamp(now)
+        target = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if target.timestamp() <= now:
+            target += timedelta(days=1)
+        return target.timestamp() + delay
+
+    def first_run(self, now: float) -> float:
+        if self.daily_at:
+            return self.next_after(now)
+        delay = random.uniform(0, self.jitter) if self.jitter > 0 else 0
+        return now + self.initial_delay + delay
+
+
+class Scheduler:
+    """
+    执行定时任务的调度器，每个任务在独立线程中执行，上一次执行未结束时跳过本次
+
+    Args:
+        jobs: 任务列表
+        elect: 是否参与主实例选举；不参与时只执行进程任务
+    """
+
+    def __init__(self, jobs: List[ScheduledJob], elect: bool = True):
+        self.all_jobs = jobs
+        self.jobs = [job for job in jobs if elect or not job.leader_only]
+        self.elect = elect
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._next_run: Dict[str, float] = {}
+        self._running: Dict[str, threading.Thread] = {}
+        self._history: Dict[str, deque] = {}
+        self._is_leader = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 主实例选举 ----------
+
+    def is_leader(self) -> bool:
+        """当前是否执行集群任务（Redis 不可用时每个实例都执行）"""
+        return self.elect and (self._is_leader or not is_redis_healthy())
+
+    def _check_leader(self) -> bool:
+        if not is_redis_healthy():
+            return True
+        try:
+            is_leader = bool(_leader_script(
+                keys=[SCHEDULER_LEADER_KEY],
+                args=[self.instance_id, SCHEDULER_LEASE_SECONDS * 1000],
+            ))
+        except Exception as e:
+            print(f"[Scheduler] 续约主实例租约失败: {str(e)}")
+            return False
+        if is_leader != self._is_leader:
+            print(f"[Scheduler] {self.instance_id} {'成为' if is_leader else '不再是'}主实例")
+        self._is_leader = is_leader
+        return is_leader
+
+    def _resign(self):
+        if not self._is_leader:
+            return
+        try:
+            redis_client.eval(_RESIGN_SCRIPT, 1, SCHEDULER_LEADER_KEY, self.instance_id)
+        except Exception:
+            pass
+        self._is_leader = False
+
+    # ---------- 执行时间 ----------
+
+    def _shared_schedule(self, job: ScheduledJob) -> bool:
+        return job.leader_only and is_redis_healthy()
+
+    def _get_next_run(self, job: ScheduledJob, now: float) -> float:
+        if self._shared_schedule(job):
+            try:
+                value = redis_client.hget(SCHEDULER_NEXT_RUN_KEY, job.name)
+                if value is not None:
+                    return float(value)
+            except Exception as e:
+                print(f"[Scheduler] 读取任务 {job.name} 的执行时间失败: {str(e)}")
+        if job.name not in self._next_run:
+            self._next_run[job.name] = job.first_run(now)
+        return self._next_run[job.name]
+
+    def _set_next_run(self, job: ScheduledJob, next_run: float):
+        self._next_run[job.name] = next_run
+        if self._shared_schedule(job):
+            try:
+                redis_client.hset(SCHEDULER_NEXT_RUN_KEY, job.name, next_run)
+            except Exception as e:
+                print(f"[Scheduler] 保存任务 {job.name} 的执行时间失败: {str(e)}")
+
+    # ---------- 执行记录 ----------
+
+    def _record_run(self, job: ScheduledJob, started: float, duration: float, error: Optional[str]):
+        record = {
+            "instance": self.instance_id,
+            "started_at": int(started),
+            "duration": round(duration, 3),
+            "status": "failed" if error else "success",
+            "error": error,
+        }
+        self._history.setdefault(job.name, deque(maxlen=SCHEDULER_HISTORY_MAX)).appendleft(record)
+        if not job.leader_only or not is_redis_healthy():
+            return
+        try:
+            pipe = redis_client.pipeline()
+            pipe.lpush(SCHEDULER_HISTORY_KEY + job.name, json.dumps(record, ensure_ascii=False))
+            pipe.ltrim(SCHEDULER_HISTORY_KEY + job.name, 0, SCHEDULER_HISTORY_MAX - 1)
+            pipe.execute()
+        except Exception as e:
+            print(f"[Scheduler] 保存任务 {job.name} 的执行记录失败: {str(e)}")
+
+    def _execute(self, job: ScheduledJob):
+        started = time.time()
+        error = None
+        try:
+            job.fn()
+        except Exception as e:
+            error = str(e)
+            print(f"[Scheduler] 任务 {job.name} 执行失败: {error}")
+        self._record_run(job, started, time.time() - started, error)
+
+    # ---------- 调度循环 ----------
+
+    def tick(self):
+        now = time.time()
+        is_leader = self._check_leader() if self.elect else False
+        for job in self.jobs:
+            if job.leader_only and not is_leader:
+                continue
+            if now < self._get_next_run(job, now):
+                continue
+            self._set_next_run(job, job.next_after(now))
+            running = self._running.get(job.name)
+            if running is not None and running.is_alive():
+                print(f"[Scheduler] 任务 {job.name} 上一次执行尚未结束，跳过")
+                continue
+            thread = threading.Thread(target=self._execute, args=(job,), name=f"job-{job.name}", daemon=True)
+            self._running[job.name] = thread
+            thread.start()
+
+    def run(self):
+        """阻塞运行调度循环，直到 stop 被调用；之后应调用 shutdown 等待任务结束并释放租约"""
+        print(f"[Scheduler] {self.instance_id} 已启动，任务: {', '.join(job.name for job in self.jobs)}")
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[Scheduler] 调度循环发生错误: {str(e)}")
+            self._stop.wait(TICK_SECONDS)
+
+    def start(self):
+        """在后台线程中运行调度循环"""
+        self._thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止调度循环（可在信号处理函数中调用）"""
+        self._stop.set()
+
+    def shutdown(self, timeout: float):
+        """停止调度，等待执行中的任务结束（最多 timeout 秒）后释放主实例租约"""
+        self.stop()
+        deadline = time.time() + timeout
+        if self._thread is not None:
+            self._thread.join(max(0.0, deadline - time.time()))
+        for name, thread in list(self._running.items()):
+            thread.join(max(0.0, deadline - time.time()))
+            if thread.is_alive():
+                print(f"[Scheduler] 停机时任务 {name} 仍未结束")
+        self._resign()
+
+    def status(self) -> List[Dict[str, Any]]:
+        """各任务的下次执行时间和最近的执行记录（集群任务读取Redis中所有实例的记录）"""
+        result = []
+        now = time.time()
+        for job in self.all_jobs:
+            history = list(self._history.get(job.name, []))
+            if job.leader_only and is_redis_healthy():
+                try:
+                    history = [json.loads(item) for item in redis_client.lrange(SCHEDULER_HISTORY_KEY + job.name, 0, -1)]
+                except Exception as e:
+                    print(f"[Scheduler] 读取任务 {job.name} 的执行记录失败: {str(e)}")
+            running = self._running.get(job.name)
+            result.append({
+                "name": job.name,
+                "leader_only": job.leader_only,
+                "interval": job.interval,
+                "daily_at": job.daily_at,
+                "next_run": int(self._get_next_run(job, now)),
+                "running": running is not None and running.is_alive(),
+                "history": history,
+            })
+        return result
+
+
+# 当前进程中运行的调度器
+_scheduler: Optional[Scheduler] = None
+
+
+def stop_scheduler(timeout: float):
+    """停止本进程的调度器"""
+    if _scheduler is not None:
+        _scheduler.shutdown(timeout)
+
+
+def start_scheduler(elect: bool = True) -> Scheduler:
+    """在后台线程中启动本进程的调度器（每个进程只启动一次）"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler(build_jobs(), elect=elect)
+        _scheduler.start()
+    return _scheduler
+
+
+def get_leader() -> Optional[str]:
+    """当前主实例的标识，Redis 不可用时返回None"""
+    try:
+        return redis_client.get(SCHEDULER_LEADER_KEY)
+    except Exception:
+        return None
+
+
+def scheduler_status() -> Dict[str, Any]:
+    """调度器状态：主实例、本实例和各任务的执行记录"""
+    return {
+        "leader": get_leader(),
+        "instance": _scheduler.instance_id if _scheduler else None,
+        "jobs": _scheduler.status() if _scheduler else [],
+    }
+
+
+def _refresh_redis_cache():
+    """重建Redis账号候选缓存（内存账号池模式下由各进程的 flush_usage 任务负责）"""
+    from db import session_scope
+    from utils.account_manager import refresh_accounts_cache, use_memory_pool
+    if use_memory_pool():
+        return
+    with session_scope() as db:
+        refresh_accounts_cache(db)
+
+
+def _flush_usage():
+    """写回本进程缓冲的使用次数；内存账号池模式下同时重新加载本进程的账号池"""
+    from db import session_scope
+    from utils.account_manager import refresh_accounts_cache, use_memory_pool
+    from utils.usage_counter import flush_usage_counts
+    with session_scope() as db:
+        flush_usage_counts(db)
+        if use_memory_pool():
+            refresh_accounts_cache(db)
+
+
+def build_jobs() -> List[ScheduledJob]:
+    """项目的全部定时任务"""
+    from utils.check_cookies import check_and_refresh_accounts, reset_account_counts, reset_local_counts, CHECK_INTERVAL_SECONDS
+    from utils.check_models import refresh_models
+    return [
+        # 集群任务
+        ScheduledJob("refresh_due_accounts", check_and_refresh_accounts, interval=CHECK_INTERVAL_SECONDS, initial_delay=30),
+        ScheduledJob("refresh_redis_cache", _refresh_redis_cache, interval=60, initial_delay=15, jitter=5),
+        ScheduledJob("reset_account_counts", reset_account_counts, daily_at="00:00", jitter=0),
+        # 进程任务
+        ScheduledJob("flush_usage", _flush_usage, interval=60, initial_delay=15, leader_only=False, jitter=5),
+        ScheduledJob("reset_local_counts", reset_local_counts, daily_at="00:00", leader_only=False, jitter=0),
+        # 模型列表写入本地文件，每个实例各自刷新
+        ScheduledJob("refresh_models", refresh_models, interval=6 * 3600, initial_delay=60, leader_only=False),
+    ]
@@ -0,0 +1,202 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from env import REQUEST_COALESCING
+
+# 相同请求的并发合并（single-flight，每个进程独立）：
+# 同一时刻完全相同的 /v1/chat/completions 请求只向上游发起一次生成，其余请求挂到这次生成上
+# - 流式：上游事件由后台任务写入回放缓冲，每个订阅者（包括发起请求的客户端）都从第一个事件开始读取，
+#   生成途中加入的请求先补齐已有事件再继续等待新事件
+# - 非流式：所有请求等待同一个结果
+# - 订阅者在发起或合并请求时立即登记，请求结束时释放；所有订阅者都释放后取消上游生成
+# - 生成结束后从登记表移除，之后的相同请求重新发起（或命中响应缓存）
+_flights: Dict[str, "Flight"] = {}
+_stats = {"leaders": 0, "followers": 0, "cancelled": 0}
+
+
+def coalescing_enabled(header: Optional[str]) -> bool:
+    """REQUEST_COALESCING 为默认值，请求头 X-Coalesce: true/false 可按请求开启或关闭"""
+    if header:
+        return header.strip().lower() in ("1", "true", "yes", "on")
+    return REQUEST_COALESCING
+
+
+class Flight:
+    """一次上游生成：回放缓冲、结果和订阅者计数"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._pumping = False
+        # 上游已建立（交给后台任务）或发起请求失败时置位
+        self.started = asyncio.Event()
+        self._updated = asyncio.Event()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def _finish(self, error: Optional[BaseException] = None):
+        self.error = error
+        self.done = True
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+        self.started.set()
+        self._notify()
+
+    def fail(self, error: BaseException):
+        """上游建立之前失败（或发起请求的客户端断开），挂在上面的请求随之失败"""
+        if not self.started.is_set():
+            self._finish(error)
+
+    def run_stream(self, source: AsyncIterator[str], cleanup: Optional[Callable[[], Awaitable[None]]] = None):
+        """
+        由后台任务消费上游事件流并写入回放缓冲
+
+        Args:
+            source: 上游事件流，结束时自行释放账号、准入许可和连接
+            cleanup: 任务在开始读取 source 之前就被取消时（source 的 finally 不会执行）用来释放这些资源
+        """
+        self.task = asyncio.create_task(self._pump(source))
+        self.started.set()
+
+        def on_done(task: asyncio.Task):
+            if not self._pumping:
+                self._finish(asyncio.CancelledError())
+                if cleanup is not None:
+                    asyncio.ensure_future(cleanup())
+
+        self.task.add_done_callback(on_done)
+
+    def run_result(self, coro: Awaitable[Any]):
+        """由后台任务执行非流式生成"""
+        self.task = asyncio.ensure_future(coro)
+        self.task.add_done_callback(lambda task: self._finish(None if task.cancelled() else task.exception()))
+        self.started.set()
+
+    async def _pump(self, source: AsyncIterator[str]):
+        self._pumping = True
+        error = None
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError as e:
+            error = e
+            raise
+        except Exception as e:
+            # 错误以错误事件发给订阅者
+            error = e
+        finally:
+            # 确保上游生成器的 finally（释放账号、准入许可和连接）被执行
+            await source.aclose()
+            self._finish(error)
+
+    async def wait_started(self):
+        """等待上游建立；发起请求失败时按同样的错误返回"""
+        await self.started.wait()
+        if self.task is None and self.error is not None:
+            if isinstance(self.error, HTTPException):
+                raise self.error
+            raise HTTPException(status_code=503, detail="Upstream request failed, please retry")
+
+    def attach(self) -> "Subscription":
+        """登记一个订阅者（发起请求或合并进来时立即登记，而不是开始读取时）"""
+        self.subscribers += 1
+        return Subscription(self)
+
+    def _detach(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and self.task and not self.task.done():
+            # 没有客户端在等待结果，停止上游生成
+            _stats["cancelled"] += 1
+            self.task.cancel()
+
+
+def _error_event(error: BaseException) -> str:
+    """上游生成中途失败或被取消时发给客户端的错误事件"""
+    if isinstance(error, asyncio.CancelledError):
+        message = "Upstream generation was cancelled"
+    elif isinstance(error, HTTPException):
+        message = str(error.detail)
+    else:
+        message = str(error) or "Upstream generation failed"
+    payload = {"error": {"message": message, "type": "upstream_error"}}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """
+    挂在一次生成上的请求
+    请求结束（读完、出错或客户端断开）时释放，可重复调用；所有订阅者都释放后才会取消上游生成
+    """
+
+    __slots__ = ("flight", "_released")
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.flight._detach()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """从第一个事件开始读取流式响应；上游中途失败或被取消时以错误事件结束"""
+        flight = self.flight
+        index = 0
+        try:
+            while True:
+                while index < len(flight.events):
+                    yield flight.events[index]
+                    index += 1
+                if flight.done:
+                    break
+                await flight._updated.wait()
+            if flight.error is not None:
+                yield _error_event(flight.error)
+                yield "data: [DONE]\n\n"
+        finally:
+            self.release()
+
+    async def result(self) -> Any:
+        """等待非流式生成的结果"""
+        try:
+            return await asyncio.shield(self.flight.task)
+        finally:
+            self.release()
+
+
+def join_flight(key: str) -> Optional[Subscription]:
+    """挂到相同请求正在进行的生成上，没有时返回None"""
+    flight = _flights.get(key)
+    if flight is None or flight.done:
+        return None
+    _stats["followers"] += 1
+    return flight.attach()
+
+
+def start_flight(key: str) -> Subscription:
+    """登记一次新的生成并作为第一个订阅者，之后的相同请求会挂到它上面"""
+    flight = Flight(key)
+    _flights[key] = flight
+    _stats["leaders"] += 1
+    return flight.attach()
+
+
+def coalescing_stats() -> Dict[str, Any]:
+    """本进程的请求合并统计：进行中的生成数、发起/合并/取消次数"""
+    return {
+        "enabled_by_default": REQUEST_COALESCING,
+        "in_flight": len(_flights),
+        **_stats,
+    }
@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+from env import TASK_STATUS_TTL, TASK_DETAILS_MAX
+from utils.redis_cache import redis_client, KEY_PREFIX, is_redis_healthy
+
+# 后台任务（批量注册、批量刷新）的状态存储
+# Redis 中每个任务四个键，均带 TTL 自动清理，任务有进度时续期：
+#   task:<id>          HASH   计数器和状态：kind/total/processed/success/failed/status/created_at，
+#                             seq 为条目更新序号
+#   task:<id>:details  HASH   每个条目（邮箱/账号）的最新状态描述，最多保留 TASK_DETAILS_MAX 个条目
+#   task:<id>:updated  ZSET   条目 -> 最近一次更新的序号，查询时只返回 details 游标之后有变化的条目，
+#                             超出上限时淘汰最久未更新的条目
+#   task:<id>:results  STREAM 条目的最终结果（成功/失败），最多保留 TASK_DETAILS_MAX 条，条目ID即游标；
+#                             处理中的中间状态只更新 details，不写入，避免挤掉最终结果
+# 所有 worker 和副本共享同一份状态；Redis 不可用时退回进程内存储（同样有数量上限）
+TASK_KEY = f"{KEY_PREFIX}task:"
+_COUNTERS = ("total", "processed", "success", "failed")
+
+# KEYS[1]: 状态，KEYS[2]: details，KEYS[3]: updated，KEYS[4]: results
+# ARGV[1]: 条目，ARGV[2]: 状态描述，ARGV[3]: 是否成功（空串表示处理中，'1' 成功，'0' 失败），
+# ARGV[4]: 保留时间，ARGV[5]: 条目数上限
+_REPORT_SCRIPT = """
+local seq = redis.call('hincrby', KEYS[1], 'seq', 1)
+if ARGV[3] ~= '' then
+    redis.call('hincrby', KEYS[1], 'processed', 1)
+    redis.call('hincrby', KEYS[1], ARGV[3] == '1' and 'success' or 'failed', 1)
+    redis.call('xadd', KEYS[4], 'MAXLEN', '~', ARGV[5], '*', 'item', ARGV[1], 'detail', ARGV[2], 'success', ARGV[3])
+    redis.call('expire', KEYS[4], ARGV[4])
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[3], seq, ARGV[1])
+local overflow = redis.call('zcard', KEYS[3]) - tonumber(ARGV[5])
+if overflow > 0 then
+    local evicted = redis.call('zrange', KEYS[3], 0, overflow - 1)
+    redis.call('zremrangebyrank', KEYS[3], 0, overflow - 1)
+    redis.call('hdel', KEYS[2], unpack(evicted))
+end
+for i = 1, 3 do
+    redis.call('expire', KEYS[i], ARGV[4])
+end
+"""
+_report_script = redis_client.register_script(_REPORT_SCRIPT)
+
+# 进程内备用存储：
+# task_id -> {"status": {...}, "details": OrderedDict[item, (seq, detail)]（按更新顺序）,
+#             "results": deque[(seq, item, detail, success)], "seq": int}
+_MAX_LOCAL_TASKS = 100
+_local_tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _status_key(task_id: str) -> str:
+    return f"{TASK_KEY}{task_id}"
+
+
+def _details_key(task_id: str) -> str:
+    return f"{TASK_KEY}{task_id}:details"
+
+
+def _updated_key(task_id: str) -> str:
+    return f"{TASK_KEY}{task_id}:updated"
+
+
+def _results_key(task_id: str) -> str:
+    return f"{TASK_KEY}{task_id}:results"
+
+
+def _use_redis() -> bool:
+    return is_redis_healthy()
+
+
+def create_task(task_id: str, kind: str, total: int) -> None:
+    """登记一个新任务"""
+    status = {
+        "kind": kind,
+        "total": total,
+        "processed": 0,
+        "success": 0,
+        "failed": 0,
+        "status": "processing",
+        "created_at": int(time.time()),
+    }
+    if _use_redis():
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(_status_key(task_id), mapping=status)
+            pipe.expire(_status_key(task_id), TASK_STATUS_TTL)
+            pipe.execute()
+            return
+        except Exception as e:
+            print(f"登记任务状态失败，使用进程内存储: {str(e)}")
+    with _local_lock:
+        _local_tasks[task_id] = {"status": status, "details": OrderedDict(), "results": deque(maxlen=TASK_DETAILS_MAX), "seq": 0}
+        while len(_local_tasks) > _MAX_LOCAL_TASKS:
+            _local_tasks.popitem(last=False)
+
+
+def report_item(task_id: str, item: Optional[str], detail: str, success: Optional[bool] = None) -> None:
+    """
+    记录单个条目的进度
+
+    Args:
+        task_id: 任务ID
+        item: 条目标识（邮箱、账号ID等）
+        detail: 状态描述
+        success: 条目最终是否成功；None 表示仍在处理中，不计入 processed，也不写入结果流
+    """
+    with _local_lock:
+        local = _local_tasks.get(task_id)
+    if local is None:
+        try:
+            _report_script(
+                keys=[_status_key(task_id), _details_key(task_id), _updated_key(task_id), _results_key(task_id)],
+                args=[str(item), detail, "" if success is None else int(success), TASK_STATUS_TTL, TASK_DETAILS_MAX],
+            )
+        except Exception as e:
+            print(f"更新任务状态失败: {str(e)}")
+        return
+
+    with _local_lock:
+        local["seq"] += 1
+        if success is not None:
+            local["status"]["processed"] += 1
+            local["status"]["success" if success else "failed"] += 1
+            local["results"].append((local["seq"], str(item), detail, success))
+        details = local["details"]
+        details[str(item)] = (local["seq"], detail)
+        details.move_to_end(str(item))
+        while len(details) > TASK_DETAILS_MAX:
+            details.popitem(last=False)
+
+
+def finish_task(task_id: str, status: str = "completed") -> None:
+    """标记任务结束"""
+    with _local_lock:
+        local = _local_tasks.get(task_id)
+        if local is not None:
+            local["status"]["status"] = status
+            return
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(_status_key(task_id), "status", status)
+        pipe.expire(_status_key(task_id), TASK_STATUS_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"更新任务状态失败: {str(e)}")
+
+
+def get_task(task_id: str, since: Optional[str] = None, limit: int = 100,
+             details_since: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    查询任务状态
+
+    Args:
+        task_id: 任务ID
+        since: 结果游标，只返回该游标之后的最终结果；None 表示从头开始
+        limit: results 和 details 各自最多返回的条数，0 表示只返回计数器
+        details_since: details 游标，只返回该游标之后状态有变化的条目；None 表示从头开始
+
+    Returns:
+        任务不存在时返回None，否则为包含以下内容的字典：
+        - 计数器和状态
+        - details: {条目: 最新状态描述}，只包含 details_since 之后有变化的条目，以及下一次查询用的 details_cursor
+        - results: 游标之后的最终结果列表 [{item, detail, success}]，以及下一次查询用的 cursor
+    """
+    details_after = int(details_since) if details_since and details_since.isdigit() else 0
+    with _local_lock:
+        local = _local_tasks.get(task_id)
+        if local is not None:
+            after = int(since) if since and since.isdigit() else 0
+            entries = [entry for entry in local["results"] if entry[0] > after][:limit]
+            results = [{"item": item, "detail": detail, "success": success} for _, item, detail, success in entries]
+            cursor = str(entries[-1][0]) if entries else str(after)
+            changed = [(item, seq, detail) for item, (seq, detail) in local["details"].items() if seq > details_after][:limit]
+            details = {item: detail for item, _, detail in changed}
+            details_cursor = str(changed[-1][1]) if changed else str(details_after)
+            return dict(local["status"], details=details, details_cursor=details_cursor, results=results, cursor=cursor)
+
+    try:
+        status = redis_client.hgetall(_status_key(task_id))
+        if not status:
+            return None
+        details, details_cursor, results, cursor = {}, str(details_after), [], since or "0-0"
+        if limit > 0:
+            changed = redis_client.zrangebyscore(
+                _updated_key(task_id), f"({details_after}", "+inf", start=0, num=limit, withscores=True
+            )
+            if changed:
+                items = [item for item, _ in changed]
+                # 条目可能刚被淘汰，取不到的跳过
+                details = {
+                    item: detail
+                    for item, detail in zip(items, redis_client.hmget(_details_key(task_id), items))
+                    if detail is not None
+                }
+                details_cursor = str(int(changed[-1][1]))
+            entries = redis_client.xread({_results_key(task_id): cursor}, count=limit) or []
+            for _, messages in entries:
+                for entry_id, fields in messages:
+                    results.append({
+                        "item": fields.get("item"),
+                        "detail": fields.get("detail"),
+                        "success": fields.get("success") == "1",
+                    })
+                    cursor = entry_id
+    except Exception as e:
+        print(f"查询任务状态失败: {str(e)}")
+        return None
+
+    status.pop("seq", None)
+    for name in _COUNTERS:
+        status[name] = int(status.get(name, 0))
+    status["created_at"] = int(status.get("created_at", 0))
+    return dict(status, details=details, details_cursor=details_cursor, results=results, cursor=cursor)
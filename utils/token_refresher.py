@@ -0,0 +1,195 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from db import session_scope
+from env import (
+    TOKEN_REFRESH_LEAD_SECONDS,
+    TOKEN_REFRESH_JITTER_SECONDS,
+    TOKEN_REFRESH_WORKERS,
+    TOKEN_REFRESH_RETRY_SECONDS,
+)
+from models.tokens import Token
+from utils.check_cookies import refresh_single_account
+
+logger = logging.getLogger("token_refresher")
+
+# 每隔多久从数据库重新同步一次账号列表（秒），用于发现新增/启用的账号
+RELOAD_INTERVAL_SECONDS = 60
+# 调度循环的最长休眠时间（秒）
+MAX_IDLE_SECONDS = 5
+
+
+class TokenRefresher:
+    """
+    主动刷新器：按 token_expires 把账号放入优先队列，
+    在过期前 TOKEN_REFRESH_LEAD_SECONDS 秒（加随机抖动）刷新凭据，
+    请求链路因此总是拿到新鲜的凭据，只有在极端情况下才需要内联刷新
+
+    access_token 的到期刷新只由这里负责（check_cookies 的定时任务只处理 cookies 过期和禁用账号重试）；
+    到期时先重新读取 token_expires，账号已被其他途径（请求链路、批量刷新）刷新过时只重新排期
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+        self._running = False
+        self._last_reload = 0.0
+
+    def _due_time(self, token_expires: Optional[datetime]) -> float:
+        """计算账号的刷新时间点（时间戳）"""
+        if token_expires is None:
+            # 没有记录过期时间的账号尽快刷新，同样加抖动避免扎堆
+            return time.time() + random.uniform(0, TOKEN_REFRESH_JITTER_SECONDS)
+        return (
+            token_expires.timestamp()
+            - TOKEN_REFRESH_LEAD_SECONDS
+            - random.uniform(0, TOKEN_REFRESH_JITTER_SECONDS)
+        )
+
+    def schedule(self, account_id: int, token_expires: Optional[datetime], not_before: Optional[float] = None):
+        """加入或更新账号的刷新计划；not_before 为最早的刷新时间点（时间戳）"""
+        due = self._due_time(token_expires)
+        if not_before is not None:
+            due = max(due, not_before)
+        with self._lock:
+            self._due[account_id] = due
+            heapq.heappush(self._heap, (due, account_id))
+
+    def unschedule(self, account_id: int):
+        """取消账号的刷新计划（堆中的旧元素在弹出时丢弃）"""
+        with self._lock:
+            self._due.pop(account_id, None)
+
+    def reload(self):
+        """从数据库同步启用账号的 token_expires"""
+        with session_scope() as db:
+            rows = (
+                db.query(Token.id, Token.token_expires)
+                .filter(Token.enable == 1, Token.deleted_at == None)
+                .all()
+            )
+        alive = {row.id for row in rows}
+        with self._lock:
+            known = set(self._due)
+            # 已禁用或已删除的账号不再刷新
+            for account_id in known - alive:
+                self._due.pop(account_id, None)
+        for row in rows:
+            if row.id not in known:
+                self.schedule(row.id, row.token_expires)
+        self._last_reload = time.time()
+
+    def _pop_due(self, now: float) -> List[int]:
+        """取出所有已到刷新时间的账号"""
+        due_ids = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, account_id = heapq.heappop(self._heap)
+                if self._due.get(account_id) != due or account_id in self._in_flight:
+                    continue
+                self._due.pop(account_id, None)
+                self._in_flight.add(account_id)
+                due_ids.append(account_id)
+        return due_ids
+
+    def _seconds_until_next(self) -> float:
+        with self._lock:
+            if not self._heap:
+                return MAX_IDLE_SECONDS
+            return max(0.0, min(MAX_IDLE_SECONDS, self._heap[0][0] - time.time()))
+
+    @staticmethod
+    def _load(account_id: int):
+        with session_scope() as db:
+            return (
+                db.query(Token.id, Token.token_expires, Token.enable)
+                .filter(Token.id == account_id, Token.deleted_at == None)
+                .first()
+            )
+
+    @staticmethod
+    def _still_fresh(token_expires: Optional[datetime]) -> bool:
+        """token_expires 在最早的刷新时间点之后，说明排期之后已被刷新过"""
+        if token_expires is None:
+            return False
+        lead = TOKEN_REFRESH_LEAD_SECONDS + TOKEN_REFRESH_JITTER_SECONDS
+        return token_expires.timestamp() - time.time() > lead
+
+    @staticmethod
+    def _retry_time() -> float:
+        return time.time() + TOKEN_REFRESH_RETRY_SECONDS + random.uniform(0, TOKEN_REFRESH_JITTER_SECONDS)
+
+    def _refresh(self, account_id: int):
+        """刷新单个账号，并按新的 token_expires 重新排期"""
+        try:
+            row = self._load(account_id)
+            if not row or row.enable != 1:
+                # 已禁用或已删除，重试由 check_cookies 的定时任务负责
+                return
+            if not self._still_fresh(row.token_expires):
+                refresh_single_account(account_id)
+                row = self._load(account_id)
+            if row and row.enable == 1:
+                # 刷新失败但账号未被禁用时 token_expires 不变、刷新时间点已过，退避后再重试
+                self.schedule(account_id, row.token_expires, not_before=self._retry_time())
+        except Exception as e:
+            logger.exception(f"主动刷新账号 {account_id} 失败: {str(e)}")
+            self.schedule(account_id, None, not_before=self._retry_time())
+        finally:
+            with self._lock:
+                self._in_flight.discard(account_id)
+
+    def _clear(self):
+        """放弃当前的刷新计划，重新激活时从数据库重新加载"""
+        with self._lock:
+            self._heap = []
+            self._due.clear()
+        self._last_reload = 0.0
+
+    def run(self, active: Optional[Callable[[], bool]] = None):
+        """
+        运行刷新循环
+
+        Args:
+            active: 返回当前是否应执行刷新的函数（如是否为调度器主实例）；为None时始终执行
+
+        注意：此函数会阻塞当前线程，应在单独的线程中运行
+        """
+        if self._running:
+            logger.warning("主动刷新器已在运行中")
+            return
+        self._running = True
+        logger.info(
+            f"主动刷新器已启动，提前 {TOKEN_REFRESH_LEAD_SECONDS} 秒刷新，"
+            f"抖动 {TOKEN_REFRESH_JITTER_SECONDS} 秒，并发 {TOKEN_REFRESH_WORKERS}"
+        )
+        with ThreadPoolExecutor(max_workers=TOKEN_REFRESH_WORKERS) as executor:
+            while self._running:
+                if active is not None and not active():
+                    # 多进程/多副本部署时只有一个实例主动刷新
+                    if self._due:
+                        self._clear()
+                    time.sleep(MAX_IDLE_SECONDS)
+                    continue
+                try:
+                    if time.time() - self._last_reload >= RELOAD_INTERVAL_SECONDS:
+                        self.reload()
+                    for account_id in self._pop_due(time.time()):
+                        executor.submit(self._refresh, account_id)
+                except Exception as e:
+                    logger.exception(f"主动刷新器发生异常: {str(e)}")
+                time.sleep(self._seconds_until_next() or 0.1)
+
+    def stop(self):
+        self._running = False
+
+
+token_refresher = TokenRefresher()
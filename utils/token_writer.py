@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from db import session_scope
+from env import TOKEN_UPSERT_BATCH, TOKEN_UPSERT_FLUSH_MS
+from models.tokens import Token, upsert_tokens
+from utils.account_manager import token_to_dict
+from utils.local_cache import invalidate_account
+from utils.redis_cache import cache_account, is_redis_healthy
+
+
+class TokenUpsertCollector:
+    """
+    账号写入收集器：注册和刷新流程提交的账号数据先放入缓冲，
+    凑满 TOKEN_UPSERT_BATCH 条或每隔 TOKEN_UPSERT_FLUSH_MS 毫秒批量 upsert 一次，
+    把成千上万个小事务合并为少量批量事务
+
+    submit 返回 Future，写入成功后结果为账号ID（数据既没有 account 也没有可更新的 id 时为None），失败时抛出写库异常
+    """
+
+    def __init__(self, batch_size: int = TOKEN_UPSERT_BATCH, flush_interval_ms: int = TOKEN_UPSERT_FLUSH_MS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._pending: List[Tuple[dict, Future]] = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="token-upsert", daemon=True)
+            self._thread.start()
+
+    def submit(self, token_data: dict) -> Future:
+        """提交一条账号数据"""
+        future = Future()
+        with self._cond:
+            self._pending.append((token_data, future))
+            self._ensure_thread()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def _take(self) -> List[Tuple[dict, Future]]:
+        with self._cond:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            return batch
+
+    def flush(self) -> int:
+        """立即写入缓冲中的一批数据，返回写入条数"""
+        batch = self._take()
+        if not batch:
+            return 0
+        try:
+            with session_scope() as db:
+                ids = upsert_tokens(db, [token_data for token_data, _ in batch])
+                written = [account_id for account_id in ids if account_id is not None]
+                enabled = db.query(Token).filter(Token.id.in_(written), Token.enable == 1).all() if written else []
+                account_data = [token_to_dict(account) for account in enabled]
+        except Exception as e:
+            print(f"批量写入账号失败: {str(e)}")
+            for _, future in batch:
+                future.set_exception(e)
+            return 0
+
+        for (_, future), account_id in zip(batch, ids):
+            if account_id is not None:
+                # 凭据已变化，通知所有副本重新加载
+                invalidate_account(account_id)
+            future.set_result(account_id)
+        self._cache_enabled(account_data)
+        return len(batch)
+
+    @staticmethod
+    def _cache_enabled(account_data: List[dict]):
+        """把启用的账号同步到Redis账号缓存，使新凭据立即可用"""
+        if not account_data or not is_redis_healthy():
+            return
+        for data in account_data:
+            cache_account(data["id"], data, is_paid=False)
+            if data.get("account_type") == "paid":
+                cache_account(data["id"], data, is_paid=True)
+
+    def drain(self) -> int:
+        """写入缓冲中的全部数据（停机时调用），返回写入条数"""
+        total = 0
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return total
+            total += self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            started = time.time()
+            while self.flush() >= self.batch_size and time.time() - started < self.flush_interval:
+                # 积压较多时连续写入，直到缓冲不足一批
+                pass
+
+
+token_collector = TokenUpsertCollector()
@@ -0,0 +1,58 @@
+import threading
+from typing import Dict
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# 账号使用次数的写缓冲：account_id -> 尚未写入数据库的增量
+# 请求链路只在内存中累加，由后台线程定期批量写回 tokens.count
+_pending_counts: Dict[int, int] = {}
+_pending_lock = threading.Lock()
+
+
+def record_usage(account_id: int, n: int = 1) -> None:
+    """记录一次账号使用（仅写内存，不访问数据库）"""
+    if account_id is None:
+        return
+    with _pending_lock:
+        _pending_counts[account_id] = _pending_counts.get(account_id, 0) + n
+
+
+def discard_pending_usage() -> int:
+    """丢弃尚未写回的使用次数（每日重置时调用，避免把前一天的增量写到新的一天）"""
+    with _pending_lock:
+        discarded = len(_pending_counts)
+        _pending_counts.clear()
+    return discarded
+
+
+def flush_usage_counts(db: Session) -> int:
+    """
+    将缓冲中的使用次数批量写回数据库
+
+    Args:
+        db: 数据库会话
+
+    Returns:
+        本次写回的账号数量
+    """
+    with _pending_lock:
+        if not _pending_counts:
+            return 0
+        pending = dict(_pending_counts)
+        _pending_counts.clear()
+
+    try:
+        db.execute(
+            text("UPDATE tokens SET count = COALESCE(count, 0) + :n WHERE id = :id"),
+            [{"id": account_id, "n": n} for account_id, n in pending.items()]
+        )
+        db.commit()
+        return len(pending)
+    except Exception as e:
+        db.rollback()
+        # 写回失败时把增量放回缓冲，等待下次重试
+        with _pending_lock:
+            for account_id, n in pending.items():
+                _pending_counts[account_id] = _pending_counts.get(account_id, 0) + n
+        print(f"写回账号使用次数失败: {str(e)}")
+        return 0
@@ -0,0 +1,169 @@
+import time
+from typing import Dict, Iterable, Optional
+
+from env import USAGE_WINDOW_MINUTES, USAGE_RATE_WINDOW_MINUTES, ACCOUNT_RATE_LIMIT, USAGE_PICK_SAMPLE
+from utils.redis_cache import redis_client, KEY_PREFIX, ACCOUNT_KEY, PAID_ACCOUNT_KEY
+
+# 滑动窗口使用量统计：
+# 每次使用记入当前分钟的桶（HASH: account_id -> 次数），同时累加到两个有序集合：
+#   USAGE_DAY_KEY    最近 USAGE_WINDOW_MINUTES 分钟的使用量，用于均衡负载
+#   USAGE_RECENT_KEY 最近 USAGE_RATE_WINDOW_MINUTES 分钟的使用量，用于避开接近上游限流的账号
+# 桶滑出窗口时从有序集合中扣除，游标记录已扣除到哪一分钟；扣除在脚本内原子完成，多副本无需加锁
+USAGE_BUCKET_KEY = f"{KEY_PREFIX}usage_bucket:"
+USAGE_DAY_KEY = f"{KEY_PREFIX}usage_window:day"
+USAGE_RECENT_KEY = f"{KEY_PREFIX}usage_window:recent"
+USAGE_DAY_CURSOR_KEY = f"{KEY_PREFIX}usage_window:day_cursor"
+USAGE_RECENT_CURSOR_KEY = f"{KEY_PREFIX}usage_window:recent_cursor"
+
+# KEYS[1..4]: 日窗口集合、近期窗口集合、日窗口游标、近期窗口游标
+# ARGV[1..5]: 当前分钟、日窗口分钟数、近期窗口分钟数、桶键前缀、桶过期时间（秒）
+_ADVANCE_SNIPPET = """
+local now = tonumber(ARGV[1])
+local bucket_prefix = ARGV[4]
+
+local function advance(zset, cursor_key, window)
+    local expire_upto = now - window
+    local cursor = tonumber(redis.call('get', cursor_key))
+    if cursor and cursor >= expire_upto then
+        return
+    end
+    if cursor and expire_upto - cursor <= window then
+        -- 扣除滑出窗口的桶
+        for minute = cursor + 1, expire_upto do
+            local bucket = redis.call('hgetall', bucket_prefix .. minute)
+            for i = 1, #bucket, 2 do
+                redis.call('zincrby', zset, -tonumber(bucket[i + 1]), bucket[i])
+            end
+        end
+    else
+        -- 首次使用或长时间没有推进（桶可能已过期），按窗口内的桶重建
+        redis.call('del', zset)
+        for minute = expire_upto + 1, now do
+            local bucket = redis.call('hgetall', bucket_prefix .. minute)
+            for i = 1, #bucket, 2 do
+                redis.call('zincrby', zset, tonumber(bucket[i + 1]), bucket[i])
+            end
+        end
+    end
+    redis.call('zremrangebyscore', zset, '-inf', 0)
+    redis.call('set', cursor_key, expire_upto)
+end
+
+local function record(account_id)
+    local bucket_key = bucket_prefix .. now
+    redis.call('hincrby', bucket_key, account_id, 1)
+    redis.call('expire', bucket_key, tonumber(ARGV[5]))
+    redis.call('zincrby', KEYS[1], 1, account_id)
+    redis.call('zincrby', KEYS[2], 1, account_id)
+end
+
+advance(KEYS[1], KEYS[3], tonumber(ARGV[2]))
+advance(KEYS[2], KEYS[4], tonumber(ARGV[3]))
+"""
+
+_advance_script = redis_client.register_script(_ADVANCE_SNIPPET + "return 1")
+
+# ARGV[6]: 账号ID
+_record_script = redis_client.register_script(_ADVANCE_SNIPPET + """
+record(ARGV[6])
+return 1
+""")
+
+# KEYS[5]: 候选账号集合
+# ARGV[6..8]: 账号数据键前缀、近期窗口内的使用上限（0表示不限制）、抽样数
+# 从候选账号中随机抽取 ARGV[8] 个（候选不足时全部参与），选出日窗口使用量最少的账号并记一次使用；
+# 近期使用量达到上限的账号只在抽样中没有其他账号可选时才会被选中。
+# 每次挑选的开销与抽样数成正比，与账号总数无关；持续挑选下使用量仍趋于均衡（多选一负载均衡）
+_pick_script = redis_client.register_script(_ADVANCE_SNIPPET + """
+local account_prefix = ARGV[6]
+local limit = tonumber(ARGV[7])
+local best, best_score, limited, limited_score
+for _, account_id in ipairs(redis.call('srandmember', KEYS[5], tonumber(ARGV[8]))) do
+    if redis.call('exists', account_prefix .. account_id) == 1 then
+        local score = tonumber(redis.call('zscore', KEYS[1], account_id)) or 0
+        local recent = tonumber(redis.call('zscore', KEYS[2], account_id)) or 0
+        if limit > 0 and recent >= limit then
+            if not limited or recent < limited_score then
+                limited, limited_score = account_id, recent
+            end
+        elseif not best or score < best_score then
+            best, best_score = account_id, score
+        end
+    else
+        -- 账号数据已过期，从候选集合中移除
+        redis.call('srem', KEYS[5], account_id)
+    end
+end
+local chosen = best or limited
+if chosen then
+    record(chosen)
+end
+return chosen
+""")
+
+
+def _window_keys():
+    return [USAGE_DAY_KEY, USAGE_RECENT_KEY, USAGE_DAY_CURSOR_KEY, USAGE_RECENT_CURSOR_KEY]
+
+
+def _window_args():
+    return [
+        int(time.time() // 60),
+        USAGE_WINDOW_MINUTES,
+        USAGE_RATE_WINDOW_MINUTES,
+        USAGE_BUCKET_KEY,
+        (USAGE_WINDOW_MINUTES + 2) * 60,
+    ]
+
+
+def pick_least_used(is_paid: bool = False) -> Optional[int]:
+    """
+    从Redis候选账号中随机抽取 USAGE_PICK_SAMPLE 个，挑选其中滑动窗口内使用量最少的账号，并记一次使用
+
+    Args:
+        is_paid: 是否从付费账号候选中挑选
+
+    Returns:
+        账号ID，没有候选账号时返回None
+    """
+    base_key = PAID_ACCOUNT_KEY if is_paid else ACCOUNT_KEY
+    account_id = _pick_script(
+        keys=_window_keys() + [base_key + "set"],
+        args=_window_args() + [base_key, ACCOUNT_RATE_LIMIT, USAGE_PICK_SAMPLE],
+    )
+    return int(account_id) if account_id is not None else None
+
+
+def record_window_usage(account_id: int) -> bool:
+    """记一次账号使用（用于不经过 pick_least_used 选出的账号）"""
+    try:
+        _record_script(keys=_window_keys(), args=_window_args() + [account_id])
+        return True
+    except Exception as e:
+        print(f"记录账号窗口使用量失败: {str(e)}")
+        return False
+
+
+def get_window_usage(account_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    查询账号在最近 USAGE_WINDOW_MINUTES 分钟内的使用次数
+
+    Args:
+        account_ids: 账号ID列表
+
+    Returns:
+        account_id -> 使用次数，Redis不可用时返回空字典
+    """
+    account_ids = list(account_ids)
+    if not account_ids:
+        return {}
+    try:
+        _advance_script(keys=_window_keys(), args=_window_args())
+        pipe = redis_client.pipeline(transaction=False)
+        for account_id in account_ids:
+            pipe.zscore(USAGE_DAY_KEY, account_id)
+        scores = pipe.execute()
+    except Exception as e:
+        print(f"查询账号窗口使用量失败: {str(e)}")
+        return {}
+    return {account_id: int(score or 0) for account_id, score in zip(account_ids, scores)}
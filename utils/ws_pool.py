@@ -2,6 +2,9 @@ from typing import Dict, Any, Callable
 import asyncio
 import json
 
+# 注意：这里的连接和队列都是进程内的，多 worker 部署时不能跨进程使用；
+# 当前请求链路不再使用本模块（见 routers/reverse.py）
+#
 # This module maintains two global pools:
 # 1. ws_pool:   account(str) -> {"sid": str, "ws": AsyncWebSocket}
 # 2. msg_pool:  chat_id(str) -> asyncio.Queue that stores completion chunks coming from the websocket stream
@@ -100,6 +103,20 @@ async def get_ws(account: Any, ws_factory: Callable[[Any], "AsyncWebSocket"]):
         asyncio.create_task(_ws_listener(account_key))
         return ws
 
+async def close_all():
+    """Close every pooled websocket and alert pending consumers (called on shutdown)."""
+    async with _pool_lock:
+        entries = list(ws_pool.values())
+        ws_pool.clear()
+    for entry in entries:
+        try:
+            await entry["ws"].close()
+        except Exception:
+            pass
+    for queue in list(msg_pool.values()):
+        await queue.put({"error": "ws_closed"})
+    msg_pool.clear()
+
 def get_msg_queue(chat_id: str) -> asyncio.Queue:
     """Return (and create if necessary) the message queue for *chat_id*."""
     return _get_or_create_queue(chat_id)
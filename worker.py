@@ -0,0 +1,70 @@
+"""
+后台作业 worker：从Redis作业队列中取出批量注册、批量刷新作业并执行
+
+用法：
+    python worker.py                       # 单进程，并发作业数取 JOB_WORKER_CONCURRENCY
+    python worker.py --processes 4 --concurrency 2
+
+worker 进程退出或崩溃后，执行中的作业在 JOB_LEASE_SECONDS 秒后由其他 worker 接管，跳过已完成的条目继续执行
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+
+from env import PROXY_URL, JOB_WORKER_CONCURRENCY, SHUTDOWN_TIMEOUT_SECONDS
+
+
+def run_worker(concurrency: int):
+    from models.tokens import check_schema
+    from utils.job_queue import JobWorker
+    from utils.token_writer import token_collector
+
+    # 凭据迁移未执行时拒绝启动
+    check_schema()
+
+    worker = JobWorker(concurrency)
+    # 收到 SIGTERM/SIGINT 后停止领取作业，等待执行中的作业结束，超时则释放租约交给其他 worker
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run(SHUTDOWN_TIMEOUT_SECONDS)
+    token_collector.drain()
+    print(f"[Worker] {worker.worker_id} 已停止")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatBetter2API 后台作业 worker")
+    parser.add_argument("--processes", type=int, default=1, help="worker 进程数")
+    parser.add_argument("--concurrency", type=int, default=JOB_WORKER_CONCURRENCY, help="每个进程同时执行的作业数")
+    args = parser.parse_args()
+
+    # 与 API 进程一致，设置全局代理（如果有配置）
+    if PROXY_URL:
+        os.environ["http_proxy"] = PROXY_URL
+        os.environ["https_proxy"] = PROXY_URL
+
+    if args.processes <= 1:
+        run_worker(args.concurrency)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(args.concurrency,), name=f"worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, _frame):
+        # 把停止信号转发给子进程，由子进程各自完成停机
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()